@@ -9,6 +9,7 @@ from django.utils.safestring import mark_safe
 from ..models import Contact
 from ..models import Newsletter
 from ..models import Attachment
+from ..models import PoolServer
 from ..models import MailingList
 from ..mailer import Mailer
 from ..settings import USE_TINYMCE
@@ -25,6 +26,12 @@ class AttachmentAdminInline(admin.TabularInline):
     fieldsets = ((None, {'fields': (('title', 'file_attachment'))}),)
 
 
+class PoolServerAdminInline(admin.TabularInline):
+    model = PoolServer
+    extra = 0
+    fieldsets = ((None, {'fields': (('server', 'weight'))}),)
+
+
 class BaseNewsletterAdmin(admin.ModelAdmin):
     date_hierarchy = 'creation_date'
     list_display = ('title', 'mailing_list', 'status',
@@ -35,13 +42,16 @@ class BaseNewsletterAdmin(admin.ModelAdmin):
     filter_horizontal = ['test_contacts']
     fieldsets = ((None, {'fields': ('title', 'import_url', 'content',)}),
                  (_('Receivers'), {'fields': ('mailing_list', 'test_contacts',)}),
-                 (_('Sending'), {'fields': ('sending_date', 'status',)}),
+                 (_('Sending'), {'fields': ('sending_date', 'projected_completion',
+                                            'status', 'priority',
+                                            'identical_content')}),
                  (_('Miscellaneous'), {'fields': ('server', 'header_sender',
                                                   'header_reply', 'slug'),
                                        'classes': ('collapse',)}),
                  )
+    readonly_fields = ('projected_completion',)
     prepopulated_fields = {'slug': ('title',)}
-    inlines = (AttachmentAdminInline,)
+    inlines = (AttachmentAdminInline, PoolServerAdminInline)
     actions = ['send_mail_test', 'make_ready_to_send', 'make_cancel_sending']
     actions_on_top = False
     actions_on_bottom = True
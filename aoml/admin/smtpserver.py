@@ -5,6 +5,7 @@ from django.core.exceptions import ValidationError
 from django.utils.translation import gettext_lazy as _
 
 from ..models import SMTPServer
+from ..rates import parse_schedule
 
 
 class SMTPServerAdminForm(forms.ModelForm):
@@ -21,6 +22,15 @@ class SMTPServerAdminForm(forms.ModelForm):
 
         return self.cleaned_data['headers']
 
+    def clean_rate_schedule(self):
+        """Check if the rules of the rate schedule are well formated"""
+        try:
+            parse_schedule(self.cleaned_data['rate_schedule'])
+        except ValueError as e:
+            raise ValidationError(_('Invalid syntax: %s.') % e)
+
+        return self.cleaned_data['rate_schedule']
+
     class Meta:
         model = SMTPServer
         fields = '__all__'
@@ -28,13 +38,17 @@ class SMTPServerAdminForm(forms.ModelForm):
 
 class SMTPServerAdmin(admin.ModelAdmin):
     form = SMTPServerAdminForm
-    list_display = ('name', 'host', 'port', 'user', 'tls', 'ssl', 'mails_hour',)
+    list_display = ('name', 'host', 'port', 'user', 'tls', 'ssl', 'mails_hour', 'effective_rate',
+                    'max_connections',)
     list_filter = ('tls',)
     search_fields = ('name', 'host', 'user')
     fieldsets = ((None, {'fields': ('name', )}),
                  (_('Configuration'), {'fields': ('host', 'port',
                                                   'user', 'password', 'tls', 'ssl')}),
-                 (_('Miscellaneous'), {'fields': ('mails_hour', 'headers'),
+                 (_('Miscellaneous'), {'fields': ('mails_hour', 'rate_schedule', 'warmup_start',
+                                                  'adaptive_rate', 'max_connections',
+                                                  'session_messages', 'session_lifetime',
+                                                  'keepalive', 'headers'),
                                        'classes': ('collapse', )}),
                  )
     actions = ['check_connections']
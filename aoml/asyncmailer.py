@@ -0,0 +1,490 @@
+"""Asyncio engine for sending the newsletters"""
+import ssl
+import time
+import base64
+import asyncio
+from datetime import datetime
+from itertools import islice
+from collections import deque
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from smtplib import SMTPConnectError
+from smtplib import SMTPDataError
+from smtplib import SMTPHeloError
+from smtplib import SMTPNotSupportedError
+from smtplib import SMTPResponseException
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPServerDisconnected
+from smtplib import SMTPAuthenticationError
+
+from django.utils import timezone
+from django.utils.encoding import smart_str
+
+from .models import Newsletter
+from .journal import StatusJournal
+from .mailer import NewsLetterSender
+from .mailer import IDLE_SLEEP
+from .wakeup import Listener
+from .retry import is_disconnected
+from .throttle import Throttle
+from .domains import DomainGate
+from .domains import domain_of
+from .domains import interleave
+from .session import expired
+from .pipelining import envelope
+from .pipelining import encode_data
+from .pipelining import read_envelope
+from .settings import SLEEP_BETWEEN_SENDING
+from .settings import ASYNC_EXECUTOR_WORKERS
+from .settings import EXPEDITION_CHUNK_SIZE
+from .settings import DOMAIN_INTERLEAVE
+from .settings import PIPELINING
+from .settings import BATCH_RECIPIENTS
+
+
+class AsyncSMTP(object):
+    """Minimal SMTP client for asyncio, raising the smtplib exceptions"""
+
+    def __init__(self, host, port=25, username='', password='',
+                 use_tls=False, use_ssl=False, timeout=60):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.reader = self.writer = None
+        self.esmtp_features = {}
+        self.messages = 0
+        self.opened = self.used = time.monotonic()
+
+    @classmethod
+    def from_server(cls, server):
+        return cls(smart_str(server.host), int(server.port),
+                   smart_str(server.user), smart_str(server.password),
+                   use_tls=server.tls, use_ssl=server.ssl)
+
+    async def connect(self):
+        """Open the connection, say hello, start TLS and log in"""
+        self.opened = self.used = time.monotonic()
+        context = ssl.create_default_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context),
+            self.timeout)
+        code, message = await self.get_reply()
+        if code != 220:
+            await self.close()
+            raise SMTPConnectError(code, message)
+        await self.ehlo()
+
+        if self.use_tls and not self.use_ssl:
+            if 'starttls' not in self.esmtp_features:
+                raise SMTPNotSupportedError('STARTTLS extension not supported by server.')
+            code, message = await self.command('STARTTLS')
+            if code != 220:
+                raise SMTPResponseException(code, message)
+            await self.writer.start_tls(ssl.create_default_context())
+            await self.ehlo()
+
+        if self.username:
+            await self.login()
+
+    async def ehlo(self):
+        code, message = await self.command('EHLO localhost')
+        if code != 250:
+            raise SMTPHeloError(code, message)
+        self.esmtp_features = {}
+        for line in message.decode('latin-1').splitlines()[1:]:
+            feature = line.split(' ', 1)
+            self.esmtp_features[feature[0].lower()] = feature[1] if len(feature) > 1 else ''
+
+    async def login(self):
+        credentials = '\0%s\0%s' % (self.username, self.password)
+        code, message = await self.command('AUTH PLAIN %s' % base64.b64encode(
+            credentials.encode('utf-8')).decode('ascii'))
+        if code not in (235, 503):
+            raise SMTPAuthenticationError(code, message)
+
+    async def command(self, line):
+        self.writer.write(line.encode('ascii') + b'\r\n')
+        await self.writer.drain()
+        return await self.get_reply()
+
+    async def noop(self):
+        """Check the connection, return False if lost"""
+        try:
+            code, message = await self.command('NOOP')
+        except (OSError, SMTPServerDisconnected):
+            return False
+        self.used = time.monotonic()
+        return code == 250
+
+    async def get_reply(self):
+        """Read a reply, possibly on several lines"""
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+            if not line:
+                raise SMTPServerDisconnected('Connection unexpectedly closed')
+            lines.append(line[4:].strip())
+            if line[3:4] != b'-':
+                return int(line[:3]), b'\n'.join(lines)
+
+    async def sendmail(self, from_addr, to_addrs, msg):
+        """Send a message like smtplib.SMTP.sendmail, with the envelope
+        commands sent at once if the server supports pipelining,
+        return the dict of the refused recipients"""
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        data = encode_data(msg)
+        commands = envelope(from_addr, to_addrs)
+
+        if PIPELINING and 'pipelining' in self.esmtp_features:
+            self.writer.write(''.join('%s\r\n' % command for command in
+                                      commands).encode('ascii'))
+            await self.writer.drain()
+            replies = [await self.get_reply() for command in commands]
+        else:
+            replies = []
+            for command in commands:
+                if replies and (replies[0][0] != 250 or command == 'DATA' and all(
+                        code not in (250, 251) for code, message in replies[1:])):
+                    # the envelope is refused, the commands left are not sent
+                    replies.append((503, b''))
+                else:
+                    replies.append(await self.command(command))
+        try:
+            refused = read_envelope(replies, from_addr, to_addrs)
+        except (SMTPSenderRefused, SMTPRecipientsRefused, SMTPDataError):
+            if replies[-1][0] == 354:
+                # the server took DATA anyway, send an empty content
+                self.writer.write(b'.\r\n')
+                await self.get_reply()
+            await self.command('RSET')
+            raise
+
+        self.writer.write(data)
+        await self.writer.drain()
+        code, message = await self.get_reply()
+        if code != 250:
+            raise SMTPDataError(code, message)
+        return refused
+
+    async def quit(self):
+        try:
+            await self.command('QUIT')
+        except (OSError, SMTPServerDisconnected, asyncio.TimeoutError):
+            pass
+        await self.close()
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+class ExpeditionBuffer(deque):
+    """Contacts of a newsletter read by chunks from its expedition list,
+    the chunks are read in the executor and added from the loop"""
+
+    def __init__(self, sender):
+        super(ExpeditionBuffer, self).__init__()
+        self.contacts = sender.iter_expedition_list()
+        if DOMAIN_INTERLEAVE:
+            self.contacts = interleave(self.contacts)
+        self.exhausted = False
+
+    def read(self):
+        return list(islice(self.contacts, EXPEDITION_CHUNK_SIZE))
+
+    def add(self, contacts):
+        self.extend(contacts)
+        self.exhausted = len(contacts) < EXPEDITION_CHUNK_SIZE
+
+    def take(self, domains, count=1):
+        """Pop up to count contacts whose domain is not at its cap"""
+        contacts = []
+        for i in range(len(self)):
+            if len(contacts) == count:
+                break
+            if domains.acquire(self[0]):
+                contacts.append(self.popleft())
+            else:
+                self.rotate(-1)
+        return contacts
+
+    def timeout(self, domains):
+        """Seconds until a contact may be taken"""
+        return min(domains.timeout(domain) for domain in
+                   set(domain_of(contact.email) for contact in self))
+
+
+class AsyncSMTPMailer(object):
+    """Send the newsletters of a SMTP server over max_connections
+    sessions sharing the work, paced with the loop timers to reach
+    the mails per hour limit.
+
+    Rendering and database work is done in the executor of the engine."""
+
+    def __init__(self, server, engine):
+        self.server = server
+        self.engine = engine
+        self.journal = StatusJournal()
+        self.pending = OrderedDict()
+        self.drained = {}
+        self.inflight = {}
+        self.throttle = Throttle(server)
+        self.domains = DomainGate()
+        self.refresh_lock = asyncio.Lock()
+
+    async def run(self):
+        sessions = [self.session() for i in range(max(self.server.max_connections, 1))]
+        try:
+            await asyncio.gather(*sessions)
+        finally:
+            await self.engine.execute(self.journal.close)
+
+    async def session(self):
+        """Send the mails over one connection"""
+        loop = asyncio.get_running_loop()
+        smtp = None
+        try:
+            while not self.engine.stopped:
+                job = await self.next_job()
+                if job is None:
+                    break
+                sender, contacts = job
+                start = None
+                refused = {}
+                try:
+                    if sender.identical_message:
+                        message = sender.batch_message
+                    else:
+                        message = await self.engine.execute(
+                            sender.serialize_message, contacts[0])
+                    if smtp is not None and self.server.keepalive and \
+                            time.monotonic() - smtp.used >= self.server.keepalive and \
+                            not await smtp.noop():
+                        await smtp.close()
+                        smtp = None
+                    if smtp is None:
+                        smtp = AsyncSMTP.from_server(self.server)
+                        await smtp.connect()
+                    await self.pace(len(contacts))
+                    start = loop.time()
+                    refused = await smtp.sendmail(
+                        smart_str(sender.newsletter.header_sender),
+                        [contact.email for contact in contacts], message)
+                except Exception as e:
+                    exception = e
+                    if start is not None:
+                        sender.timings.add('smtp', loop.time() - start, self.server)
+                        self.throttle.record(loop.time() - start, e)
+                    if (is_disconnected(e) or isinstance(e, asyncio.TimeoutError)) \
+                            and smtp is not None:
+                        await smtp.close()
+                        smtp = None
+                else:
+                    exception = None
+                    sender.timings.add('smtp', loop.time() - start, self.server)
+                    self.throttle.record(loop.time() - start)
+                if start is not None and smtp is not None:
+                    smtp.messages += 1
+                    smtp.used = time.monotonic()
+
+                await self.engine.execute(sender.update_batch_status,
+                                          contacts, refused, exception)
+                if self.throttle.report_due():
+                    await self.engine.execute(self.throttle.report)
+                await self.done(sender)
+
+                if SLEEP_BETWEEN_SENDING:
+                    await asyncio.sleep(SLEEP_BETWEEN_SENDING)
+                if smtp is not None and expired(self.server, smtp.messages, smtp.opened):
+                    await smtp.quit()
+                    smtp = None
+        finally:
+            if smtp is not None:
+                await smtp.quit()
+
+    async def pace(self, count=1):
+        """Wait for the next sending slot of the server and the credits
+        of count mails"""
+        wait = self.throttle.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+        while self.server.rate() and \
+                not await self.engine.execute(self.server.consume_credits, count):
+            # the credits were taken by the other senders of the server
+            await asyncio.sleep(self.throttle.delay())
+
+    async def next_job(self):
+        """Return the next (sender, contacts) to send in round robin
+        over the newsletters, the due retries first, within the caps
+        of the domains, refreshing them when there is no work. The
+        newsletters with identical content are sent to batches of
+        contacts, one contact otherwise"""
+        while not self.engine.stopped:
+            waits = []
+            for newsletter_id, (sender, contacts) in list(self.pending.items()):
+                self.pending.move_to_end(newsletter_id)
+                contact = sender.retries.pop()
+                batch = contact is not None and [contact] or []
+                if not batch and contacts:
+                    batch = contacts.take(self.domains, sender.identical_message and
+                                          BATCH_RECIPIENTS or 1)
+                    if not batch:
+                        waits.append(contacts.timeout(self.domains))
+                if batch:
+                    self.inflight[newsletter_id] += 1
+                    return sender, batch
+
+            found = False
+            async with self.refresh_lock:
+                if not any(contacts for sender, contacts in self.pending.values()):
+                    found = await self.fill() or await self.refresh()
+            if found:
+                continue
+            waits.extend(sender.retries.timeout() for sender, contacts
+                         in self.pending.values() if sender.retries)
+            if waits:
+                await self.engine.wait(min(waits + [IDLE_SLEEP]))
+            elif not any(self.inflight.values()) and \
+                    not any(contacts for sender, contacts in self.pending.values()):
+                if self.engine.stop_when_idle:
+                    return None
+                await self.engine.wait(IDLE_SLEEP)
+        return None
+
+    async def fill(self):
+        """Read the next contacts of the newsletters being sent"""
+        found = False
+        for sender, contacts in list(self.pending.values()):
+            if contacts.exhausted:
+                continue
+            contacts.add(await self.engine.execute(contacts.read))
+            found = found or bool(contacts)
+            if not contacts:
+                await self.done(sender)
+        return found
+
+    async def refresh(self):
+        """Load the newsletters ready to be sent"""
+        loop = asyncio.get_running_loop()
+        newsletters = await self.engine.execute(
+            lambda: list(self.server.newsletters().filter(
+                status__in=[Newsletter.WAITING, Newsletter.SENDING],
+                sending_date__lte=timezone.now())))
+
+        found = False
+        for newsletter in newsletters:
+            if newsletter.id in self.pending or \
+                   loop.time() - self.drained.get(newsletter.id, -IDLE_SLEEP) < IDLE_SLEEP:
+                continue
+            sender = NewsLetterSender(newsletter, test=self.engine.test,
+                                      verbose=self.engine.verbose, journal=self.journal,
+                                      domains=self.domains)
+            sender.timings.server = self.server
+            if not sender.can_send:
+                continue
+
+            def load():
+                sender.attachments = sender.encode_attachments(sender.build_attachments())
+                if sender.identical_message:
+                    sender.batch_message = sender.serialize_identical_message()
+                return sender.expedition_list.count(), contacts.read()
+
+            contacts = ExpeditionBuffer(sender)
+            number_of_recipients, chunk = await self.engine.execute(load)
+            contacts.add(chunk)
+            if self.engine.verbose:
+                print('%s smtp-%s (%s), nl-%s (%s): %i emails will be sent' % (
+                    datetime.now().strftime('%Y-%m-%d'), self.server.id,
+                    self.server.name[:10], newsletter.id, newsletter.title[:10],
+                    number_of_recipients))
+            self.pending[newsletter.id] = (sender, contacts)
+            self.inflight[newsletter.id] = 0
+            found = found or bool(contacts)
+            if not contacts:
+                await self.done(sender)
+        return found
+
+    async def done(self, sender):
+        """Account a processed mail, update the newsletter when drained"""
+        newsletter_id = sender.newsletter.id
+        if self.inflight[newsletter_id]:
+            self.inflight[newsletter_id] -= 1
+        contacts = self.pending[newsletter_id][1]
+        if not self.inflight[newsletter_id] and not contacts and \
+               contacts.exhausted and not sender.retries:
+            del self.pending[newsletter_id]
+            del self.inflight[newsletter_id]
+            self.drained[newsletter_id] = asyncio.get_running_loop().time()
+            await self.engine.execute(sender.update_newsletter_status)
+            sender.send_timings()
+
+
+class AsyncMailer(object):
+    """Send the newsletters of all the SMTP servers on one event loop.
+
+    Alternative to the SMTPMailer threads, the SMTP sessions are coroutines
+    so many connections can be opened without as many threads, while
+    rendering and database work go to a thread pool executor."""
+
+    def __init__(self, servers, test=False, verbose=0,
+                 workers=ASYNC_EXECUTOR_WORKERS, stop_when_idle=False):
+        self.servers = list(servers)
+        self.test = test
+        self.verbose = verbose
+        self.workers = workers
+        self.stop_when_idle = stop_when_idle
+        self.stopped = False
+        self.executor = None
+        self.stop_event = None
+        self.change_event = None
+        self.listener = Listener()
+
+    async def run(self):
+        self.stop_event = asyncio.Event()
+        self.change_event = asyncio.Event()
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='aoml')
+        await self.execute(self.listener.open)
+        watcher = asyncio.ensure_future(self.watch())
+        try:
+            await asyncio.gather(*[AsyncSMTPMailer(server, self).run()
+                                   for server in self.servers])
+        finally:
+            self.stopped = True
+            self.listener.interrupt()
+            await watcher
+            self.listener.close()
+            self.executor.shutdown()
+
+    async def watch(self):
+        """Wake up the idle senders when a newsletter changes, the
+        listener waits in a thread of its own out of the executor"""
+        while not self.stopped:
+            if await asyncio.to_thread(self.listener.wait):
+                self.change_event.set()
+                self.change_event = asyncio.Event()
+
+    def stop(self):
+        """Stop after the mails being sent, to be called from the loop"""
+        self.stopped = True
+        self.stop_event.set()
+        self.listener.interrupt()
+
+    async def wait(self, timeout):
+        """Sleep until timeout, stop or a newsletter changes"""
+        waits = [asyncio.ensure_future(self.stop_event.wait()),
+                 asyncio.ensure_future(self.change_event.wait())]
+        await asyncio.wait(waits, timeout=timeout,
+                           return_when=asyncio.FIRST_COMPLETED)
+        for future in waits:
+            future.cancel()
+
+    async def execute(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args)
@@ -0,0 +1,158 @@
+"""Dispatch of the mails by domain of the recipients"""
+import time
+import threading
+from itertools import islice
+from collections import deque
+from collections import Counter
+from collections import OrderedDict
+
+from .settings import DOMAIN_RATES
+from .settings import DOMAIN_CONCURRENCY
+from .settings import EXPEDITION_CHUNK_SIZE
+
+# seconds to wait for a domain at its concurrency
+CONCURRENCY_POLL = 0.1
+
+
+def domain_of(email):
+    return email.rpartition('@')[2].lower()
+
+
+def interleave(contacts, window=EXPEDITION_CHUNK_SIZE):
+    """Spread evenly the contacts of each domain in windows of contacts,
+    so the contacts of a large domain are not sent in a row. The order of
+    the contacts of a domain is kept"""
+    contacts = iter(contacts)
+    while True:
+        chunk = list(islice(contacts, window))
+        if not chunk:
+            return
+        domains = [domain_of(contact.email) for contact in chunk]
+        counts = Counter(domains)
+        seen = Counter()
+        keys = []
+        for position, domain in enumerate(domains):
+            keys.append(((seen[domain] + 0.5) / counts[domain], position))
+            seen[domain] += 1
+        for key, position in sorted(keys):
+            yield chunk[position]
+
+
+def batches(contacts, size):
+    """Group in lists of at most size the contacts of a dispatch without
+    wait. A list is cut short when the dispatch waits for a domain, so
+    its contacts holding the slots are sent meanwhile, and the delay is
+    yielded after it as a float"""
+    batch = []
+    for contact in contacts:
+        if isinstance(contact, float):
+            if batch:
+                yield batch
+                batch = []
+            yield contact
+            continue
+        batch.append(contact)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class DomainGate(object):
+    """Caps of the mails sent to some domains, on top of the limits of
+    the SMTP server: at most NEWSLETTER_DOMAIN_RATES[domain] mails per
+    hour and NEWSLETTER_DOMAIN_CONCURRENCY[domain] mails being sent at
+    once to a domain.
+
+    A slot of concurrency is held by a contact until it is released with
+    its status, so a sender taking several contacts before sending them,
+    by batches or to render them, dispatches without wait and groups the
+    contacts with batches().
+
+    Thread safe, shared by the newsletters of a mailer."""
+
+    def __init__(self, rates=None, concurrency=None):
+        self.rates = DOMAIN_RATES if rates is None else rates
+        self.concurrency = DOMAIN_CONCURRENCY if concurrency is None else concurrency
+        self.next_slot = {}
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def limited(self, domain):
+        return domain in self.rates or domain in self.concurrency
+
+    def acquire(self, contact):
+        """Take a slot of the domain of a contact, return False if
+        the domain is at its cap"""
+        domain = domain_of(contact.email)
+        if not self.limited(domain):
+            return True
+        with self.lock:
+            now = time.monotonic()
+            if self.next_slot.get(domain, 0) > now:
+                return False
+            inflight = self.inflight.setdefault(domain, set())
+            if len(inflight) >= self.concurrency.get(domain, float('inf')):
+                return False
+            if domain in self.rates:
+                self.next_slot[domain] = now + 3600.0 / self.rates[domain]
+            if domain in self.concurrency:
+                inflight.add(contact.pk)
+            return True
+
+    def release(self, contact):
+        """The mail of a contact was sent or failed"""
+        domain = domain_of(contact.email)
+        if domain in self.concurrency:
+            with self.lock:
+                self.inflight.get(domain, set()).discard(contact.pk)
+
+    def timeout(self, domain):
+        """Seconds until a slot of a domain may be free"""
+        with self.lock:
+            timeout = self.next_slot.get(domain, 0) - time.monotonic()
+            if len(self.inflight.get(domain, ())) >= self.concurrency.get(domain, float('inf')):
+                timeout = max(timeout, CONCURRENCY_POLL)
+            return max(timeout, 0)
+
+    def dispatch(self, contacts, wait=True):
+        """Iterate over the contacts within the caps of their domains.
+        The contacts of a capped domain are put aside until it is free,
+        at most EXPEDITION_CHUNK_SIZE of them. When all the contacts left
+        are aside the next free domain is waited for, or without wait the
+        delay until then is yielded as a float, as are the floats of
+        contacts"""
+        contacts = iter(contacts)
+        aside = OrderedDict()
+        size = 0
+        exhausted = False
+        while True:
+            for domain in list(aside):
+                queue = aside[domain]
+                while queue and self.acquire(queue[0]):
+                    size -= 1
+                    yield queue.popleft()
+                if not queue:
+                    del aside[domain]
+
+            if not exhausted and size < EXPEDITION_CHUNK_SIZE:
+                contact = next(contacts, None)
+                if contact is None:
+                    exhausted = True
+                elif isinstance(contact, float):
+                    yield min([contact] + [self.timeout(domain) for domain in aside])
+                elif domain_of(contact.email) in aside or not self.acquire(contact):
+                    aside.setdefault(domain_of(contact.email), deque()).append(contact)
+                    size += 1
+                else:
+                    yield contact
+                continue
+
+            if not aside:
+                return
+            timeout = min(self.timeout(domain) for domain in aside)
+            if wait:
+                time.sleep(timeout)
+            else:
+                yield float(timeout)
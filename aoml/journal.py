@@ -0,0 +1,227 @@
+"""Write-behind journal for the ContactMailingStatus of the sending"""
+import os
+import sys
+import json
+import time
+import hashlib
+import threading
+from uuid import UUID
+from uuid import uuid4
+from glob import glob
+from collections import Counter
+from collections import defaultdict
+from tempfile import mkstemp
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from django.db import connection
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Count
+
+from .models import ContactMailingStatus
+from .models import Contact
+from .models import Newsletter
+from .outbox import lock_newsletter
+from .settings import STATUS_BATCH_SIZE
+from .settings import STATUS_BATCH_DELAY
+from .settings import STATUS_JOURNAL_DIR
+from .settings import STATUS_JOURNAL_FSYNC
+
+# records of a journal looked for at once in the statuses
+REPLAY_CHUNK_SIZE = 500
+
+
+class StatusJournal(object):
+    """Buffer the delivery statuses and insert them by batches.
+
+    Each status is first appended to a journal file owned (locked) by
+    the process, then buffered and inserted with bulk_create when the
+    buffer reaches STATUS_BATCH_SIZE or is older than STATUS_BATCH_DELAY
+    seconds. The journal is emptied after each insert, and the journals
+    left by crashed processes are replayed when a new journal is opened,
+    so a status is never lost once the mail has been handed to the SMTP.
+    The journals are named after the database, so the directory can be
+    shared by several projects or databases.
+
+    Thread safe, a journal can be shared by several senders."""
+
+    def __init__(self, directory=STATUS_JOURNAL_DIR,
+                 batch_size=STATUS_BATCH_SIZE, delay=STATUS_BATCH_DELAY):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.delay = delay
+        self.lock = threading.RLock()
+        self.buffer = []
+        self.last_flush = time.time()
+        self.path = None
+        self.fd = None
+
+    def add(self, newsletter, contact, status):
+        """Record the status of a contact for a newsletter"""
+        with self.lock:
+            record = None
+            if self.directory:
+                record = uuid4()
+                self.write({'id': record.hex,
+                            'newsletter': newsletter.pk,
+                            'contact': contact.pk,
+                            'status': status})
+            self.buffer.append(ContactMailingStatus(
+                newsletter_id=newsletter.pk, contact_id=contact.pk,
+                status=status, journal_record=record))
+            if len(self.buffer) >= self.batch_size or \
+                   time.time() - self.last_flush >= self.delay:
+                self.flush()
+
+    def flush(self):
+        """Insert the buffered statuses and empty the journal"""
+        with self.lock:
+            if self.buffer:
+                insert_statuses(self.buffer)
+                self.buffer = []
+            if self.fd is not None:
+                self.fd.seek(0)
+                self.fd.truncate()
+            self.last_flush = time.time()
+
+    def close(self):
+        """Flush the statuses and remove the journal"""
+        with self.lock:
+            self.flush()
+            if self.fd is not None:
+                self.fd.close()
+                os.remove(self.path)
+                self.fd = self.path = None
+
+    def write(self, record):
+        if self.fd is None:
+            self.open()
+        self.fd.write(json.dumps(record) + '\n')
+        self.fd.flush()
+        if STATUS_JOURNAL_FSYNC:
+            os.fsync(self.fd.fileno())
+
+    def open(self):
+        """Replay the orphan journals and create our own"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        replay_journals(self.directory)
+
+        fd, self.path = mkstemp(prefix='status-%s-' % database_key(),
+                                suffix='.journal', dir=self.directory)
+        self.fd = os.fdopen(fd, 'w')
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def insert_statuses(statuses):
+    """Insert statuses and increment the counters of their newsletters
+    in the same transaction"""
+    counts = Counter((status.newsletter_id, ContactMailingStatus.COUNTERS[status.status])
+                     for status in statuses
+                     if status.status in ContactMailingStatus.COUNTERS)
+    increments = defaultdict(dict)
+    for (newsletter_id, counter), count in counts.items():
+        increments[newsletter_id][counter] = F(counter) + count
+
+    with transaction.atomic():
+        ContactMailingStatus.objects.bulk_create(statuses)
+        # always in the same order, not to deadlock with other processes
+        for newsletter_id in sorted(increments):
+            Newsletter.objects.filter(pk=newsletter_id).update(**increments[newsletter_id])
+
+
+def recount_newsletter(newsletter):
+    """Recompute the counters of a newsletter from its statuses, and its
+    number of recipients if it was not counted when the sending started"""
+    with transaction.atomic():
+        # the statuses inserted meanwhile wait for the lock to be counted
+        lock_newsletter(newsletter)
+        counts = dict(newsletter.contactmailingstatus_set.filter(
+            status__in=ContactMailingStatus.COUNTERS).order_by().values_list(
+                'status').annotate(Count('pk')))
+        values = {counter: counts.get(status, 0)
+                  for status, counter in ContactMailingStatus.COUNTERS.items()}
+        if not newsletter.recipients_count and \
+               newsletter.status not in (Newsletter.DRAFT, Newsletter.WAITING):
+            values['recipients_count'] = newsletter.mailing_list.expedition_set().count()
+        Newsletter.objects.filter(pk=newsletter.pk).update(**values)
+    for name, value in values.items():
+        setattr(newsletter, name, value)
+    return values
+
+
+def database_key():
+    """Key of the database the statuses are written to"""
+    settings_dict = connection.settings_dict
+    return hashlib.sha1(repr([settings_dict.get(name) for name in (
+        'ENGINE', 'HOST', 'PORT', 'NAME')]).encode('utf-8')).hexdigest()[:12]
+
+
+def existing(queryset, field, values):
+    """Values of a field found in a queryset, by chunks"""
+    values = list(values)
+    found = set()
+    for i in range(0, len(values), REPLAY_CHUNK_SIZE):
+        found.update(queryset.filter(**{field + '__in': values[i:i + REPLAY_CHUNK_SIZE]}
+                                     ).values_list(field, flat=True))
+    return found
+
+
+def replay_journals(directory):
+    """Insert the statuses of the journals of the database whose process
+    is gone.
+
+    A record is skipped if its status already exists, found by the id of
+    the record, because the process may have crashed between the insert
+    and the journal truncation, or if its newsletter or its contact was
+    deleted since. Return the number of replayed statuses."""
+    if fcntl is None:
+        return 0
+
+    replayed = 0
+    for path in glob(os.path.join(directory, 'status-%s-*.journal' % database_key())):
+        # empty journals may be just created and not yet locked
+        if not os.path.getsize(path):
+            continue
+        with open(path) as fd:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue
+
+            statuses = []
+            for line in fd:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # interrupted while writing the last line
+                    continue
+                statuses.append(ContactMailingStatus(
+                    newsletter_id=record['newsletter'],
+                    contact_id=record['contact'],
+                    status=record['status'],
+                    journal_record=UUID(record['id'])))
+            inserted = existing(ContactMailingStatus.objects, 'journal_record',
+                                [status.journal_record for status in statuses])
+            newsletters = existing(Newsletter.objects, 'pk',
+                                   set(status.newsletter_id for status in statuses))
+            contacts = existing(Contact.objects, 'pk',
+                                set(status.contact_id for status in statuses))
+            orphans = [status for status in statuses
+                       if status.newsletter_id not in newsletters or
+                       status.contact_id not in contacts]
+            if orphans:
+                print('%s: %i statuses of deleted newsletters or contacts skipped' % (
+                    path, len(orphans)), file=sys.stderr)
+            statuses = [status for status in statuses
+                        if status.journal_record not in inserted and
+                        status not in orphans]
+            insert_statuses(statuses)
+            replayed += len(statuses)
+            os.remove(path)
+    return replayed
@@ -1,13 +1,21 @@
 """Mailer for """
 import re
 import sys
+import string
 import time
+import mmap
+import tempfile
 import threading
 import mimetypes
+from uuid import uuid4
 from random import sample
+from random import choice
 from io import StringIO
+from itertools import islice
+from collections import deque
 from datetime import datetime
 from datetime import timedelta
+from smtplib import SMTPException
 from smtplib import SMTPRecipientsRefused
 
 
@@ -19,6 +27,7 @@ from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
 
 from email import message_from_file
+from email.policy import compat32
 from html2text import html2text as html2text_orig
 #from django.contrib.sites.models import Site
 from django.template import Context, Template
@@ -27,11 +36,37 @@ from django.utils.encoding import smart_str
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from django.urls import reverse
+from django.db import connection as db_connection
+from django.db.models import F
+from django.db.models import Case
+from django.db.models import When
+from django.db.models import Value
+from django.db.models import Exists
+from django.db.models import OuterRef
 
 from .models import Newsletter
 from .models import ContactMailingStatus
+from .journal import StatusJournal
+from . import outbox
+from . import pipelining
+from .pipeline import RenderPipeline
+from .scheduler import NewsletterScheduler
+from .wakeup import Listener
+from .retry import RetryQueue
+from .retry import is_transient
+from .retry import is_disconnected
+from .throttle import Throttle
+from .domains import DomainGate
+from .domains import interleave
+from .domains import batches
+from .session import SMTPSession
+from .pool import ServerPool
+from .spool import Spool
+from .timings import Timings
+from .timings import timings_recorded
 from .utils.tokens import tokenize
 from .utils.newsletter import track_links
+from .utils.newsletter import is_contact_independent
 from .settings import TRACKING_LINKS
 from .settings import TRACKING_IMAGE
 from .settings import TRACKING_IMAGE_FORMAT
@@ -40,13 +75,30 @@ from .settings import UNIQUE_KEY_CHAR_SET
 from .settings import INCLUDE_UNSUBSCRIPTION
 from .settings import SLEEP_BETWEEN_SENDING
 from .settings import DOMAIN
-from .settings import RESTART_CONNECTION_BETWEEN_SENDING
+from .settings import RENDER_PROCESSES
+from .settings import ATTACHMENTS_MMAP
+from .settings import EXPEDITION_CHUNK_SIZE
+from .settings import BATCH_RECIPIENTS
+from .settings import DOMAIN_INTERLEAVE
+from .settings import USE_OUTBOX
+from .settings import OUTBOX_BATCH_SIZE
+from .settings import OUTBOX_LEASE
 
 
 # this is needed to so the newletter is sent in 7bit plain text instead of base64 blob
 # better for debugging
 from email import charset
 charset.add_charset('utf-8', charset.SHORTEST, charset.QP)
+UTF8 = charset.Charset('UTF-8')
+
+# values of a message depending on the contact, in the order of make_message
+MESSAGE_VALUES = ('subject', 'to', 'unsubscribe', 'text', 'html')
+MESSAGE_HEADERS = {'subject': 'Subject',
+                   'to': 'To',
+                   'unsubscribe': 'List-Unsubscribe'}
+# the headers are not folded by Message.as_string
+MESSAGE_POLICY = compat32.clone(max_line_length=0)
+NEWLINE_RE = re.compile(r'\r\n|\r|\n')
 
 
 if not hasattr(timedelta, 'total_seconds'):
@@ -58,6 +110,15 @@ else:
     total_seconds = lambda td: td.total_seconds()
 
 
+BASE36_CHARS = string.digits + string.ascii_lowercase
+HEX_CHARS = string.hexdigits[:16]
+
+# seconds to wait before looking again for newsletters to send
+IDLE_SLEEP = 600
+
+# To header of the messages sent to batches of recipients
+UNDISCLOSED_RECIPIENTS = 'undisclosed-recipients:;'
+
 LINK_RE = re.compile(r"https?://([^ \n]+\n)+[^ \n]+", re.MULTILINE)
 
 
@@ -77,54 +138,228 @@ def html2text(html):
     return out.getvalue()
 
 
+def encode_message_value(name, value):
+    """Encode a value of the message like the email generator,
+    a header line or the payload of a text part"""
+    if name in MESSAGE_HEADERS:
+        return MESSAGE_POLICY.fold(MESSAGE_HEADERS[name], value)
+    return NEWLINE_RE.sub('\n', UTF8.body_encode(smart_str(value)))
+
+
+class ExpeditionCursor(object):
+    """Id of the last contact of the expedition list up to which all the
+    contacts read were processed. The contacts are read ahead by the
+    interleaving by domain and the render pipeline, and processed out of
+    order by the connections, so the cursor follows the first contact
+    read and not yet processed.
+
+    Thread safe, shared by the connections of a sender."""
+
+    def __init__(self, position=0):
+        self.position = position
+        self.read = deque()
+        self.done = set()
+        self.lock = threading.Lock()
+
+    def add(self, contacts):
+        """Record the contacts read, by increasing id"""
+        with self.lock:
+            self.read.extend(contact.id for contact in contacts)
+
+    def processed(self, contact):
+        """Record the contact processed, advance the position over the
+        contacts processed in a row"""
+        with self.lock:
+            if not self.read or contact.id < self.read[0]:
+                return
+            self.done.add(contact.id)
+            while self.read and self.read[0] in self.done:
+                self.position = self.read.popleft()
+                self.done.discard(self.position)
+
+
 class NewsLetterSender(object):
 
-    def __init__(self, newsletter, test=False, verbose=0):
+    def __init__(self, newsletter, test=False, verbose=0, journal=None,
+                 domains=None):
         self.test = test
         self.verbose = verbose
         self.newsletter = newsletter
+        self.journal = journal or StatusJournal()
+        self.domains = domains or DomainGate()
         self.newsletter_template = Template(self.newsletter.content)
         self.title_template = Template(self.newsletter.title)
+        self.links = {}
+        self.compiled_content = None
+        self.compiled_texts = {}
+        self.compile_lock = threading.Lock()
+        # contacts claimed in the outbox and processed
+        self.leases = []
+        self.delivered = []
+        self.outbox_lock = threading.Lock()
+        # contacts failed for a transient reason, sent again later
+        self.retries = RetryQueue()
+        # contacts of the expedition list processed, for resuming
+        self.expedition_cursor = None
+        # durations of the stages of the mails
+        self.timings = Timings()
+        # placeholders for the contact's tokens when the content is
+        # rendered once and completed for each contact
+        self.content_is_static = is_contact_independent(self.newsletter.content)
+        # the same message for all the contacts, sent to batches of recipients
+        self.identical_message = (self.newsletter.identical_content and
+                                  self.content_is_static and
+                                  is_contact_independent(self.newsletter.title) and
+                                  'UNIQUE_KEY' not in self.newsletter.title)
+        self.placeholder_uidb36 = uuid4().hex
+        self.placeholder_token = uuid4().hex
+        # same boundary for all the messages, to insert the attachments
+        self.set_boundaries('===============%s==' % uuid4().hex,
+                            '===============%s==' % uuid4().hex)
+        self.attachments = b''
+        self.message_segments = None
+        # messages rendered ahead by the prerender_newsletter command
+        self.spool = None
+        self.spool_opened = test
+
+    def set_boundaries(self, boundary, alternative_boundary):
+        """Set the boundaries of the messages, before rendering them"""
+        self.boundary = boundary
+        self.alternative_boundary = alternative_boundary
+        self.closing_delimiter = '\n--%s--\n' % self.boundary
 
     def build_message(self, contact):
         """
         Build the email as a multipart message containing
-        a multipart alternative for text (plain, HTML) plus
-        all the attached files.
+        a multipart alternative for text (plain, HTML),
+        the attached files are added by serialize_message.
         """
         content_html = self.build_email_content(contact)
-        content_text = html2text(content_html)
+        content_text = self.build_text_content(contact, content_html)
+
+        return self.make_message(self.build_title_content(contact),
+                                 contact.mail_format(),
+                                 '<%s>' % self.build_unsubscribe_link(contact),
+                                 content_text, content_html)
 
-        message = MIMEMultipart()
+    def make_message(self, subject, to, unsubscribe, content_text, content_html):
+        """Build the email from the values depending on the contact"""
+        message = MIMEMultipart(boundary=self.boundary)
 
-        message['Subject'] = self.build_title_content(contact)
+        message['Subject'] = subject
         message['From'] = smart_str(self.newsletter.header_sender)
         message['Reply-to'] = smart_str(self.newsletter.header_reply)
-        message['To'] = contact.mail_format()
-        
-        uidb36, token = tokenize(contact)
-        unsubscribe_link = reverse("newsletter_mailinglist_oneclick_unsubscribe", 
-                                   kwargs={"slug": self.newsletter.slug,
-                                           "uidb36":uidb36,
-                                           "token":token})
-        unsubscribe_link = "https://" + DOMAIN + unsubscribe_link
-        
-        message['List-Unsubscribe'] = "<{}>".format(unsubscribe_link)
-        message['List-Unsubscribe-Post'] = "List-Unsubscribe=One-Click"
+        message['To'] = to
+        if unsubscribe:
+            message['List-Unsubscribe'] = unsubscribe
+            message['List-Unsubscribe-Post'] = "List-Unsubscribe=One-Click"
 
-        message_alt = MIMEMultipart('alternative')
+        message_alt = MIMEMultipart('alternative', boundary=self.alternative_boundary)
         message_alt.attach(MIMEText(smart_str(content_text), 'plain', 'UTF-8'))
         message_alt.attach(MIMEText(smart_str(content_html), 'html', 'UTF-8'))
         message.attach(message_alt)
 
-        for attachment in self.attachments:
-            message.attach(attachment)
-
         for header, value in list(self.newsletter.server.custom_headers.items()):
             message[header] = value
 
         return message
 
+    def build_unsubscribe_link(self, contact):
+        uidb36, token = tokenize(contact)
+        unsubscribe_link = reverse("newsletter_mailinglist_oneclick_unsubscribe", 
+                                   kwargs={"slug": self.newsletter.slug,
+                                           "uidb36":uidb36,
+                                           "token":token})
+        return "https://" + DOMAIN + unsubscribe_link
+
+    def render_messages(self, contacts):
+        """Build the messages of an iterable of numbered contacts, yielding
+        (number, contact, message) where message is the serialized message
+        or the exception raised while building it"""
+        for i, contact in contacts:
+            try:
+                message = self.serialize_message(contact)
+            except Exception as e:
+                message = e
+            yield i, contact, message
+
+    def compile_message(self):
+        """Flatten once a message with markers instead of the values
+        depending on the contact, return its segments: the bytes common
+        to all the messages alternating with the names of the values"""
+        markers = dict((name, uuid4().hex) for name in MESSAGE_VALUES)
+        message = self.make_message(*[markers[name] for name in MESSAGE_VALUES])
+        message = message.as_string()[:-len(self.closing_delimiter)]
+
+        positions = []
+        for name, marker in markers.items():
+            encoded = encode_message_value(name, marker)
+            start = message.index(encoded)
+            positions.append((start, start + len(encoded), name))
+
+        segments = []
+        position = 0
+        for start, end, name in sorted(positions):
+            segments.append(message[position:start].encode('ascii'))
+            segments.append(name)
+            position = end
+        segments.append(message[position:].encode('ascii'))
+        return segments
+
+    def serialize_message(self, contact):
+        """Return the message of a contact ready to be sent, read from the
+        spool of the newsletter if it was rendered ahead, else rendered by
+        serialize_content, the attachments being inserted before the
+        closing delimiter"""
+        spool = self.open_spool()
+        if spool is not None:
+            with self.timings.measure('serialize'):
+                message = spool.get(contact)
+            if message is not None:
+                return message
+        return b''.join([self.serialize_content(contact), self.attachments,
+                         self.closing_delimiter.encode('ascii')])
+
+    def open_spool(self):
+        """Return the spool of the newsletter, None if it is missing or stale"""
+        with self.compile_lock:
+            if not self.spool_opened:
+                self.spool = Spool.open(self.newsletter)
+                self.spool_opened = True
+        return self.spool
+
+    def serialize_content(self, contact):
+        """Return the message of a contact without the attachments and the
+        closing delimiter, made of the segments compiled once for the
+        newsletter and of the values of the contact encoded like the
+        email package would do"""
+        with self.compile_lock:
+            if self.message_segments is None:
+                self.message_segments = self.compile_message()
+
+        content_html = self.build_email_content(contact)
+        values = {'subject': self.build_title_content(contact),
+                  'to': contact.mail_format(),
+                  'unsubscribe': '<%s>' % self.build_unsubscribe_link(contact),
+                  'text': self.build_text_content(contact, content_html),
+                  'html': content_html}
+
+        with self.timings.measure('serialize'):
+            return b''.join([segment if isinstance(segment, bytes) else
+                             encode_message_value(segment, values[segment]).encode('ascii')
+                             for segment in self.message_segments])
+
+    def serialize_identical_message(self):
+        """Return the message sent to all the contacts of a newsletter
+        with identical content, without the personal links nor tracking"""
+        content_html = self.render_email_content(None, None, None)
+        message = self.make_message(self.build_title_content(None),
+                                    UNDISCLOSED_RECIPIENTS, None,
+                                    html2text(content_html), content_html)
+        message = message.as_string()[:-len(self.closing_delimiter)]
+        return b''.join([message.encode('ascii'), self.attachments,
+                         self.closing_delimiter.encode('ascii')])
+
     def build_attachments(self):
         """Build email's attachment messages"""
         attachments = []
@@ -157,17 +392,93 @@ class NewsLetterSender(object):
 
         return attachments
 
+    def encode_attachments(self, attachments):
+        """Serialize the attachment messages once for all the contacts,
+        each one preceded by the delimiter of the newsletter's messages.
+        The result is memory-mapped from a temporary file with
+        NEWSLETTER_ATTACHMENTS_MMAP."""
+        encoded = ''.join('\n--%s\n%s' % (self.boundary, attachment.as_string())
+                          for attachment in attachments).encode('ascii')
+        if not ATTACHMENTS_MMAP or not encoded:
+            return encoded
+
+        with tempfile.TemporaryFile() as spool:
+            spool.write(encoded)
+            spool.flush()
+            return mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+
     def build_title_content(self, contact):
         """Generate the email title for a contact"""
         context = Context({'contact': contact,
                            'UNIQUE_KEY': ''.join(sample(UNIQUE_KEY_CHAR_SET,
                                                         UNIQUE_KEY_LENGTH))})
-        title = self.title_template.render(context)
+        with self.timings.measure('title'):
+            title = self.title_template.render(context)
         return title
 
     def build_email_content(self, contact):
         """Generate the mail for a contact"""
         uidb36, token = tokenize(contact)
+        if not self.content_is_static:
+            return self.render_email_content(contact, uidb36, token)
+
+        with self.compile_lock:
+            if self.compiled_content is None:
+                self.compiled_content = self.render_email_content(
+                    None, self.placeholder_uidb36, self.placeholder_token)
+        # tokens are always rendered together in the urls
+        return self.compiled_content.replace(
+            '%s-%s' % (self.placeholder_uidb36, self.placeholder_token),
+            '%s-%s' % (uidb36, token))
+
+    def build_text_content(self, contact, content_html):
+        """Generate the plain text alternative of the mail for a contact.
+        The text of a static content is converted once by length of the
+        tokens, as html2text wraps the lines, and completed for each
+        contact like the HTML content"""
+        with self.timings.measure('html2text'):
+            return self.convert_text_content(contact, content_html)
+
+    def convert_text_content(self, contact, content_html):
+        uidb36, token = tokenize(contact)
+        key = self.content_is_static and (len(uidb36), len(token))
+        with self.compile_lock:
+            if key not in self.compiled_texts:
+                content_text = html2text(content_html)
+                self.compiled_texts[key] = self.compile_text_content(
+                    key, content_text, uidb36, token)
+                return content_text
+
+        tokens, text = self.compiled_texts[key]
+        if text is None:
+            return html2text(content_html)
+        return text.replace(tokens, '%s-%s' % (uidb36, token))
+
+    def compile_text_content(self, key, content_text, uidb36, token):
+        """Convert the compiled content with random tokens of the length of
+        the contact's ones, return the tokens and the text or (None, None)
+        if the text must be converted for each contact. content_text is the
+        text of the contact, to check that only the tokens differ"""
+        compiled = (None, None)
+        if key:
+            tokens = '%s-%s' % (''.join(choice(BASE36_CHARS) for c in uidb36),
+                                ''.join(choice(HEX_CHARS) for c in token))
+            text = html2text(self.compiled_content.replace(
+                '%s-%s' % (self.placeholder_uidb36, self.placeholder_token), tokens))
+            if text.replace(tokens, '%s-%s' % (uidb36, token)) == content_text:
+                compiled = (tokens, text)
+
+        if self.verbose:
+            print('nl-%s (%s): text alternative %s' % (
+                self.newsletter.id, self.newsletter.title[:10],
+                compiled[1] is None and 'converted for each contact' or
+                'converted once for the uids of %i characters' % len(uidb36)))
+        return compiled
+
+    def render_email_content(self, contact, uidb36, token):
+        """Render the newsletter's template for a contact's tokens,
+        without the links needing the tokens if they are None"""
+        start = time.perf_counter()
         context = {'contact': contact,
 #                           'domain': Site.objects.get_current().domain,
                           'domain': DOMAIN,
@@ -175,19 +486,21 @@ class NewsLetterSender(object):
                            'tracking_image_format': TRACKING_IMAGE_FORMAT,
                            'uidb36': uidb36, 'token': token}
 
-        link_site = render_to_string('newsletter/newsletter_link_site.html', context)
-        context['viewonsite'] = mark_safe(link_site)
+        if uidb36:
+            link_site = render_to_string('newsletter/newsletter_link_site.html', context)
+            context['viewonsite'] = mark_safe(link_site)
 
-        if INCLUDE_UNSUBSCRIPTION:
-            context['unsubscribe'] = render_to_string('newsletter/newsletter_link_unsubscribe.html', context)
-        if TRACKING_IMAGE:
-            context['imagetracking'] = render_to_string('newsletter/newsletter_image_tracking.html', context)
+            if INCLUDE_UNSUBSCRIPTION:
+                context['unsubscribe'] = render_to_string('newsletter/newsletter_link_unsubscribe.html', context)
+            if TRACKING_IMAGE:
+                context['imagetracking'] = render_to_string('newsletter/newsletter_image_tracking.html', context)
 
         content = self.newsletter_template.render(Context(context))
-        
-        
+        self.timings.add('render', time.perf_counter() - start)
+
         if TRACKING_LINKS:
-            content = track_links(content, context)
+            with self.timings.measure('tracking'):
+                content = track_links(content, context, self.links)
         
         return smart_str(content)
 
@@ -196,13 +509,40 @@ class NewsLetterSender(object):
         if self.test:
             return
 
+        if self.leases:
+            leases, self.leases = self.leases, []
+            self.release_outbox(leases)
+        self.journal.flush()
+        self.save_cursor()
+        self.snapshot_recipients()
         if self.newsletter.status == Newsletter.WAITING:
             self.newsletter.status = Newsletter.SENDING
-        if self.newsletter.status == Newsletter.SENDING and \
-               self.newsletter.mails_sent() >= \
-               self.newsletter.mailing_list.expedition_set().count():
-            self.newsletter.status = Newsletter.SENT
-        self.newsletter.save()
+        status = self.newsletter.status
+        if status == Newsletter.SENDING and not self.build_expedition_list().exists():
+            # the recipients left since the start unsubscribed or were removed
+            status = Newsletter.SENT
+        elif status == Newsletter.SENDING:
+            # sent once the counter reaches the recipients of the start
+            status = Case(When(sent_count__gte=F('recipients_count'),
+                               then=Value(Newsletter.SENT)),
+                          default=Value(Newsletter.SENDING))
+        # only the status, without overwriting the one set by another
+        # sender of the newsletter which completed it
+        Newsletter.objects.filter(
+            pk=self.newsletter.pk,
+            status__in=[Newsletter.WAITING, Newsletter.SENDING]).update(
+                status=status, modification_date=timezone.now())
+        self.newsletter.refresh_from_db(
+            fields=['status'] + list(ContactMailingStatus.COUNTERS.values()))
+
+    def snapshot_recipients(self):
+        """Count the recipients of the newsletter when its sending starts"""
+        if self.test or self.newsletter.recipients_count:
+            return
+        recipients = self.newsletter.mailing_list.expedition_set().count()
+        Newsletter.objects.filter(pk=self.newsletter.pk, recipients_count=0).update(
+            recipients_count=recipients)
+        self.newsletter.refresh_from_db(fields=['recipients_count'])
 
     @property
     def can_send(self):
@@ -220,15 +560,130 @@ class NewsLetterSender(object):
     @property
     def expedition_list(self):
         """Build the expedition list"""
+        return self.build_expedition_list()
+
+    def build_expedition_list(self):
+        """Build the expedition list, ordered by id"""
         if self.test:
-            return self.newsletter.test_contacts.all()
+            return self.newsletter.test_contacts.order_by('id')
 
         already_sent = ContactMailingStatus.objects.filter(status=ContactMailingStatus.SENT,
-                                                           newsletter=self.newsletter).values_list('contact__id', flat=True)
-        expedition_list = self.newsletter.mailing_list.expedition_set().exclude(id__in=already_sent)
+                                                           newsletter=self.newsletter,
+                                                           contact=OuterRef('pk'))
+        expedition_list = self.newsletter.mailing_list.expedition_set().exclude(
+            Exists(already_sent)).order_by('id')
         return expedition_list
 
+    def iter_expedition_list(self):
+        """Iterate over the expedition list by chunks of contacts, from the
+        cursor of the newsletter which is saved at each chunk so a sending
+        can be resumed. The cursor is the last contact up to which all
+        were processed, see ExpeditionCursor. Once all the contacts were
+        taken the next iteration starts again from the first one, for the
+        failed ones.
+
+        With NEWSLETTER_USE_OUTBOX the contacts are claimed in the outbox."""
+        self.snapshot_recipients()
+        if USE_OUTBOX and not self.test:
+            yield from self.iter_outbox()
+            return
+
+        expedition_list = self.build_expedition_list()
+        cursor = 0 if self.test else self.newsletter.cursor
+        if cursor and not expedition_list.filter(id__gt=cursor).exists():
+            cursor = 0
+
+        if not self.test:
+            self.expedition_cursor = ExpeditionCursor(cursor)
+        while True:
+            self.save_cursor()
+            contacts = list(expedition_list.filter(id__gt=cursor)[:EXPEDITION_CHUNK_SIZE])
+            if self.expedition_cursor is not None:
+                self.expedition_cursor.add(contacts)
+            for contact in contacts:
+                yield contact
+            if len(contacts) < EXPEDITION_CHUNK_SIZE:
+                return
+            cursor = contacts[-1].id
+
+    def save_cursor(self):
+        """Save the position of the expedition cursor on the newsletter"""
+        if self.expedition_cursor is None:
+            return
+        cursor = self.expedition_cursor.position
+        if cursor != self.newsletter.cursor:
+            self.newsletter.cursor = cursor
+            Newsletter.objects.filter(pk=self.newsletter.pk).update(cursor=cursor)
+
+    def iter_outbox(self):
+        """Iterate over the contacts claimed by batches in the outbox of
+        the newsletter, which is filled with the expedition list when
+        empty. The lease of a batch is extended while it is consumed, the
+        contacts processed are removed from the outbox before claiming
+        the next batch and the ones of the leases not processed are freed
+        by update_newsletter_status."""
+        outbox.fill(self.newsletter, self.build_expedition_list())
+        while True:
+            self.release_outbox()
+            lease, contacts = outbox.claim(self.newsletter, OUTBOX_BATCH_SIZE)
+            if not contacts:
+                return
+            self.leases.append(lease)
+            renewal = time.time() + OUTBOX_LEASE / 2
+            for contact in contacts:
+                if time.time() > renewal:
+                    outbox.renew(lease)
+                    renewal = time.time() + OUTBOX_LEASE / 2
+                yield contact
+
+    def release_outbox(self, leases=()):
+        """Remove the contacts processed from the outbox, once their
+        statuses are saved so they are not put again in the outbox"""
+        with self.outbox_lock:
+            delivered, self.delivered = self.delivered, []
+        if delivered or leases:
+            self.journal.flush()
+            outbox.release(self.newsletter, delivered, leases)
+
+    def iter_contacts(self, wait=True):
+        """Iterate over the contacts to send: the expedition list
+        interleaved by domain and the retries, within the caps of
+        the domains"""
+        contacts = self.iter_expedition_list()
+        if DOMAIN_INTERLEAVE:
+            contacts = interleave(contacts)
+        return self.domains.dispatch(self.iter_with_retries(contacts, wait), wait)
+
+    def iter_with_retries(self, contacts, wait=True):
+        """Iterate over the contacts and over the contacts to retry when
+        they are due. Once the contacts are exhausted the retries left
+        are waited for, or without wait the delay until the next one is
+        yielded as a float"""
+        for contact in contacts:
+            yield from self.retries.due()
+            yield contact
+        while True:
+            yield from self.retries.due()
+            timeout = self.retries.timeout()
+            if timeout is None:
+                return
+            if wait:
+                time.sleep(timeout)
+            else:
+                yield float(timeout)
+
     def update_contact_status(self, contact, exception):
+        self.domains.release(contact)
+        if exception is not None and is_transient(exception) and \
+               self.retries.add(contact):
+            # no status until the retry
+            if self.verbose:
+                print('%s will be retried: %s' % (contact.email, exception))
+            return
+        self.retries.forget(contact)
+        if self.expedition_cursor is not None:
+            self.expedition_cursor.processed(contact)
+
         if exception is None:
             status = (self.test
                       and ContactMailingStatus.SENT_TEST
@@ -242,77 +697,295 @@ class NewsLetterSender(object):
             print('smtp connection raises %s' % exception, file=sys.stderr)
             status = ContactMailingStatus.ERROR
 
-        ContactMailingStatus.objects.create(
-            newsletter=self.newsletter, contact=contact, status=status)
+        with self.timings.measure('status'):
+            self.journal.add(self.newsletter, contact, status)
+        if self.leases:
+            with self.outbox_lock:
+                self.delivered.append(contact.id)
+
+    def send_timings(self):
+        """Send the timings of the mails processed with timings_recorded"""
+        if self.timings:
+            timings_recorded.send(sender=self.__class__, newsletter=self.newsletter,
+                                  timings=self.timings)
+
+    def update_batch_status(self, contacts, refused, exception):
+        """Record the statuses of a batch of contacts sent in one
+        transaction, from the refused recipients or the exception"""
+        for contact in contacts:
+            if exception is None and contact.email in refused:
+                self.update_contact_status(contact, SMTPRecipientsRefused(
+                    {contact.email: refused[contact.email]}))
+            else:
+                self.update_contact_status(contact, exception)
 
 
 class Mailer(NewsLetterSender):
     """Mailer for generating and sending newsletters
-    In test mode the mailer always send mails but do not log it"""
+    In test mode the mailer always send mails but do not log it.
+
+    The mails are shared by the servers of the pool of the newsletter."""
     smtp = None
+    _pool = None
 
     def run(self):
         """Send the mails"""
         if not self.can_send:
             return
 
-        if not self.smtp:
-            self.smtp_connect()
-
-        self.attachments = self.build_attachments()
+        self.attachments = self.encode_attachments(self.build_attachments())
+        self.timings.server = self.newsletter.server
 
-        expedition_list = self.expedition_list
-
-        number_of_recipients = len(expedition_list)
+        number_of_recipients = self.expedition_list.count()
         if self.verbose:
             print('%i emails will be sent' % number_of_recipients)
 
-        i = 1
-        for contact in expedition_list:
+        # the sessions of each server are capped by the pool
+        connections = min(max(member.server.max_connections
+                              for member in self.pool.members),
+                          number_of_recipients)
+        rendered_ahead = RENDER_PROCESSES and number_of_recipients and \
+            not self.identical_message
+        if self.identical_message or rendered_ahead:
+            # the batches and the pipeline take several contacts before
+            # sending them, they wait for the domains themselves
+            expedition_list = self.iter_contacts(wait=False)
+        else:
+            expedition_list = self.iter_contacts()
+        pipeline = None
+        if rendered_ahead:
+            pipeline = RenderPipeline(self, expedition_list, RENDER_PROCESSES)
+            pipeline.start()
+        try:
+            if self.identical_message:
+                sessions = self.sessions()
+                self.send_batches(sessions, expedition_list, number_of_recipients)
+                self.quit_sessions(sessions)
+            elif self.smtp or connections <= 1:
+                sessions = self.sessions()
+                if pipeline:
+                    messages = pipeline.messages()
+                else:
+                    messages = self.render_messages(enumerate(expedition_list, 1))
+                self.send_mails(sessions, messages, number_of_recipients)
+                self.quit_sessions(sessions)
+            else:
+                self.send_mails_parallel(expedition_list, number_of_recipients,
+                                         connections, pipeline)
+        finally:
+            if pipeline:
+                pipeline.stop()
+            self.journal.close()
+
+        self.update_newsletter_status()
+        self.send_timings()
+
+    def send_mails(self, sessions, messages, number_of_recipients):
+        """Send an iterable of (number, contact, message)
+        over the sessions of the servers of the pool"""
+        for i, contact, message in messages:
             if self.verbose:
                 print('- Processing %s/%s (%s)' % (
                     i, number_of_recipients, contact.pk))
 
+            member = session = start = None
             try:
-                message = self.build_message(contact)
-                self.smtp.sendmail(smart_str(self.newsletter.header_sender),
-                                   contact.email,
-                                   message.as_string())
+                if isinstance(message, Exception):
+                    raise message
+                member, session = self.open_session(sessions)
+                if member is None:
+                    # the credits were taken by the other senders of the servers
+                    break
+                smtp = session.get()
+                self.pace(member)
+                start = time.monotonic()
+                pipelining.sendmail(smtp, smart_str(self.newsletter.header_sender),
+                                    contact.email, message)
             except Exception as e:
-                raise e #todo : remove (test)
                 exception = e
             else:
                 exception = None
 
+            if start is not None:
+                self.record_reply(member, start, exception)
+                session.sent()
             self.update_contact_status(contact, exception)
+            if session is not None and exception is not None and \
+                   is_disconnected(exception):
+                session.close()
 
             if SLEEP_BETWEEN_SENDING:
                 time.sleep(SLEEP_BETWEEN_SENDING)
-            if RESTART_CONNECTION_BETWEEN_SENDING:
-                self.smtp.quit()
-                self.smtp_connect()
 
-            i += 1
+    def send_batches(self, sessions, contacts, number_of_recipients):
+        """Send the identical message to batches of contacts, one SMTP
+        transaction by batch, over the sessions of the servers of the pool.
+        The contacts are dispatched without wait, a batch being cut short
+        when the domains are waited for"""
+        message = self.serialize_identical_message()
+        i = 0
+        for batch in batches(contacts, BATCH_RECIPIENTS):
+            if isinstance(batch, float):
+                time.sleep(batch)
+                continue
+            try:
+                member, session = self.open_session(sessions, len(batch))
+            except Exception as e:
+                # no server of the pool can be connected to
+                self.update_batch_status(batch, {}, e)
+                continue
+            if member is None:
+                # the credits were taken by the other senders of the servers
+                for contact in batch:
+                    self.domains.release(contact)
+                break
+            i += len(batch)
+            if self.verbose:
+                print('- Processing %s/%s (%i recipients)' % (
+                    i, number_of_recipients, len(batch)))
+
+            smtp = session.get()
+            self.pace(member)
+            start = time.monotonic()
+            try:
+                refused = pipelining.sendmail(
+                    smtp, smart_str(self.newsletter.header_sender),
+                    [contact.email for contact in batch], message)
+            except Exception as e:
+                refused, exception = {}, e
+            else:
+                exception = None
+            self.record_reply(member, start, exception)
+            session.sent()
 
-        self.smtp.quit()
-        self.update_newsletter_status()
+            self.update_batch_status(batch, refused, exception)
+            if exception is not None and is_disconnected(exception):
+                session.close()
+
+            if SLEEP_BETWEEN_SENDING:
+                time.sleep(SLEEP_BETWEEN_SENDING)
+
+    def send_mails_parallel(self, expedition_list, number_of_recipients,
+                            connections, pipeline=None):
+        """Send the mails with a pool of connections, each one
+        driven by a thread taking the contacts from the shared
+        expedition list, or the messages rendered by the pipeline"""
+        contacts = enumerate(expedition_list, 1)
+        contacts_lock = threading.Lock()
+        errors = []
+
+        def next_contacts():
+            while not errors:
+                with contacts_lock:
+                    contact = next(contacts, None)
+                if contact is None:
+                    return
+                yield contact
+
+        def worker():
+            try:
+                sessions = self.sessions()
+                if pipeline:
+                    messages = pipeline.messages()
+                else:
+                    messages = self.render_messages(next_contacts())
+                self.send_mails(sessions, messages, number_of_recipients)
+                self.quit_sessions(sessions)
+            except Exception as e:
+                errors.append(e)
+                if pipeline:
+                    pipeline.stop()
+            finally:
+                db_connection.close()
+
+        workers = [threading.Thread(target=worker, name='%s-%i' % (
+                       self.newsletter.slug, i)) for i in range(connections)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        if errors:
+            raise errors[0]
 
     def smtp_connect(self):
         """Make a connection to the SMTP"""
         self.smtp = self.newsletter.server.connect()
 
+    @property
+    def pool(self):
+        """Servers sending the newsletter"""
+        if self._pool is None:
+            self._pool = ServerPool.for_newsletter(self.newsletter)
+        return self._pool
+
+    def sessions(self):
+        """Sessions of a connection by server of the pool,
+        the one of the server of the newsletter using smtp"""
+        sessions = {}
+        if self.smtp:
+            sessions[self.newsletter.server.pk] = SMTPSession(
+                self.newsletter.server, self.smtp)
+            self.pool.connect(self.newsletter.server.pk)
+        return sessions
+
+    def quit_sessions(self, sessions):
+        for session in sessions.values():
+            session.quit()
+        self.pool.disconnect(sessions)
+
+    def open_session(self, sessions, count=1):
+        """Take count credits of a server of the pool, return its member
+        and its session connected, or None without credits. A server
+        which can not be connected to is left aside and its credits taken
+        on another one, the error is raised when no server is left"""
+        while True:
+            member = self.pool.choose(count, sessions)
+            if member is None:
+                return None, None
+            session = sessions.get(member.server.pk)
+            if session is None:
+                session = sessions[member.server.pk] = SMTPSession(member.server)
+            try:
+                session.get()
+                return member, session
+            except (SMTPException, OSError) as e:
+                session.close()
+                self.pool.fail(member)
+                print('%s left aside: %s' % (member.server, e), file=sys.stderr)
+                if not self.pool.healthy():
+                    raise
+
+    def pace(self, member):
+        """Wait for the sending slot of the adaptive rate of a server,
+        the static rate being only enforced by the credits"""
+        if member.throttle.adaptive:
+            time.sleep(member.throttle.reserve())
+
+    def record_reply(self, member, start, exception):
+        """Adapt the rate of a server to the reply to a mail sent at start"""
+        self.timings.add('smtp', time.monotonic() - start, member.server)
+        member.throttle.record(time.monotonic() - start, exception)
+        if member.throttle.report_due():
+            member.throttle.report()
+
     @property
     def expedition_list(self):
         """Build the expedition list"""
-        credits = self.newsletter.server.credits()
+        credits = self.pool.credits()
         if credits <= 0:
-            return []
+            return super(Mailer, self).expedition_list.none()
         return super(Mailer, self).expedition_list[:credits]
 
+    def iter_expedition_list(self):
+        """Iterate over the expedition list within the credits"""
+        credits = max(self.pool.credits(), 0)
+        return islice(super(Mailer, self).iter_expedition_list(), credits)
+
     @property
     def can_send(self):
         """Check if the newsletter can be sent"""
-        if self.newsletter.server.credits() <= 0:
+        if self.pool.credits() <= 0:
             return False
         return super(Mailer, self).can_send
 
@@ -321,101 +994,162 @@ class SMTPMailer(object):
     """for generating and sending newsletters
 
     SMTPMailer takes the problem on a different basis than Mailer, it use
-    a SMTP server and make a roundrobin over all newsletters to be sent
-    dispatching it's send command to smtp server regularly over time to
-    reach the limit.
+    a SMTP server and share it between all newsletters to be sent with
+    a NewsletterScheduler, dispatching it's send command to smtp server
+    regularly over time to reach the limit.
 
     It is more robust in term of predictability.
 
-    In test mode the mailer always send mails but do not log it"""
+    In test mode the mailer always send mails but do not log it.
+    With max_messages, the mailer stops after sending as many mails"""
 
     smtp = None
 
-    def __init__(self, server, test=False, verbose=0):
-        self.start = datetime.now()
+    def __init__(self, server, test=False, verbose=0, max_messages=0):
         self.server = server
         self.test = test
         self.verbose = verbose
+        self.max_messages = max_messages
+        self.messages = 0
         self.stop_event = threading.Event()
+        self.journal = StatusJournal()
+        self.listener = Listener(server.id)
+        self.throttle = Throttle(server)
+        self.domains = DomainGate()
+
+    def stop(self):
+        """Stop after the mail being sent, to be called from any thread"""
+        self.stop_event.set()
+        self.listener.interrupt()
 
     def run(self):
         """send mails
         """
         sending = dict()
-        candidates = self.get_candidates()
-        roundrobin = []
-
-        if not self.smtp:
-            self.smtp_connect()
+        timings = dict()
+        scheduler = NewsletterScheduler(self.server)
+        self.listener.open()
+        self.session = SMTPSession(self.server, self.smtp)
+        self.session.get()
 
-        delay = self.server.delay()
-
-        i = 1
         sleep_time = 0
         while (not self.stop_event.wait(sleep_time) and
                not self.stop_event.is_set()):
-            if not roundrobin:
-                # refresh the list
-                for expedition in candidates:
-                    if expedition.id not in sending and expedition.can_send:
-                        sending[expedition.id] = expedition()
-
-                roundrobin = list(sending.keys())
-
-            if roundrobin:
-                nl_id = roundrobin.pop()
-                nl = sending[nl_id]
-
+            for nl_id in scheduler.poll():
+                # canceled or sent by another sender
+                if nl_id in sending:
+                    sending.pop(nl_id).close()
+
+            newsletter = scheduler.next()
+
+            if newsletter and newsletter.id not in sending:
+                expedition = NewsLetterExpedition(newsletter, self)
+                if not expedition.can_send:
+                    scheduler.done(newsletter.id)
+                    sleep_time = 0
+                    continue
+                sending[newsletter.id] = expedition()
+                timings[newsletter.id] = expedition.timings
+
+            if newsletter:
+                nl = sending[newsletter.id]
                 try:
-                    self.smtp.sendmail(*next(nl))
+                    message = next(nl)
                 except StopIteration:
-                    del sending[nl_id]
+                    del sending[newsletter.id]
+                    del timings[newsletter.id]
+                    scheduler.done(newsletter.id)
+                    sleep_time = 0
+                    continue
+                if isinstance(message, float):
+                    # the contacts left wait for their retry or domain
+                    scheduler.defer(newsletter.id, message)
+                    sleep_time = 0
+                    continue
+                if not self.wait_slot():
+                    # stopped, the contact is sent by the next run
+                    sending.pop(newsletter.id).close()
+                    continue
+
+                smtp = self.session.get()
+                start = time.monotonic()
+                try:
+                    refused = pipelining.sendmail(smtp, *message)
                 except Exception as e:
+                    timings[newsletter.id].add('smtp', time.monotonic() - start, self.server)
+                    self.throttle.record(time.monotonic() - start, e)
+                    self.session.sent()
                     nl.throw(e)
+                    self.messages += 1
+                    if is_disconnected(e):
+                        self.session.close()
                 else:
-                    next(nl)
-
-                sleep_time = (delay * i -
-                              total_seconds(datetime.now() - self.start))
-                if SLEEP_BETWEEN_SENDING:
-                    sleep_time = max(time.sleep(SLEEP_BETWEEN_SENDING), sleep_time)
-                if RESTART_CONNECTION_BETWEEN_SENDING:
-                    self.smtp.quit()
-                    self.smtp_connect()
-                i += 1
+                    timings[newsletter.id].add('smtp', time.monotonic() - start, self.server)
+                    self.throttle.record(time.monotonic() - start)
+                    self.session.sent()
+                    nl.send(refused)
+                    self.messages += 1
+                if self.throttle.report_due():
+                    self.throttle.report()
+
+                if self.max_messages and self.messages >= self.max_messages:
+                    self.stop_event.set()
+
+                sleep_time = SLEEP_BETWEEN_SENDING
             else:
-                # no work, sleep a bit and some reset
-                sleep_time = 600
-                i = 1
-                self.start = datetime.now()
+                # no work, sleep until the next newsletter is due, the
+                # next refresh, a newsletter changes or the keepalive
+                self.journal.flush()
+                timeout = scheduler.timeout()
+                idle_timeout = self.session.idle_timeout()
+                if idle_timeout is not None:
+                    timeout = min(timeout, idle_timeout)
+                if self.listener.wait(timeout):
+                    scheduler.next_refresh = 0
+                self.session.keepalive()
+                sleep_time = 0
 
             if sleep_time < 0:
                 sleep_time = 0
 
-        self.smtp.quit()
-
-    def get_candidates(self):
-        """get candidates NL"""
-        return [NewsLetterExpedition(nl, self)
-                for nl in Newsletter.objects.filter(server=self.server)]
+        for nl in sending.values():
+            nl.close()
+        self.listener.close()
+        self.journal.close()
+        self.session.quit()
 
     def smtp_connect(self):
         """Make a connection to the SMTP"""
         self.smtp = self.server.connect()
 
+    def wait_slot(self):
+        """Wait for the sending slot and the credit of a mail,
+        return False if stopped"""
+        if self.stop_event.wait(self.throttle.reserve()):
+            return False
+        while not self.server.consume_credits():
+            # the credits were taken by the other senders of the server
+            if self.stop_event.wait(self.throttle.delay()):
+                return False
+        return True
+
 
 class NewsLetterExpedition(NewsLetterSender):
     """coroutine that will give messages to be sent with mailer
 
     between to message it alternate with None so that
-    the mailer give it a chance to save status to db
+    the mailer give it a chance to save status to db,
+    and when only contacts to retry or of capped domains
+    are left it gives the seconds to wait as a float
     """
 
     def __init__(self, newsletter, mailer):
         super(NewsLetterExpedition, self).__init__(
-                        newsletter, test=mailer.test, verbose=mailer.verbose)
+                        newsletter, test=mailer.test, verbose=mailer.verbose,
+                        journal=mailer.journal, domains=mailer.domains)
         self.mailer = mailer
         self.id = newsletter.id
+        self.timings.server = mailer.server
 
     def __call__(self):
         """iterator on messages to be sent
@@ -428,28 +1162,34 @@ class NewsLetterExpedition(NewsLetterSender):
         # ajust len
         title = '%-30s' % title
 
-        self.attachments = self.build_attachments()
-
-        expedition_list = self.expedition_list
+        self.attachments = self.encode_attachments(self.build_attachments())
 
-        number_of_recipients = len(expedition_list)
+        number_of_recipients = self.expedition_list.count()
         if self.verbose:
             print('%s %s: %i emails will be sent' % (
                     datetime.now().strftime('%Y-%m-%d'),
                     title, number_of_recipients))
 
         try:
+            if self.identical_message:
+                yield from self.expedite_batches(title, number_of_recipients)
+                return
+
             i = 1
-            for contact in expedition_list:
+            for contact in self.iter_contacts(wait=False):
+                if isinstance(contact, float):
+                    # delay until the next retry or free domain, for the mailer
+                    yield contact
+                    continue
                 if self.verbose:
                     print('%s %s: processing %s/%s (%s)' % (
                         datetime.now().strftime('%H:%M:%S'),
                         title, i, number_of_recipients, contact.pk))
                 try:
-                    message = self.build_message(contact)
+                    message = self.serialize_message(contact)
                     yield (smart_str(self.newsletter.header_sender),
                                        contact.email,
-                                       message.as_string())
+                                       message)
                 except Exception as e:
                     exception = e
                 else:
@@ -457,8 +1197,54 @@ class NewsLetterExpedition(NewsLetterSender):
 
                 self.update_contact_status(contact, exception)
                 i += 1
-                # this one permits us to save to database imediately
-                # and acknoledge eventual exceptions
+                # this one acknowledges the sending or the exception
+                # thrown by the mailer, the status goes to the journal
                 yield None
         finally:
             self.update_newsletter_status()
+            self.send_timings()
+
+    def expedite_batches(self, title, number_of_recipients):
+        """Iterator on the identical message sent to batches of contacts,
+        receiving the refused recipients. The mailer consumed the credit
+        of one mail, the credits of the other contacts of a batch are
+        consumed here, or they wait for the next batch"""
+        message = self.serialize_identical_message()
+        contacts = self.iter_contacts(wait=False)
+        waiting = deque()
+        i = 0
+        while True:
+            batch = [waiting.popleft() for j in range(min(len(waiting), BATCH_RECIPIENTS))]
+            timeout = None
+            for contact in islice(contacts, BATCH_RECIPIENTS - len(batch)):
+                if isinstance(contact, float):
+                    timeout = contact
+                    break
+                batch.append(contact)
+            if not batch:
+                if timeout is None:
+                    return
+                # delay until the next retry or free domain, for the mailer
+                yield timeout
+                continue
+            if len(batch) > 1 and \
+                   not self.mailer.server.consume_credits(len(batch) - 1):
+                waiting.extendleft(reversed(batch[1:]))
+                batch = batch[:1]
+
+            i += len(batch)
+            if self.verbose:
+                print('%s %s: processing %s/%s (%i recipients)' % (
+                    datetime.now().strftime('%H:%M:%S'),
+                    title, i, number_of_recipients, len(batch)))
+            try:
+                refused = yield (smart_str(self.newsletter.header_sender),
+                                 [contact.email for contact in batch],
+                                 message)
+            except Exception as e:
+                refused, exception = {}, e
+            else:
+                exception = None
+
+            self.update_batch_status(batch, refused or {}, exception)
+            yield None
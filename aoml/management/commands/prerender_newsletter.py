@@ -0,0 +1,41 @@
+"""Command for rendering the newsletters ahead of their sending"""
+from django.conf import settings
+from django.utils.translation import activate
+from django.core.management.base import BaseCommand
+
+from ... import spool
+from ...mailer import NewsLetterSender
+from ...models import Newsletter
+
+
+class Command(BaseCommand):
+
+    """Render the messages of the newsletters waiting in their spools"""
+    help = 'Render the messages of the newsletters waiting in their spools'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*',
+                            help='slugs of the newsletters, all the waiting ones by default')
+
+    def handle(self, **options):
+        verbose = int(options['verbosity'])
+
+        activate(settings.LANGUAGE_CODE)
+
+        active = Newsletter.objects.filter(status__in=[Newsletter.WAITING,
+                                                       Newsletter.SENDING])
+        # the spools of the newsletters sent, cancelled or deleted
+        for newsletter_id in set(spool.spooled()) - set(active.values_list('pk', flat=True)):
+            spool.remove(newsletter_id)
+
+        newsletters = active.filter(status=Newsletter.WAITING)
+        if options['slugs']:
+            newsletters = active.filter(slug__in=options['slugs'])
+
+        for newsletter in newsletters:
+            if NewsLetterSender(newsletter).identical_message:
+                # rendered once when sent
+                continue
+            rendered = spool.prerender(newsletter, verbose)
+            if verbose:
+                print('%s: %i messages rendered' % (newsletter.slug, rendered))
@@ -0,0 +1,28 @@
+"""Command for repairing the counters of the newsletters"""
+from django.core.management.base import BaseCommand
+
+from ...journal import recount_newsletter
+from ...models import Newsletter
+
+
+class Command(BaseCommand):
+
+    """Recompute the counters of the newsletters from their statuses"""
+    help = 'Recompute the counters of the newsletters from their statuses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('slugs', nargs='*',
+                            help='slugs of the newsletters, all by default')
+
+    def handle(self, **options):
+        verbose = int(options['verbosity'])
+
+        newsletters = Newsletter.objects.all()
+        if options['slugs']:
+            newsletters = newsletters.filter(slug__in=options['slugs'])
+
+        for newsletter in newsletters.iterator():
+            values = recount_newsletter(newsletter)
+            if verbose:
+                print('%s: %s' % (newsletter.slug, ', '.join(
+                    '%s %i' % (name, value) for name, value in sorted(values.items()))))
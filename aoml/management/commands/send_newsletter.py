@@ -6,6 +6,8 @@ from optparse import make_option
 
 from ...mailer import Mailer
 from ...models import Newsletter
+from ...timings import merge
+from ...timings import summary
 
 
 class Command(BaseCommand):
@@ -15,6 +17,9 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('--test', help='test only', action='store_true', dest='delete')
+        parser.add_argument('--timings', action='store_true',
+                            help='print the timings of the stages of the mails '
+                                 'by newsletter and by server')
 
     def handle(self, **options):
         verbose = int(options['verbosity'])
@@ -25,6 +30,7 @@ class Command(BaseCommand):
         activate(settings.LANGUAGE_CODE)
 
         is_test = options.get('test', False)
+        servers = {}
 
         for newsletter in Newsletter.objects.exclude(
                 status=Newsletter.DRAFT).exclude(status=Newsletter.SENT):
@@ -34,6 +40,15 @@ class Command(BaseCommand):
                     print('Start emailing %s' % str(
                         newsletter.title).encode('utf-8'))
                 mailer.run()
+                if options['timings'] and mailer.timings:
+                    print('Timings of %s' % newsletter.slug)
+                    print('\n'.join(summary(mailer.timings.stages)))
+                    for server, stages in mailer.timings.servers.items():
+                        merge(servers.setdefault(server, {}), stages)
+
+        for server, stages in servers.items():
+            print('Timings of %s' % server)
+            print('\n'.join(summary(stages)))
 
         if verbose:
             print('End session sending')
@@ -1,5 +1,6 @@
 """Command for sending the newsletter"""
 from threading import Thread
+import asyncio
 import signal
 import sys
 
@@ -7,15 +8,29 @@ from django.conf import settings
 from django.utils.translation import activate
 from django.core import signals
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 
 from ...mailer import SMTPMailer
+from ...asyncmailer import AsyncMailer
 from ...models import SMTPServer
+from ...settings import USE_OUTBOX
+from ...supervisor import Supervisor
 
 
 class Command(BaseCommand):
     """Send the newsletter in queue"""
     help = 'Send the newsletter in queue'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                            help='one thread per SMTP server, or all the SMTP sessions '
+                            'on one asyncio event loop')
+        parser.add_argument('--processes', type=int, default=0,
+                            help='run the SMTP servers in this number of worker processes '
+                            'each, restarted when they crash, instead of threads')
+        parser.add_argument('--max-messages', type=int, default=0,
+                            help='replace a worker process after sending this number of mails')
+
     def handle(self, **options):
         verbose = int(options['verbosity'])
 
@@ -24,6 +39,12 @@ class Command(BaseCommand):
 
         activate(settings.LANGUAGE_CODE)
 
+        if options['engine'] == 'asyncio':
+            self.handle_asyncio(verbose)
+
+        if options['processes']:
+            self.handle_processes(verbose, options['processes'], options['max_messages'])
+
         senders = SMTPServer.objects.all()
         workers = []
 
@@ -50,11 +71,37 @@ class Command(BaseCommand):
 
         sys.exit(0)
 
+    def handle_processes(self, verbose, processes, max_messages):
+        """Run the worker processes until sigterm"""
+        if processes > 1 and not USE_OUTBOX:
+            raise CommandError('Several processes by SMTP server '
+                               'require NEWSLETTER_USE_OUTBOX')
+
+        Supervisor(SMTPServer.objects.all(), processes=processes,
+                   max_messages=max_messages, verbose=verbose).run()
+        sys.exit(0)
+
+    def handle_asyncio(self, verbose):
+        """Run the AsyncMailer until sigterm"""
+        mailer = AsyncMailer(SMTPServer.objects.all(), verbose=verbose)
+
+        # first close current connection
+        signals.request_finished.send(sender=self.__class__)
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            for s in [signal.SIGTERM, signal.SIGINT]:
+                loop.add_signal_handler(s, mailer.stop)
+            await mailer.run()
+
+        asyncio.run(run())
+        sys.exit(0)
+
 
 def term_handler(workers):
 
     def handler(signum, frame):
         for worker, thread in workers:
-            worker.stop_event.set()
+            worker.stop()
 
     return handler
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0005_auto_20230506_0040'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smtpserver',
+            name='max_connections',
+            field=models.PositiveIntegerField(default=1, help_text='Number of connections opened in parallel for sending.', verbose_name='max connections'),
+        ),
+    ]
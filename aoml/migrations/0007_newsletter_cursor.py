@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0006_smtpserver_max_connections'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newsletter',
+            name='cursor',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Id of the last contact taken for sending.', verbose_name='cursor'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0007_newsletter_cursor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Delivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lease', models.CharField(blank=True, db_index=True, max_length=32, verbose_name='lease')),
+                ('lease_expiration', models.DateTimeField(blank=True, null=True, verbose_name='lease expiration')),
+                ('contact', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='aoml.contact', verbose_name='contact')),
+                ('newsletter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='aoml.newsletter', verbose_name='newsletter')),
+            ],
+            options={
+                'verbose_name': 'delivery',
+                'verbose_name_plural': 'deliveries',
+                'unique_together': {('newsletter', 'contact')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:22
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0008_delivery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServerCredits',
+            fields=[
+                ('server', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to='aoml.smtpserver', verbose_name='smtp server')),
+                ('level', models.FloatField(default=0.0, verbose_name='level')),
+                ('last_update', models.FloatField(default=0.0, help_text='Timestamp of the last update of the level.', verbose_name='last update')),
+            ],
+            options={
+                'verbose_name': 'server credits',
+                'verbose_name_plural': 'server credits',
+            },
+        ),
+    ]
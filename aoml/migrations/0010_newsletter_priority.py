@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0009_servercredits'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newsletter',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=1, help_text='Share of the sending given to the newsletter against the others sent with the same server.', verbose_name='priority'),
+        ),
+    ]
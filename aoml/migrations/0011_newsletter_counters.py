@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0010_newsletter_priority'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newsletter',
+            name='error_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='mails in error'),
+        ),
+        migrations.AddField(
+            model_name='newsletter',
+            name='invalid_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='invalid mails'),
+        ),
+        migrations.AddField(
+            model_name='newsletter',
+            name='recipients_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='Number of recipients when the sending started.', verbose_name='recipients'),
+        ),
+        migrations.AddField(
+            model_name='newsletter',
+            name='sent_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='mails sent'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0012_newsletter_identical_content'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smtpserver',
+            name='adaptive_rate',
+            field=models.BooleanField(default=False, help_text='Increase the rate while the server answers well, up to the mails per hour, and slow down when it throttles.', verbose_name='adaptive rate'),
+        ),
+        migrations.AddField(
+            model_name='smtpserver',
+            name='effective_rate',
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True, verbose_name='effective mails per hour'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0013_smtpserver_adaptive_rate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smtpserver',
+            name='keepalive',
+            field=models.PositiveIntegerField(default=0, help_text='Send a NOOP after this number of idle seconds, 0 to let the server close the connection.', verbose_name='keepalive'),
+        ),
+        migrations.AddField(
+            model_name='smtpserver',
+            name='session_lifetime',
+            field=models.PositiveIntegerField(default=0, help_text='Reconnect after this number of seconds, 0 for no limit.', verbose_name='connection lifetime'),
+        ),
+        migrations.AddField(
+            model_name='smtpserver',
+            name='session_messages',
+            field=models.PositiveIntegerField(default=0, help_text='Reconnect after sending this number of mails, 0 for no limit.', verbose_name='mails per connection'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0014_smtpserver_session'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PoolServer',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('weight', models.PositiveSmallIntegerField(default=1, help_text='Share of the mails sent by the server against the other servers of the newsletter, with their credits left.', verbose_name='weight')),
+                ('newsletter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pool', to='aoml.newsletter', verbose_name='newsletter')),
+                ('server', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pools', to='aoml.smtpserver', verbose_name='smtp server')),
+            ],
+            options={
+                'verbose_name': 'pool server',
+                'verbose_name_plural': 'pool servers',
+                'unique_together': {('newsletter', 'server')},
+            },
+        ),
+    ]
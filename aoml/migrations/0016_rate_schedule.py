@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0015_poolserver'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='smtpserver',
+            name='rate_schedule',
+            field=models.TextField(blank=True, help_text='Caps of the mails per hour, one by line: "day 0: 500" and "day 21: 50000" for a ramp from the warm-up start, "08:00-20:00: 2000" for hours of the day.', verbose_name='rate schedule'),
+        ),
+        migrations.AddField(
+            model_name='smtpserver',
+            name='warmup_start',
+            field=models.DateField(blank=True, help_text='Day 0 of the ramp of the rate schedule.', null=True, verbose_name='warm-up start'),
+        ),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations
+from django.db.models import Count
+
+# Newsletter.DRAFT, Newsletter.WAITING
+DRAFT, WAITING = 0, 1
+# the counters of ContactMailingStatus.SENT, ERROR and INVALID
+COUNTERS = {0: 'sent_count', 1: 'error_count', 2: 'invalid_count'}
+
+
+def recount_newsletters(apps, schema_editor):
+    """Fill the counters of the newsletters sent before they existed,
+    like journal.recount_newsletter"""
+    Newsletter = apps.get_model('aoml', 'Newsletter')
+    ContactMailingStatus = apps.get_model('aoml', 'ContactMailingStatus')
+
+    for newsletter in Newsletter.objects.exclude(status=DRAFT).select_related('mailing_list'):
+        counts = dict(ContactMailingStatus.objects.filter(
+            newsletter=newsletter, status__in=COUNTERS).order_by().values_list(
+                'status').annotate(Count('pk')))
+        values = {counter: counts.get(status, 0) for status, counter in COUNTERS.items()}
+        if not newsletter.recipients_count and newsletter.status != WAITING:
+            mailing_list = newsletter.mailing_list
+            values['recipients_count'] = mailing_list.subscribers.exclude(
+                pk__in=mailing_list.unsubscribers.values('pk')).count()
+        Newsletter.objects.filter(pk=newsletter.pk).update(**values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0016_rate_schedule'),
+    ]
+
+    operations = [
+        migrations.RunPython(recount_newsletters, migrations.RunPython.noop),
+    ]
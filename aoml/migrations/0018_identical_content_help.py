@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0017_recount_newsletters'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='newsletter',
+            name='identical_content',
+            field=models.BooleanField(default=False, help_text='Send the same message to the contacts by batches of recipients, without the personal links and the tracking, if the title and the content do not depend on the contact. The message has no unsubscription link nor List-Unsubscribe header.', verbose_name='identical content'),
+        ),
+    ]
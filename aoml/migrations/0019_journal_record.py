@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aoml', '0018_identical_content_help'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contactmailingstatus',
+            name='journal_record',
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True, verbose_name='journal record'),
+        ),
+    ]
@@ -1,20 +1,30 @@
 """Models for emencia.django.newsletter"""
+import time
 from datetime import datetime
-from datetime import timedelta
 
 from django.db import models
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Exists
+from django.db.models import Value
+from django.db.models import OuterRef
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_save
+from django.utils import timezone
 from django.utils.encoding import smart_str, force_str
 from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import Group
-from django.utils import timezone
 
+from . import rates
+from . import wakeup
 from .settings import BASE_PATH
 from .settings import MAILER_HARD_LIMIT
 from .settings import DEFAULT_HEADER_REPLY
 from .settings import DEFAULT_HEADER_SENDER
+from .settings import USE_OUTBOX
 
 class SMTPServer(models.Model):
 
@@ -33,9 +43,33 @@ class SMTPServer(models.Model):
                                help_text=_('key1: value1 key2: value2, splitted by return line.\n'
                                            'Useful for passing some tracking headers if your provider allows it.'))
     mails_hour = models.IntegerField(_('mails per hour'), default=0)
-
-    def connect(self):
-        """Connect the SMTP Server"""
+    rate_schedule = models.TextField(_('rate schedule'), blank=True,
+                                     help_text=_('Caps of the mails per hour, one by line: '
+                                                 '"day 0: 500" and "day 21: 50000" for a ramp '
+                                                 'from the warm-up start, "08:00-20:00: 2000" '
+                                                 'for hours of the day.'))
+    warmup_start = models.DateField(_('warm-up start'), null=True, blank=True,
+                                    help_text=_('Day 0 of the ramp of the rate schedule.'))
+    max_connections = models.PositiveIntegerField(_('max connections'), default=1,
+                                                  help_text=_('Number of connections opened in parallel for sending.'))
+    adaptive_rate = models.BooleanField(_('adaptive rate'), default=False,
+                                        help_text=_('Increase the rate while the server answers well, '
+                                                    'up to the mails per hour, and slow down when it '
+                                                    'throttles.'))
+    effective_rate = models.PositiveIntegerField(_('effective mails per hour'), null=True,
+                                                 blank=True, editable=False)
+    session_messages = models.PositiveIntegerField(_('mails per connection'), default=0,
+                                                   help_text=_('Reconnect after sending this number of mails, '
+                                                               '0 for no limit.'))
+    session_lifetime = models.PositiveIntegerField(_('connection lifetime'), default=0,
+                                                   help_text=_('Reconnect after this number of seconds, '
+                                                               '0 for no limit.'))
+    keepalive = models.PositiveIntegerField(_('keepalive'), default=0,
+                                            help_text=_('Send a NOOP after this number of idle seconds, '
+                                                        '0 to let the server close the connection.'))
+
+    def connect(self, tls_context=None):
+        """Connect the SMTP Server, with the TLS context if given"""
 
         from django.core.mail.backends.smtp import EmailBackend
 
@@ -47,6 +81,8 @@ class SMTPServer(models.Model):
             use_tls=self.tls,
             use_ssl=self.ssl,
         )
+        if tls_context is not None:
+            smtp.ssl_context = tls_context
         smtp.open()
 
         return smtp.connection
@@ -57,23 +93,67 @@ class SMTPServer(models.Model):
 
         :rtype: float
         """
-        if not self.mails_hour:
+        rate = self.rate()
+        if not rate:
             return 0.0
         else:
-            return 3600.0 / self.mails_hour
+            return 3600.0 / rate
+
+    def rate(self, when=None):
+        """Mails per hour at a time, by default now, following
+        the rate schedule, 0 for no limit"""
+        return rates.scheduled_rate(self.mails_hour, self.rate_schedule,
+                                    self.warmup_start, when)
+
+    def completion(self, mails, start=None):
+        """Estimate when mails are sent from start under the rate schedule,
+        None without limit"""
+        return rates.completion(self.mails_hour, self.rate_schedule,
+                                self.warmup_start, mails, start)
+
+    def newsletters(self):
+        """Newsletters sent by the server, the ones of its pools only with
+        the outbox, their contacts being claimed by the servers"""
+        if not USE_OUTBOX:
+            return Newsletter.objects.filter(server=self)
+        return Newsletter.objects.filter(
+            models.Q(server=self) | models.Q(pool__server=self)).distinct()
 
     def credits(self):
         """Return how many mails the server can send"""
-        if not self.mails_hour:
+        mails_hour = self.rate()
+        if not mails_hour:
             return MAILER_HARD_LIMIT
 
-        last_hour = timezone.now() - timedelta(hours=1)
-        sent_last_hour = ContactMailingStatus.objects.filter(
-            models.Q(status=ContactMailingStatus.SENT) |
-            models.Q(status=ContactMailingStatus.SENT_TEST),
-            newsletter__server=self,
-            creation_date__gte=last_hour).count()
-        return self.mails_hour - sent_last_hour
+        bucket = ServerCredits.objects.filter(server=self).first()
+        if bucket is None:
+            return mails_hour
+        drained = max(time.time() - bucket.last_update, 0) * mails_hour / 3600.0
+        return int(mails_hour - max(bucket.level - drained, 0))
+
+    def consume_credits(self, count=1):
+        """Take count credits of the server if available, return True if
+        taken. The credits are counted in a leaky bucket of mails_hour
+        mails draining in one hour, updated atomically by one query, so
+        the limit is shared by the threads, processes and hosts sending
+        with the server. The mails per hour follow the rate schedule"""
+        mails_hour = self.rate()
+        if not mails_hour:
+            return True
+
+        now = time.time()
+        rate = mails_hour / 3600.0
+        level = Greatest(F('level') - Greatest(Value(now) - F('last_update'), Value(0.0)) *
+                         Value(rate), Value(0.0))
+        buckets = ServerCredits.objects.filter(server=self).alias(level_now=level).filter(
+            level_now__lte=mails_hour - count)
+        if buckets.update(level=level + Value(float(count)),
+                          last_update=Greatest(F('last_update'), Value(now))):
+            return True
+        if count > mails_hour or ServerCredits.objects.filter(server=self).exists():
+            return False
+        ServerCredits.objects.get_or_create(server=self)
+        return self.consume_credits(count)
 
     @property
     def custom_headers(self):
@@ -94,6 +174,23 @@ class SMTPServer(models.Model):
         verbose_name_plural = _('SMTP servers')
 
 
+class ServerCredits(models.Model):
+
+    """Mails counted for the mails per hour limit of a SMTP server"""
+    server = models.OneToOneField(SMTPServer, verbose_name=_('smtp server'),
+                                  primary_key=True, on_delete=models.CASCADE)
+    level = models.FloatField(_('level'), default=0.0)
+    last_update = models.FloatField(_('last update'), default=0.0,
+                                    help_text=_('Timestamp of the last update of the level.'))
+
+    def __str__(self):
+        return '%s : %.1f' % (self.server.__str__(), self.level)
+
+    class Meta:
+        verbose_name = _('server credits')
+        verbose_name_plural = _('server credits')
+
+
 class Contact(models.Model):
 
     """Contact for emailing"""
@@ -158,8 +255,9 @@ class MailingList(models.Model):
     unsubscribers_count.short_description = _('unsubscribers')
 
     def expedition_set(self):
-        unsubscribers_id = self.unsubscribers.values_list('id', flat=True)
-        return self.subscribers.exclude(id__in=unsubscribers_id)
+        unsubscribed = MailingList.unsubscribers.through.objects.filter(
+            mailinglist=self, contact=OuterRef('pk'))
+        return self.subscribers.exclude(Exists(unsubscribed))
 
     def __str__(self):
         return self.name
@@ -208,7 +306,25 @@ class Newsletter(models.Model):
                                     default=DEFAULT_HEADER_REPLY)
 
     status = models.IntegerField(_('status'), choices=STATUS_CHOICES, default=DRAFT)
+    cursor = models.PositiveIntegerField(_('cursor'), default=0, editable=False,
+                                         help_text=_('Id of the last contact taken for sending.'))
     sending_date = models.DateTimeField(_('sending date'), default=datetime.now)
+    recipients_count = models.PositiveIntegerField(
+        _('recipients'), default=0, editable=False,
+        help_text=_('Number of recipients when the sending started.'))
+    sent_count = models.PositiveIntegerField(_('mails sent'), default=0, editable=False)
+    error_count = models.PositiveIntegerField(_('mails in error'), default=0, editable=False)
+    invalid_count = models.PositiveIntegerField(_('invalid mails'), default=0, editable=False)
+    identical_content = models.BooleanField(
+        _('identical content'), default=False,
+        help_text=_('Send the same message to the contacts by batches of recipients, '
+                    'without the personal links and the tracking, if the title and '
+                    'the content do not depend on the contact. The message has no '
+                    'unsubscription link nor List-Unsubscribe header.'))
+    priority = models.PositiveSmallIntegerField(
+        _('priority'), default=1,
+        help_text=_('Share of the sending given to the newsletter against '
+                    'the others sent with the same server.'))
 
     slug = models.SlugField(help_text=_('Used for displaying the newsletter on the site.'),
                             unique=True)
@@ -218,6 +334,44 @@ class Newsletter(models.Model):
     def mails_sent(self):
         return self.contactmailingstatus_set.filter(status=ContactMailingStatus.SENT).count()
 
+    def recipients(self):
+        """Number of recipients, counted when the sending started"""
+        return self.recipients_count or self.mailing_list.expedition_set().count()
+
+    def pool_servers(self):
+        """Return the (server, weight) sending the newsletter, its
+        server first, of weight 1 unless in the pool"""
+        weights = dict(self.pool.values_list('server_id', 'weight'))
+        servers = [(self.server, weights.pop(self.server_id, 1))]
+        servers.extend((server, weights[server.pk]) for server in
+                       SMTPServer.objects.filter(pk__in=weights).order_by('pk'))
+        return servers
+
+    def remaining(self):
+        """Number of mails left to send"""
+        return max(self.recipients() - self.sent_count, 0)
+
+    def projected_completion(self):
+        """Estimate when the sending ends under the rate schedule of the
+        server, after the newsletters of the server queued before it,
+        None if not to be sent or without limit"""
+        if self.status not in (self.WAITING, self.SENDING):
+            return None
+        queue = Newsletter.objects.filter(
+            server=self.server_id, status__in=[self.WAITING, self.SENDING]).filter(
+            models.Q(sending_date__lt=self.sending_date) |
+            models.Q(sending_date=self.sending_date, pk__lt=self.pk)).order_by(
+            'sending_date', 'pk')
+        when = timezone.now()
+        for newsletter in list(queue) + [self]:
+            when = self.server.completion(
+                newsletter.remaining(),
+                max(when, rates.aware_as(newsletter.sending_date, when)))
+            if when is None:
+                return None
+        return when
+    projected_completion.short_description = _('projected completion')
+
     def get_absolute_url(self):
         return reverse('newsletter_newsletter_preview', args=[self.slug,])
 
@@ -307,6 +461,11 @@ class ContactMailingStatus(models.Model):
                       (UNSUBSCRIPTION, _('unsubscription')),
                       )
 
+    # counters of the newsletter incremented with the statuses of the sending
+    COUNTERS = {SENT: 'sent_count',
+                ERROR: 'error_count',
+                INVALID: 'invalid_count'}
+
     newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'), on_delete=models.CASCADE)
     contact = models.ForeignKey(Contact, verbose_name=_('contact'), on_delete=models.CASCADE)
     status = models.IntegerField(_('status'), choices=STATUS_CHOICES)
@@ -314,6 +473,9 @@ class ContactMailingStatus(models.Model):
                              blank=True, null=True, on_delete=models.SET_NULL)
 
     creation_date = models.DateTimeField(_('creation date'), auto_now_add=True)
+    # id of the record of the status journal it was written from
+    journal_record = models.UUIDField(_('journal record'), null=True, blank=True,
+                                      unique=True, editable=False)
 
     def __str__(self):
         return '%s : %s : %s' % (self.newsletter.__str__(),
@@ -324,3 +486,55 @@ class ContactMailingStatus(models.Model):
         ordering = ('-creation_date',)
         verbose_name = _('contact mailing status')
         verbose_name_plural = _('contact mailing statuses')
+
+
+class Delivery(models.Model):
+
+    """Contact in the outbox of a newsletter, claimed by a sender for a lease"""
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'), on_delete=models.CASCADE)
+    contact = models.ForeignKey(Contact, verbose_name=_('contact'), on_delete=models.CASCADE)
+    lease = models.CharField(_('lease'), max_length=32, blank=True, db_index=True)
+    lease_expiration = models.DateTimeField(_('lease expiration'), blank=True, null=True)
+
+    def __str__(self):
+        return '%s : %s' % (self.newsletter.__str__(),
+                            self.contact.__str__())
+
+    class Meta:
+        unique_together = ('newsletter', 'contact')
+        verbose_name = _('delivery')
+        verbose_name_plural = _('deliveries')
+
+
+class PoolServer(models.Model):
+
+    """Other SMTP server sending a newsletter"""
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'),
+                                   related_name='pool', on_delete=models.CASCADE)
+    server = models.ForeignKey(SMTPServer, verbose_name=_('smtp server'),
+                               related_name='pools', on_delete=models.CASCADE)
+    weight = models.PositiveSmallIntegerField(
+        _('weight'), default=1,
+        help_text=_('Share of the mails sent by the server against the other '
+                    'servers of the newsletter, with their credits left.'))
+
+    def __str__(self):
+        return '%s : %s' % (self.newsletter.__str__(),
+                            self.server.__str__())
+
+    class Meta:
+        unique_together = ('newsletter', 'server')
+        verbose_name = _('pool server')
+        verbose_name_plural = _('pool servers')
+
+
+def notify_newsletter_change(sender, instance, **kwargs):
+    """Wake up the senders of the servers of a newsletter once saved"""
+    def notify():
+        wakeup.notify(instance.server_id)
+        for server_id in instance.pool.values_list('server_id', flat=True):
+            wakeup.notify(server_id)
+    transaction.on_commit(notify)
+
+
+post_save.connect(notify_newsletter_change, sender=Newsletter)
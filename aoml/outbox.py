@@ -0,0 +1,85 @@
+"""Outbox of the newsletters, shared by the senders of several processes"""
+from uuid import uuid4
+from datetime import timedelta
+
+from django.db import connection
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Contact
+from .models import Delivery
+from .models import Newsletter
+from .settings import OUTBOX_LEASE
+
+
+def lock_newsletter(newsletter):
+    """Lock the row of the newsletter until the end of the transaction.
+    Without SELECT FOR UPDATE, like with SQLite, the row is updated to
+    take the write lock before reading"""
+    newsletters = Newsletter.objects.filter(pk=newsletter.pk)
+    if connection.features.has_select_for_update:
+        list(newsletters.select_for_update().values_list('pk', flat=True))
+    else:
+        newsletters.update(status=F('status'))
+
+
+def fill(newsletter, contacts, batch_size=1000):
+    """Put the contacts of a queryset in the outbox of the newsletter
+    if it is empty, return the number of contacts added"""
+    with transaction.atomic():
+        lock_newsletter(newsletter)
+        if Delivery.objects.filter(newsletter=newsletter).exists():
+            return 0
+        count = 0
+        deliveries = []
+        for contact_id in contacts.values_list('id', flat=True).iterator(batch_size):
+            deliveries.append(Delivery(newsletter=newsletter, contact_id=contact_id))
+            if len(deliveries) >= batch_size:
+                count += len(Delivery.objects.bulk_create(deliveries, ignore_conflicts=True))
+                deliveries = []
+        count += len(Delivery.objects.bulk_create(deliveries, ignore_conflicts=True))
+        return count
+
+
+def claim(newsletter, size, duration=OUTBOX_LEASE):
+    """Claim at most size contacts of the outbox of the newsletter not leased
+    or whose lease expired, return the new lease and the contacts.
+
+    The rows are selected with SKIP LOCKED when the database supports it,
+    so the senders do not wait for each other, otherwise the claims of
+    the newsletter are serialized. The rows are only updated if they are
+    still free, so a contact cannot be claimed twice."""
+    lease = uuid4().hex
+    now = timezone.now()
+    free = Delivery.objects.filter(Q(lease='') | Q(lease_expiration__lt=now),
+                                   newsletter=newsletter)
+    with transaction.atomic():
+        candidates = free.order_by('contact')
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        else:
+            lock_newsletter(newsletter)
+        ids = list(candidates.values_list('id', flat=True)[:size])
+        free.filter(id__in=ids).update(lease=lease, lease_expiration=now +
+                                       timedelta(seconds=duration))
+    return lease, list(Contact.objects.filter(delivery__lease=lease).order_by('id'))
+
+
+def renew(lease, duration=OUTBOX_LEASE):
+    """Extend a lease"""
+    Delivery.objects.filter(lease=lease).update(
+        lease_expiration=timezone.now() + timedelta(seconds=duration))
+
+
+def release(newsletter, delivered, leases=()):
+    """Remove the delivered contacts from the outbox of the newsletter,
+    and free the other contacts of the leases"""
+    with transaction.atomic():
+        lock_newsletter(newsletter)
+        Delivery.objects.filter(newsletter=newsletter,
+                                contact__in=delivered).delete()
+        if leases:
+            Delivery.objects.filter(lease__in=leases).update(
+                lease='', lease_expiration=None)
@@ -0,0 +1,214 @@
+"""Rendering of the messages in a pool of processes"""
+import queue
+import pickle
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import wait
+
+import django
+from django.db import connections
+
+from .domains import batches
+from .settings import RENDER_PROCESSES
+from .settings import RENDER_CHUNK_SIZE
+from .settings import RENDER_QUEUE_SIZE
+
+
+class RenderError(Exception):
+    """Error raised while rendering a message which cannot be pickled"""
+
+
+# senders of the worker process by newsletter id
+_senders = {}
+
+
+def init_worker():
+    """Setup Django in a new worker process"""
+    django.setup()
+
+
+def render_chunk(newsletter_id, contact_ids, test):
+    """Render the messages of a chunk of contacts in a worker process.
+    Return a list of (contact id, message) where message is the
+    serialized message or the exception raised while building it."""
+    from .mailer import NewsLetterSender
+    from .models import Contact
+    from .models import Newsletter
+
+    sender = _senders.get(newsletter_id)
+    if sender is None or sender.test != test:
+        sender = NewsLetterSender(Newsletter.objects.get(pk=newsletter_id), test=test)
+        sender.attachments = sender.encode_attachments(sender.build_attachments())
+        _senders[newsletter_id] = sender
+
+    contacts = Contact.objects.in_bulk(contact_ids)
+    messages = []
+    for contact_id in contact_ids:
+        try:
+            message = sender.serialize_message(contacts[contact_id])
+        except Exception as e:
+            try:
+                pickle.dumps(e)
+            except Exception:
+                e = RenderError(repr(e))
+            message = e
+        messages.append((contact_id, message))
+    return messages
+
+
+class RenderPipeline(object):
+    """Render the messages of a sender in a pool of processes.
+
+    The contacts are submitted by chunks of ids to the worker processes,
+    at most two chunks per process at a time. A feeder thread puts the
+    messages of the chunks in the order they complete into a queue bounded
+    to queue_size messages, drained by the SMTP stage with messages().
+    The SMTP stage receives (number, contact, message) like with
+    NewsLetterSender.render_messages, so the statuses of the contacts
+    are recorded as usual.
+
+    The contacts are dispatched by the domain gate without wait: a chunk
+    is submitted short when the gate waits for a domain, so the contacts
+    holding its slots are sent and released meanwhile.
+
+    Once the contacts are exhausted the feeder waits for the messages
+    queued to be processed, then renders the contacts failed for a
+    transient reason when their retry is due, until none is left."""
+
+    def __init__(self, sender, contacts, processes=RENDER_PROCESSES,
+                 chunk_size=RENDER_CHUNK_SIZE, queue_size=RENDER_QUEUE_SIZE):
+        self.sender = sender
+        self.contacts = contacts
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.queue = queue.Queue(queue_size)
+        self.stopped = threading.Event()
+        # messages queued and not yet processed by the SMTP stage
+        self.pending = 0
+        self.processed = threading.Condition()
+        self.executor = None
+        self.thread = None
+
+    def start(self):
+        # the forked processes must not share the database connections
+        connections.close_all()
+        self.executor = ProcessPoolExecutor(self.processes, initializer=init_worker)
+        # start the processes before the feeder thread opens a connection
+        # to the database to read the contacts
+        self.executor.submit(int).result()
+        self.thread = threading.Thread(target=self.feed, name='render-feeder',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the feeding, the messages not yet sent are lost"""
+        self.stopped.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.thread.join()
+        # the messages left, so the None waking up the consumers fits
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                break
+        self.queue.put_nowait(None)
+
+    def retried(self):
+        """Iterate over the contacts to retry as they are due,
+        until none is left"""
+        retries = self.sender.retries
+        while not self.stopped.is_set():
+            timeout = retries.timeout()
+            if timeout is None:
+                return
+            if timeout and self.stopped.wait(timeout):
+                return
+            yield from retries.due()
+
+    def wait_processed(self):
+        """Wait for the messages queued to be processed,
+        return False if stopped"""
+        with self.processed:
+            while self.pending and not self.stopped.is_set():
+                self.processed.wait(0.1)
+        return not self.stopped.is_set()
+
+    def feed(self):
+        chunks = batches(self.contacts, self.chunk_size)
+        number = 0
+        running = {}
+        try:
+            while not self.stopped.is_set():
+                delay = None
+                while len(running) < self.processes * 2:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    if isinstance(chunk, float):
+                        # waiting for a domain
+                        delay = chunk
+                        break
+                    chunk = list(enumerate(chunk, number + 1))
+                    number = chunk[-1][0]
+                    future = self.executor.submit(
+                        render_chunk, self.sender.newsletter.pk,
+                        [contact.pk for i, contact in chunk], self.sender.test)
+                    running[future] = chunk
+                if not running:
+                    if delay is not None:
+                        self.stopped.wait(delay)
+                        continue
+                    # the failed contacts are known once processed
+                    if not self.wait_processed() or not self.sender.retries:
+                        break
+                    chunks = batches(self.sender.domains.dispatch(self.retried(), wait=False),
+                                     self.chunk_size)
+                    continue
+
+                done, not_done = wait(running, timeout=delay, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = running.pop(future)
+                    try:
+                        messages = dict(future.result())
+                    except Exception as e:
+                        # the worker process died
+                        messages = dict((contact.pk, e) for i, contact in chunk)
+                    for i, contact in chunk:
+                        self.put((i, contact, messages[contact.pk]))
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            connections.close_all()
+            self.put(None)
+
+    def put(self, item):
+        """Put an item in the queue, blocking while it is full"""
+        if item is not None:
+            with self.processed:
+                self.pending += 1
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def messages(self):
+        """Iterate over the rendered messages, can be used by several threads.
+        A message is processed once the next one is asked for"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                # let the other consumers stop too
+                self.queue.put(None)
+                return
+            try:
+                yield item
+            finally:
+                with self.processed:
+                    self.pending -= 1
+                    self.processed.notify_all()
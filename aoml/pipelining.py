@@ -0,0 +1,95 @@
+"""Sending of the mails with the ESMTP PIPELINING extension (RFC 2920)"""
+import re
+import smtplib
+from smtplib import quoteaddr
+from smtplib import SMTPDataError
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPServerDisconnected
+
+from .settings import PIPELINING
+
+EOL_RE = re.compile(br'(?:\r\n|\n|\r(?!\n))')
+PERIOD_RE = re.compile(br'(?m)^\.')
+
+
+def encode_data(msg):
+    """Return the content of a message for the DATA command,
+    with CRLF line ends, the leading periods doubled and the final
+    period"""
+    if isinstance(msg, str):
+        msg = msg.encode('ascii')
+    data = PERIOD_RE.sub(b'..', EOL_RE.sub(b'\r\n', msg))
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+def envelope(from_addr, to_addrs, size=None):
+    """Return the commands of the envelope of a message"""
+    mail = 'MAIL FROM:%s' % quoteaddr(from_addr)
+    if size is not None:
+        mail += ' size=%i' % size
+    return [mail] + ['RCPT TO:%s' % quoteaddr(address) for address in to_addrs] + ['DATA']
+
+
+def read_envelope(replies, from_addr, to_addrs):
+    """Check the replies to the envelope of a message,
+    return the refused recipients or raise like smtplib.SMTP.sendmail.
+    The last reply is to DATA, a 354 means the content is expected"""
+    code, message = replies[0]
+    if code != 250:
+        raise SMTPSenderRefused(code, message, from_addr)
+    refused = {}
+    for address, (code, message) in zip(to_addrs, replies[1:-1]):
+        if code not in (250, 251):
+            refused[address] = (code, message)
+    if len(refused) == len(to_addrs):
+        raise SMTPRecipientsRefused(refused)
+    code, message = replies[-1]
+    if code != 354:
+        raise SMTPDataError(code, message)
+    return refused
+
+
+def sendmail(smtp, from_addr, to_addrs, msg):
+    """Send a message like smtplib.SMTP.sendmail, in two round trips
+    instead of three plus one by recipient when the server supports
+    pipelining: the envelope commands are sent at once, then the
+    content. Return the dict of the refused recipients"""
+    if not PIPELINING or not isinstance(smtp, smtplib.SMTP):
+        return smtp.sendmail(from_addr, to_addrs, msg)
+    smtp.ehlo_or_helo_if_needed()
+    if not smtp.has_extn('pipelining'):
+        return smtp.sendmail(from_addr, to_addrs, msg)
+
+    if isinstance(to_addrs, str):
+        to_addrs = [to_addrs]
+    data = encode_data(msg)
+    size = len(data) if smtp.has_extn('size') else None
+    smtp.send(''.join('%s\r\n' % command for command in
+                      envelope(from_addr, to_addrs, size)))
+    replies = [smtp.getreply() for i in range(len(to_addrs) + 2)]
+    try:
+        refused = read_envelope(replies, from_addr, to_addrs)
+    except Exception:
+        if replies[-1][0] == 354:
+            # the server took DATA anyway, send an empty content
+            smtp.send(b'.\r\n')
+            smtp.getreply()
+        rset(smtp)
+        raise
+
+    smtp.send(data)
+    code, message = smtp.getreply()
+    if code != 250:
+        rset(smtp)
+        raise SMTPDataError(code, message)
+    return refused
+
+
+def rset(smtp):
+    try:
+        smtp.rset()
+    except SMTPServerDisconnected:
+        pass
@@ -0,0 +1,119 @@
+"""Sending of a newsletter with a pool of SMTP servers"""
+import time
+import random
+import threading
+
+from .throttle import Throttle
+from .settings import POOL_RETRY
+
+# seconds the credits left of a server are cached for the weighting
+CREDITS_REFRESH = 10
+
+
+class PoolMember(object):
+    """SMTP server of a pool, with its pacing and its health"""
+
+    def __init__(self, server, weight=1):
+        self.server = server
+        self.weight = weight
+        self.throttle = Throttle(server)
+        self.failed_until = 0.0
+        self.cached_credits = None
+        self.refreshed = 0.0
+        # connections opened to the server, up to its max_connections
+        self.connections = 0
+
+    def healthy(self):
+        return self.failed_until <= time.monotonic()
+
+    def can_connect(self):
+        """Tell if a session can be opened to the server"""
+        return self.connections < max(self.server.max_connections, 1)
+
+    def credits(self):
+        """Credits left of the server, refreshed every CREDITS_REFRESH
+        seconds"""
+        if self.cached_credits is None or \
+               time.monotonic() - self.refreshed >= CREDITS_REFRESH:
+            self.cached_credits = max(self.server.credits(), 0)
+            self.refreshed = time.monotonic()
+        return self.cached_credits
+
+
+class ServerPool(object):
+    """SMTP servers sending a newsletter. Each mail is sent by a server
+    taken at random in proportion of its weight times its credits left,
+    so the servers are drained together. A server which can not be
+    connected to is left aside for NEWSLETTER_POOL_RETRY seconds, its
+    share going to the other servers, then tried again. Each connection
+    of the sender opens at most one session by server, and the sessions
+    of a server are capped by its max_connections.
+
+    Thread safe, shared by the connections of a sender."""
+
+    def __init__(self, members):
+        self.members = members
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_newsletter(cls, newsletter):
+        return cls([PoolMember(server, weight) for server, weight
+                    in newsletter.pool_servers()])
+
+    def healthy(self):
+        return [member for member in self.members if member.healthy()]
+
+    def credits(self):
+        """Credits left of the healthy servers"""
+        return sum(max(member.server.credits(), 0) for member in self.healthy())
+
+    def choose(self, count=1, connected=()):
+        """Take count credits of a healthy server, return its member or
+        None if no server has the credits. connected are the ids of the
+        servers the caller has a session to, a session to another server
+        is counted in its connections"""
+        with self.lock:
+            members = [member for member in self.healthy()
+                       if member.server.pk in connected or member.can_connect()]
+            weights = [member.weight * max(member.credits(), 1) for member in members]
+        while members:
+            member = random.choices(members, weights)[0]
+            index = members.index(member)
+            new = member.server.pk not in connected
+            if new:
+                with self.lock:
+                    if not member.can_connect():
+                        # taken by another connection meanwhile
+                        del members[index], weights[index]
+                        continue
+                    member.connections += 1
+            if member.server.consume_credits(count):
+                with self.lock:
+                    member.cached_credits = max(member.credits() - count, 0)
+                return member
+            # the credits were taken by the other senders of the server
+            with self.lock:
+                member.cached_credits = 0
+                if new:
+                    member.connections -= 1
+            del members[index], weights[index]
+        return None
+
+    def connect(self, server_id):
+        """Count a session opened to a server outside of choose"""
+        with self.lock:
+            for member in self.members:
+                if member.server.pk == server_id:
+                    member.connections += 1
+
+    def disconnect(self, server_ids):
+        """Free the connections of the sessions closed to servers"""
+        with self.lock:
+            for member in self.members:
+                if member.server.pk in server_ids:
+                    member.connections -= 1
+
+    def fail(self, member):
+        """Leave aside a server which can not be connected to"""
+        with self.lock:
+            member.failed_until = time.monotonic() + POOL_RETRY
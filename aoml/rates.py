@@ -0,0 +1,131 @@
+"""Rates of the SMTP servers varying over time, for the warm-up of
+a sending IP and the hours of the day"""
+import re
+from datetime import timedelta
+from functools import lru_cache
+
+from django.utils import timezone
+
+RAMP_RE = re.compile(r'^day\s+(\d+)\s*:\s*(\d+)$', re.IGNORECASE)
+WINDOW_RE = re.compile(r'^(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*:\s*(\d+)$')
+# the completions later than this are not estimated
+HORIZON = timedelta(days=365)
+
+
+@lru_cache(maxsize=64)
+def parse_schedule(text):
+    """Return the (day, rate) points of the warm-up ramp, sorted by day,
+    and the (start, end, rate) windows of the day in minutes of a rate
+    schedule, one rule by line:
+
+        day 0: 500
+        day 21: 50000
+        08:00-20:00: 20000
+
+    Raise ValueError on an invalid line"""
+    ramp = []
+    windows = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        match = RAMP_RE.match(line)
+        if match:
+            day, rate = int(match.group(1)), int(match.group(2))
+            ramp.append((day, rate))
+        else:
+            match = WINDOW_RE.match(line)
+            if not match:
+                raise ValueError('Invalid rule %r' % line)
+            start_hour, start_minute, end_hour, end_minute, rate = map(int, match.groups())
+            if start_hour > 23 or end_hour > 24 or start_minute > 59 or end_minute > 59:
+                raise ValueError('Invalid hours %r' % line)
+            windows.append((start_hour * 60 + start_minute,
+                            end_hour * 60 + end_minute, rate))
+        if not rate:
+            raise ValueError('Rate of 0 mail per hour %r' % line)
+    return tuple(sorted(ramp)), tuple(windows)
+
+
+def ramp_rate(ramp, day):
+    """Rate of a day of the warm-up, interpolated between the points"""
+    if day <= ramp[0][0]:
+        return ramp[0][1]
+    for (day_1, rate_1), (day_2, rate_2) in zip(ramp, ramp[1:]):
+        if day < day_2:
+            return int(rate_1 + (rate_2 - rate_1) * (day - day_1) / (day_2 - day_1))
+    return ramp[-1][1]
+
+
+def in_window(start, end, minute):
+    if start <= end:
+        return start <= minute < end
+    # over midnight
+    return minute >= start or minute < end
+
+
+def local(when=None):
+    """Local time of when, by default now"""
+    when = when or timezone.now()
+    if timezone.is_aware(when):
+        return timezone.localtime(when)
+    return when
+
+
+def aware_as(when, other):
+    """when made aware or naive like other, to be compared with it"""
+    if timezone.is_aware(other) and timezone.is_naive(when):
+        return timezone.make_aware(when)
+    if timezone.is_naive(other) and timezone.is_aware(when):
+        return timezone.make_naive(when)
+    return when
+
+
+def scheduled_rate(mails_hour, schedule, warmup_start=None, when=None):
+    """Mails per hour at a local time, 0 for no limit: mails_hour capped
+    by the rate of the warm-up day since warmup_start and by the rates
+    of the windows of the day including the time"""
+    if not schedule:
+        return mails_hour
+    when = local(when)
+    ramp, windows = parse_schedule(schedule)
+    rates = [mails_hour] if mails_hour else []
+    if ramp and warmup_start is not None:
+        rates.append(ramp_rate(ramp, (when.date() - warmup_start).days))
+    minute = when.hour * 60 + when.minute
+    rates.extend(rate for start, end, rate in windows
+                 if in_window(start, end, minute))
+    return min(rates) if rates else 0
+
+
+def next_change(schedule, when):
+    """Next time the scheduled rate may change after when,
+    at the next midnight or edge of a window"""
+    day = when.replace(hour=0, minute=0, second=0, microsecond=0)
+    edges = set()
+    if schedule:
+        for start, end, rate in parse_schedule(schedule)[1]:
+            edges.update((start, end))
+    for minute in sorted(edges):
+        change = day + timedelta(minutes=minute)
+        if change > when:
+            return change
+    return day + timedelta(days=1)
+
+
+def completion(mails_hour, schedule, warmup_start, mails, start=None):
+    """Estimate when mails are sent from start under the rate schedule,
+    return None without limit or after a year"""
+    when = local(start)
+    horizon = when + HORIZON
+    while mails > 0:
+        rate = scheduled_rate(mails_hour, schedule, warmup_start, when)
+        if not rate or when > horizon:
+            return None
+        change = next_change(schedule, when)
+        capacity = rate * (change - when).total_seconds() / 3600.0
+        if capacity >= mails:
+            return when + timedelta(hours=float(mails) / rate)
+        mails -= capacity
+        when = change
+    return when
@@ -0,0 +1,101 @@
+"""Retry of the mails failed for a transient reason"""
+import time
+import random
+import threading
+from heapq import heappop
+from heapq import heappush
+from itertools import count
+from smtplib import SMTPException
+from smtplib import SMTPResponseException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPServerDisconnected
+
+from .settings import RETRY_ATTEMPTS
+from .settings import RETRY_DELAY
+from .settings import RETRY_MAX_DELAY
+
+
+def is_transient(exception):
+    """Tell if a failure may not happen again: 4xx replies,
+    disconnections and network errors"""
+    if isinstance(exception, SMTPRecipientsRefused):
+        return bool(exception.recipients) and all(
+            400 <= code < 500 for code, message in exception.recipients.values())
+    if isinstance(exception, SMTPResponseException):
+        return 400 <= exception.smtp_code < 500
+    if isinstance(exception, SMTPException):
+        return isinstance(exception, SMTPServerDisconnected)
+    return isinstance(exception, OSError)
+
+
+def is_disconnected(exception):
+    """Tell if the connection must be established again after a failure"""
+    if isinstance(exception, SMTPResponseException):
+        # service not available, closing the channel
+        return exception.smtp_code == 421
+    if isinstance(exception, SMTPException):
+        return isinstance(exception, SMTPServerDisconnected)
+    return isinstance(exception, OSError)
+
+
+class RetryQueue(object):
+    """Contacts to send again after a transient failure, in a heap keyed
+    by the time of their retry. The delay is doubled at each attempt up
+    to max_delay, and taken at random in its upper half so the contacts
+    failing together are not retried together.
+
+    Thread safe, shared by the connections of a sender."""
+
+    def __init__(self, attempts=RETRY_ATTEMPTS, delay=RETRY_DELAY,
+                 max_delay=RETRY_MAX_DELAY):
+        self.max_attempts = attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.heap = []
+        self.attempts = {}
+        self.sequence = count()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, contact):
+        """Schedule the retry of a contact,
+        return False if it had all its attempts"""
+        with self.lock:
+            attempts = self.attempts.get(contact.pk, 0) + 1
+            if attempts > self.max_attempts:
+                del self.attempts[contact.pk]
+                return False
+            self.attempts[contact.pk] = attempts
+            delay = min(self.delay * 2 ** (attempts - 1), self.max_delay)
+            delay = random.uniform(delay / 2.0, delay)
+            heappush(self.heap, (time.monotonic() + delay,
+                                 next(self.sequence), contact))
+            return True
+
+    def forget(self, contact):
+        """The contact was sent or failed for good"""
+        with self.lock:
+            self.attempts.pop(contact.pk, None)
+
+    def pop(self):
+        """Return a contact whose retry is due, or None"""
+        with self.lock:
+            if self.heap and self.heap[0][0] <= time.monotonic():
+                return heappop(self.heap)[2]
+        return None
+
+    def due(self):
+        """Iterate over the contacts whose retry is due"""
+        contact = self.pop()
+        while contact is not None:
+            yield contact
+            contact = self.pop()
+
+    def timeout(self):
+        """Seconds until the next retry, None if there are none"""
+        with self.lock:
+            if not self.heap:
+                return None
+            return max(self.heap[0][0] - time.monotonic(), 0)
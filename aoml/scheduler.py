@@ -0,0 +1,161 @@
+"""Scheduler of the newsletters sent by a SMTP server"""
+import time
+from heapq import heappop
+from heapq import heappush
+from itertools import count
+from datetime import timedelta
+
+from django.utils import timezone
+
+from .models import Newsletter
+from .settings import SCHEDULER_POLL
+from .settings import SCHEDULER_RETRY
+
+ACTIVE_STATUS = (Newsletter.WAITING, Newsletter.SENDING)
+
+
+class NewsletterScheduler(object):
+    """Tell which newsletter of a SMTP server has to send the next mail.
+
+    The newsletters waiting for their sending date are kept in a heap
+    keyed by the date. The due newsletters share the sending in
+    proportion of their priority: each one has a pass increased by
+    1 / priority when it is served, and the one with the lowest pass is
+    served next (stride scheduling).
+
+    The newsletters are refreshed from the database every poll_delay
+    seconds, only the rows modified since the last refresh are read.
+    A newsletter whose expedition is done is not sent again before
+    retry_delay seconds, so the contacts in error are not retried
+    in a loop."""
+
+    def __init__(self, server, poll_delay=SCHEDULER_POLL,
+                 retry_delay=SCHEDULER_RETRY):
+        self.server = server
+        self.poll_delay = poll_delay
+        self.retry_delay = retry_delay
+        self.newsletters = {}
+        self.not_before = {}
+        self.entries = {}
+        self.waiting = []
+        self.ready = []
+        self.sequence = count()
+        self.virtual_time = 0.0
+        self.last_refresh = None
+        self.next_refresh = 0
+
+    def refresh(self):
+        """Read the newsletters modified since the last refresh,
+        return the ids of the newsletters no longer to be sent"""
+        now = timezone.now()
+        newsletters = self.server.newsletters()
+        if self.last_refresh is None:
+            newsletters = newsletters.filter(status__in=ACTIVE_STATUS)
+        else:
+            newsletters = newsletters.filter(
+                modification_date__gte=self.last_refresh)
+        self.last_refresh = now
+        self.next_refresh = time.monotonic() + self.poll_delay
+
+        removed = []
+        for newsletter in newsletters:
+            if not self.schedule(newsletter, now):
+                removed.append(newsletter.id)
+        return removed
+
+    def schedule(self, newsletter, now=None):
+        """Schedule a newsletter after a change,
+        return False if it is no longer to be sent"""
+        now = now or timezone.now()
+        if newsletter.status not in ACTIVE_STATUS:
+            self.remove(newsletter.id)
+            return False
+
+        self.newsletters[newsletter.id] = newsletter
+        due = max(newsletter.sending_date,
+                  self.not_before.get(newsletter.id, newsletter.sending_date))
+        state = self.entries.get(newsletter.id, (None,))[0]
+        if due > now:
+            self.push_waiting(newsletter.id, due)
+        elif state != 'ready':
+            self.push_ready(newsletter.id)
+        return True
+
+    def remove(self, newsletter_id):
+        """Stop to schedule a newsletter, its entries in the heaps are
+        discarded when they are popped"""
+        self.newsletters.pop(newsletter_id, None)
+        self.entries.pop(newsletter_id, None)
+        self.not_before.pop(newsletter_id, None)
+
+    def done(self, newsletter_id):
+        """The expedition of the newsletter is over, wait before sending
+        again to the contacts left"""
+        newsletter = self.newsletters.get(newsletter_id)
+        if newsletter is None:
+            return
+        now = timezone.now()
+        self.not_before[newsletter_id] = now + timedelta(seconds=self.retry_delay)
+        self.schedule(newsletter, now)
+
+    def defer(self, newsletter_id, seconds):
+        """The newsletter has nothing to send for some seconds"""
+        newsletter = self.newsletters.get(newsletter_id)
+        if newsletter is None:
+            return
+        now = timezone.now()
+        self.not_before[newsletter_id] = now + timedelta(seconds=seconds)
+        self.schedule(newsletter, now)
+
+    def push_waiting(self, newsletter_id, due):
+        sequence = next(self.sequence)
+        self.entries[newsletter_id] = ('waiting', sequence)
+        heappush(self.waiting, (due, sequence, newsletter_id))
+
+    def push_ready(self, newsletter_id, pass_=None):
+        if pass_ is None:
+            # start from the current pass, not to get all the sending
+            # after a long wait or to never get a chance to be served
+            pass_ = self.virtual_time
+        sequence = next(self.sequence)
+        self.entries[newsletter_id] = ('ready', sequence)
+        heappush(self.ready, (pass_, sequence, newsletter_id))
+
+    def poll(self):
+        """Refresh if the poll delay is over,
+        return the ids of the newsletters no longer to be sent"""
+        if time.monotonic() < self.next_refresh:
+            return []
+        return self.refresh()
+
+    def next(self):
+        """Return the newsletter to serve, or None if none is due"""
+        now = timezone.now()
+        while self.waiting and self.waiting[0][0] <= now:
+            due, sequence, newsletter_id = heappop(self.waiting)
+            if self.entries.get(newsletter_id) == ('waiting', sequence):
+                self.push_ready(newsletter_id)
+
+        while self.ready:
+            pass_, sequence, newsletter_id = heappop(self.ready)
+            if self.entries.get(newsletter_id) != ('ready', sequence):
+                continue
+            newsletter = self.newsletters[newsletter_id]
+            self.virtual_time = pass_
+            self.push_ready(newsletter_id,
+                            pass_ + 1.0 / max(newsletter.priority, 1))
+            return newsletter
+        return None
+
+    def timeout(self):
+        """Seconds until the next newsletter is due or the next refresh"""
+        timeout = self.next_refresh - time.monotonic()
+        while self.waiting:
+            due, sequence, newsletter_id = self.waiting[0]
+            if self.entries.get(newsletter_id) != ('waiting', sequence):
+                heappop(self.waiting)
+                continue
+            timeout = min(timeout,
+                          (due - timezone.now()).total_seconds())
+            break
+        return max(timeout, 0)
@@ -0,0 +1,118 @@
+"""Connections to the SMTP servers, recycled according to their policy"""
+import ssl
+import time
+from smtplib import SMTPException
+
+from django.conf import settings
+
+from .settings import RESTART_CONNECTION_BETWEEN_SENDING
+
+
+def expired(server, messages, opened):
+    """Tell if a connection opened at opened, which sent messages,
+    is to be recycled"""
+    if RESTART_CONNECTION_BETWEEN_SENDING and messages:
+        return True
+    if server.session_messages and messages >= server.session_messages:
+        return True
+    return bool(server.session_lifetime and
+                time.monotonic() - opened >= server.session_lifetime)
+
+
+class ResumingContext(ssl.SSLContext):
+    """TLS context resuming the session of the last connection,
+    to save the full handshake when reconnecting"""
+    session = None
+
+    def wrap_socket(self, sock, *args, **kwargs):
+        if self.session is not None and not kwargs.get('server_side') and \
+               kwargs.get('session') is None:
+            kwargs['session'] = self.session
+        return super(ResumingContext, self).wrap_socket(sock, *args, **kwargs)
+
+
+def resuming_context():
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_default_certs()
+    # the client certificate of the Django SMTP backend
+    if settings.EMAIL_SSL_CERTFILE or settings.EMAIL_SSL_KEYFILE:
+        context.load_cert_chain(settings.EMAIL_SSL_CERTFILE,
+                                settings.EMAIL_SSL_KEYFILE)
+    return context
+
+
+class SMTPSession(object):
+    """Connection to a SMTP server, opened on demand. It is recycled after
+    the session messages or lifetime of the server, checked with a NOOP
+    after keepalive idle seconds and dropped after an error, the next
+    connection resuming the TLS session.
+
+    smtp is an already opened connection to use first."""
+
+    def __init__(self, server, smtp=None):
+        self.server = server
+        self.smtp = smtp
+        self.context = resuming_context() if server.tls or server.ssl else None
+        self.messages = 0
+        self.opened = self.used = time.monotonic()
+
+    def get(self):
+        """Return the connection, opened or recycled if needed"""
+        if self.smtp is not None and expired(self.server, self.messages, self.opened):
+            self.quit()
+        if self.smtp is None:
+            self.smtp = self.server.connect(self.context)
+            self.messages = 0
+            self.opened = self.used = time.monotonic()
+        return self.smtp
+
+    def sent(self, count=1):
+        """Count the messages sent on the connection"""
+        self.messages += count
+        self.used = time.monotonic()
+
+    def idle_timeout(self):
+        """Seconds until the next keepalive, None without keepalive"""
+        if self.smtp is None or not self.server.keepalive:
+            return None
+        return max(self.used + self.server.keepalive - time.monotonic(), 0)
+
+    def keepalive(self):
+        """Send a NOOP if the connection is idle for keepalive seconds,
+        drop it if the server does not answer"""
+        if self.idle_timeout() != 0:
+            return
+        try:
+            code = self.smtp.noop()[0]
+        except (SMTPException, OSError):
+            code = None
+        if code != 250:
+            self.close()
+        self.used = time.monotonic()
+
+    def save_tls_session(self):
+        sock = getattr(self.smtp, 'sock', None)
+        if self.context is not None and isinstance(sock, ssl.SSLSocket) and \
+               sock.session is not None:
+            self.context.session = sock.session
+
+    def quit(self):
+        if self.smtp is None:
+            return
+        self.save_tls_session()
+        try:
+            self.smtp.quit()
+        except (SMTPException, OSError):
+            self.close()
+        self.smtp = None
+
+    def close(self):
+        """Drop the connection after an error"""
+        if self.smtp is None:
+            return
+        self.save_tls_session()
+        try:
+            self.smtp.close()
+        except Exception:
+            pass
+        self.smtp = None
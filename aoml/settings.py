@@ -1,5 +1,7 @@
 """Settings for emencia.django.newsletter"""
+import os
 import string
+import tempfile
 from django.conf import settings
 
 BASE64_IMAGES = {
@@ -37,6 +39,60 @@ SLEEP_BETWEEN_SENDING = getattr(
 RESTART_CONNECTION_BETWEEN_SENDING = getattr(
     settings, 'NEWSLETTER_RESTART_CONNECTION_BETWEEN_SENDING', False)
 
+EXPEDITION_CHUNK_SIZE = getattr(settings, 'NEWSLETTER_EXPEDITION_CHUNK_SIZE', 1000)
+
+RETRY_ATTEMPTS = getattr(settings, 'NEWSLETTER_RETRY_ATTEMPTS', 4)
+RETRY_DELAY = getattr(settings, 'NEWSLETTER_RETRY_DELAY', 30)
+RETRY_MAX_DELAY = getattr(settings, 'NEWSLETTER_RETRY_MAX_DELAY', 600)
+
+ADAPTIVE_INITIAL_RATE = getattr(settings, 'NEWSLETTER_ADAPTIVE_INITIAL_RATE', 3600)
+ADAPTIVE_MIN_RATE = getattr(settings, 'NEWSLETTER_ADAPTIVE_MIN_RATE', 60)
+ADAPTIVE_INCREASE = getattr(settings, 'NEWSLETTER_ADAPTIVE_INCREASE', 10)
+ADAPTIVE_DECREASE = getattr(settings, 'NEWSLETTER_ADAPTIVE_DECREASE', 0.5)
+ADAPTIVE_LATENCY_FACTOR = getattr(settings, 'NEWSLETTER_ADAPTIVE_LATENCY_FACTOR', 3)
+
+DOMAIN_INTERLEAVE = getattr(settings, 'NEWSLETTER_DOMAIN_INTERLEAVE', True)
+DOMAIN_RATES = getattr(settings, 'NEWSLETTER_DOMAIN_RATES', {})
+DOMAIN_CONCURRENCY = getattr(settings, 'NEWSLETTER_DOMAIN_CONCURRENCY', {})
+
+PIPELINING = getattr(settings, 'NEWSLETTER_PIPELINING', True)
+
+POOL_RETRY = getattr(settings, 'NEWSLETTER_POOL_RETRY', 300)
+
+BATCH_RECIPIENTS = getattr(settings, 'NEWSLETTER_BATCH_RECIPIENTS', 100)
+
+USE_OUTBOX = getattr(settings, 'NEWSLETTER_USE_OUTBOX', False)
+OUTBOX_BATCH_SIZE = getattr(settings, 'NEWSLETTER_OUTBOX_BATCH_SIZE', 100)
+OUTBOX_LEASE = getattr(settings, 'NEWSLETTER_OUTBOX_LEASE', 600)
+
+SCHEDULER_POLL = getattr(settings, 'NEWSLETTER_SCHEDULER_POLL', 60)
+SCHEDULER_RETRY = getattr(settings, 'NEWSLETTER_SCHEDULER_RETRY', 600)
+
+WAKEUP = getattr(settings, 'NEWSLETTER_WAKEUP', True)
+WAKEUP_DIR = getattr(settings, 'NEWSLETTER_WAKEUP_DIR',
+                     os.path.join(tempfile.gettempdir(), 'aoml', 'wakeup'))
+
+ATTACHMENTS_MMAP = getattr(settings, 'NEWSLETTER_ATTACHMENTS_MMAP', False)
+
+RENDER_PROCESSES = getattr(settings, 'NEWSLETTER_RENDER_PROCESSES', 0)
+RENDER_CHUNK_SIZE = getattr(settings, 'NEWSLETTER_RENDER_CHUNK_SIZE', 50)
+RENDER_QUEUE_SIZE = getattr(settings, 'NEWSLETTER_RENDER_QUEUE_SIZE', 500)
+
+ASYNC_EXECUTOR_WORKERS = getattr(settings, 'NEWSLETTER_ASYNC_EXECUTOR_WORKERS', 4)
+
+STATUS_BATCH_SIZE = getattr(settings, 'NEWSLETTER_STATUS_BATCH_SIZE', 100)
+STATUS_BATCH_DELAY = getattr(settings, 'NEWSLETTER_STATUS_BATCH_DELAY', 5)
+# kept across reboots, the statuses of the journals are replayed,
+# in the project by default
+STATUS_JOURNAL_DIR = getattr(settings, 'NEWSLETTER_STATUS_JOURNAL_DIR', os.path.join(
+    str(getattr(settings, 'BASE_DIR', os.path.join(os.path.expanduser('~'), '.aoml'))),
+    'newsletter_journal'))
+STATUS_JOURNAL_FSYNC = getattr(settings, 'NEWSLETTER_STATUS_JOURNAL_FSYNC', False)
+
+SPOOL_DIR = getattr(settings, 'NEWSLETTER_SPOOL_DIR',
+                    os.path.join(tempfile.gettempdir(), 'aoml', 'spool'))
+SPOOL_SEGMENT_SIZE = getattr(settings, 'NEWSLETTER_SPOOL_SEGMENT_SIZE', 64 * 1024 * 1024)
+
 BASE_PATH = getattr(settings, 'NEWSLETTER_BASE_PATH', 'uploads/newsletter')
 
 DOMAIN = getattr(settings, 'NEWSLETTER_DOMAIN', 'www.example.com')
@@ -0,0 +1,238 @@
+"""Spool of the messages of a newsletter rendered ahead of its sending"""
+import os
+import json
+import mmap
+import shutil
+import struct
+import hashlib
+from zlib import crc32
+
+from django.utils.encoding import smart_str
+
+from .settings import SPOOL_DIR
+from .settings import SPOOL_SEGMENT_SIZE
+from .settings import DOMAIN
+from .settings import TRACKING_LINKS
+from .settings import TRACKING_IMAGE
+from .settings import INCLUDE_UNSUBSCRIPTION
+from .settings import EXPEDITION_CHUNK_SIZE
+
+# contact id, segment, offset, length and version of the contact
+RECORD = struct.Struct('<QIQII')
+META = 'meta.json'
+INDEX = 'index'
+TAIL = 'tail'
+SEGMENT = 'segment-%04i'
+
+
+def spool_path(newsletter_id, directory=SPOOL_DIR):
+    return os.path.join(directory, str(newsletter_id))
+
+
+def fingerprint(newsletter):
+    """Hash of what the messages of a newsletter are made of, but the
+    contacts, the spool is stale when it changes"""
+    attachments = []
+    for attachment in newsletter.attachment_set.order_by('pk'):
+        path = attachment.file_attachment.path
+        stat = os.stat(path) if os.path.exists(path) else None
+        attachments.append((attachment.pk, attachment.title, path,
+                            stat and (stat.st_size, stat.st_mtime)))
+    values = [newsletter.title, newsletter.content, smart_str(newsletter.header_sender),
+              smart_str(newsletter.header_reply), newsletter.slug,
+              newsletter.mailing_list_id, newsletter.server.headers, attachments,
+              DOMAIN, TRACKING_LINKS, TRACKING_IMAGE, INCLUDE_UNSUBSCRIPTION]
+    return hashlib.sha1(json.dumps(values, default=str).encode('utf-8')).hexdigest()
+
+
+def contact_version(contact):
+    """Checksum of a contact, its message is stale when it changes"""
+    return crc32(('%s %s' % (contact.email, contact.modification_date)).encode('utf-8'))
+
+
+class Spool(object):
+    """Messages of a newsletter read from its spool: segment files
+    memory-mapped, each message found by the id of its contact in the
+    index sorted by contact, and completed with the tail of the spool,
+    the attachments and the closing delimiter.
+
+    The spool is read as it was when opened, the messages appended
+    since are not seen."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, TAIL), 'rb') as tail:
+            self.tail = tail.read()
+        self.index = self.map(INDEX)
+        self.records = len(self.index) // RECORD.size if self.index else 0
+        self.segments = {}
+
+    @classmethod
+    def open(cls, newsletter, directory=SPOOL_DIR):
+        """Return the spool of a newsletter, None if there is none
+        or if it is stale"""
+        path = spool_path(newsletter.pk, directory)
+        try:
+            with open(os.path.join(path, META)) as meta:
+                if json.load(meta)['fingerprint'] != fingerprint(newsletter):
+                    return None
+            return cls(path)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def map(self, name):
+        with open(os.path.join(self.path, name), 'rb') as f:
+            if not os.fstat(f.fileno()).st_size:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.records
+
+    def get(self, contact):
+        """Return the message of a contact, None if it is not in the
+        spool or if the contact changed since"""
+        low, high = 0, self.records
+        while low < high:
+            middle = (low + high) // 2
+            contact_id = RECORD.unpack_from(self.index, middle * RECORD.size)[0]
+            if contact_id < contact.pk:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.records:
+            return None
+        contact_id, segment, offset, length, version = RECORD.unpack_from(
+            self.index, low * RECORD.size)
+        if contact_id != contact.pk or version != contact_version(contact):
+            return None
+        if segment not in self.segments:
+            self.segments[segment] = self.map(SEGMENT % segment)
+        return self.segments[segment][offset:offset + length] + self.tail
+
+
+class SpoolWriter(object):
+    """Append the messages of a newsletter to its spool, by increasing
+    contact id. The spool is emptied first if it is stale, else the
+    messages are appended to a new segment file, the index being written
+    once the messages it points to are flushed.
+
+    meta is the dict of the spool saved in meta.json: its fingerprint
+    and the boundaries of its messages."""
+
+    def __init__(self, newsletter_id, meta, tail, directory=SPOOL_DIR):
+        self.path = spool_path(newsletter_id, directory)
+        old_meta = self.read_meta(self.path)
+        if old_meta is not None and old_meta['fingerprint'] != meta['fingerprint']:
+            shutil.rmtree(self.path)
+            old_meta = None
+        self.meta = old_meta or meta
+        if old_meta is None:
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, TAIL), 'wb') as f:
+                f.write(tail)
+            open(os.path.join(self.path, INDEX), 'wb').close()
+            with open(os.path.join(self.path, META), 'w') as f:
+                json.dump(meta, f)
+
+        self.index = open(os.path.join(self.path, INDEX), 'ab')
+        # the records of the index not flushed by a crash are lost
+        self.index.truncate(self.index.tell() // RECORD.size * RECORD.size)
+        self.last_contact_id = 0
+        if self.index.tell():
+            with open(os.path.join(self.path, INDEX), 'rb') as index:
+                index.seek(-RECORD.size, os.SEEK_END)
+                self.last_contact_id = RECORD.unpack(index.read(RECORD.size))[0]
+        self.segment_number = len([name for name in os.listdir(self.path)
+                                   if name.startswith('segment-')])
+        self.segment = None
+        self.pending = []
+
+    @staticmethod
+    def read_meta(path):
+        try:
+            with open(os.path.join(path, META)) as meta:
+                return json.load(meta)
+        except (OSError, ValueError):
+            return None
+
+    def add(self, contact, message):
+        """Append the message of a contact, without its tail"""
+        if self.segment is None or self.segment.tell() >= SPOOL_SEGMENT_SIZE:
+            self.next_segment()
+        offset = self.segment.tell()
+        self.segment.write(message)
+        self.pending.append(RECORD.pack(contact.pk, self.segment_number - 1, offset,
+                                        len(message), contact_version(contact)))
+        self.last_contact_id = contact.pk
+        if len(self.pending) >= EXPEDITION_CHUNK_SIZE:
+            self.flush()
+
+    def next_segment(self):
+        if self.segment is not None:
+            self.flush()
+            self.segment.close()
+        self.segment = open(os.path.join(self.path, SEGMENT % self.segment_number), 'wb')
+        self.segment_number += 1
+
+    def flush(self):
+        """Write the index of the messages flushed"""
+        if self.segment is not None:
+            self.segment.flush()
+        self.index.write(b''.join(self.pending))
+        self.index.flush()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.segment is not None:
+            self.segment.close()
+        self.index.close()
+
+
+def remove(newsletter_id, directory=SPOOL_DIR):
+    """Remove the spool of a newsletter"""
+    shutil.rmtree(spool_path(newsletter_id, directory), ignore_errors=True)
+
+
+def spooled(directory=SPOOL_DIR):
+    """Ids of the newsletters with a spool"""
+    if not os.path.isdir(directory):
+        return []
+    return [int(name) for name in os.listdir(directory) if name.isdigit()]
+
+
+def prerender(newsletter, verbose=0, directory=SPOOL_DIR):
+    """Render in the spool of a newsletter the messages of the contacts
+    of its expedition list not yet in the spool, return their number.
+    The messages failing to render are left to the sending"""
+    from .mailer import NewsLetterSender
+
+    sender = NewsLetterSender(newsletter, verbose=verbose)
+    meta = {'fingerprint': fingerprint(newsletter),
+            'boundary': sender.boundary,
+            'alternative_boundary': sender.alternative_boundary}
+    old_meta = SpoolWriter.read_meta(spool_path(newsletter.pk, directory))
+    if old_meta is not None and old_meta['fingerprint'] == meta['fingerprint']:
+        # appended to the messages of the same boundaries
+        meta = old_meta
+    sender.set_boundaries(meta['boundary'], meta['alternative_boundary'])
+    sender.attachments = sender.encode_attachments(sender.build_attachments())
+    tail = bytes(sender.attachments) + sender.closing_delimiter.encode('ascii')
+
+    writer = SpoolWriter(newsletter.pk, meta, tail, directory)
+    contacts = sender.build_expedition_list().filter(id__gt=writer.last_contact_id)
+    rendered = 0
+    try:
+        for contact in contacts.iterator(chunk_size=EXPEDITION_CHUNK_SIZE):
+            try:
+                message = sender.serialize_content(contact)
+            except Exception as e:
+                if verbose:
+                    print('- %s not rendered: %s' % (contact.email, e))
+                continue
+            writer.add(contact, message)
+            rendered += 1
+    finally:
+        writer.close()
+    return rendered
@@ -0,0 +1,159 @@
+"""Supervisor of the worker processes of the continuous sender"""
+import sys
+import time
+import signal
+import socket
+import threading
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+from datetime import datetime
+
+import django
+from django.db import connections
+
+# seconds to wait before restarting a crashed worker, doubled at each
+# crash in a row up to RESTART_MAX_DELAY
+RESTART_DELAY = 1
+RESTART_MAX_DELAY = 60
+
+
+def run_worker(server_id, max_messages, verbose):
+    """Send the newsletters of a SMTP server in a worker process until
+    SIGTERM or max_messages mails were sent, exit with 1 on error"""
+    # not the handlers of the supervisor
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    django.setup()
+    from .mailer import SMTPMailer
+    from .models import SMTPServer
+
+    mailer = SMTPMailer(SMTPServer.objects.get(pk=server_id), verbose=verbose,
+                        max_messages=max_messages)
+    errors = []
+
+    def run():
+        try:
+            mailer.run()
+        except Exception:
+            traceback.print_exc()
+            errors.append(sys.exc_info())
+        finally:
+            connections.close_all()
+
+    # the mailer runs in a thread, so the signal handler of the main
+    # thread never interrupts it while it holds a lock
+    signal.signal(signal.SIGTERM, lambda signum, frame: mailer.stop())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    thread = threading.Thread(target=run, name=mailer.server.name)
+    thread.start()
+    thread.join()
+    sys.exit(1 if errors else 0)
+
+
+class Worker(object):
+    """Slot of a worker process of a SMTP server"""
+
+    def __init__(self, server, number):
+        self.server = server
+        self.number = number
+        self.process = None
+        self.started = 0
+        self.failures = 0
+        self.restart = 0
+
+    def __str__(self):
+        return 'smtp-%s (%s) worker %i' % (self.server.id, self.server.name[:10],
+                                           self.number)
+
+
+class Supervisor(object):
+    """Run processes worker processes per SMTP server.
+
+    A worker exiting after max_messages mails is replaced at once, a worker
+    crashing is restarted after a delay doubled at each crash in a row.
+    On SIGTERM or SIGINT the workers are asked to stop: they finish the
+    mail being sent and write the pending statuses before exiting."""
+
+    # function run by the worker processes
+    target = staticmethod(run_worker)
+
+    def __init__(self, servers, processes=1, max_messages=0, verbose=0):
+        self.workers = [Worker(server, number) for server in servers
+                        for number in range(processes)]
+        self.max_messages = max_messages
+        self.verbose = verbose
+        self.stopping = False
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+
+    def log(self, worker, message):
+        if self.verbose:
+            print('%s %s: %s' % (datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                 worker, message))
+
+    def stop(self, signum=None, frame=None):
+        """Ask the workers to stop, can be called from a signal handler"""
+        self.stopping = True
+        for worker in self.workers:
+            if worker.process and worker.process.is_alive():
+                worker.process.terminate()
+        try:
+            self.writer.send(b'\0')
+        except OSError:
+            pass
+
+    def start(self, worker):
+        worker.process = multiprocessing.Process(
+            target=self.target, name=str(worker),
+            args=(worker.server.pk, self.max_messages, self.verbose))
+        worker.process.start()
+        worker.started = time.monotonic()
+        self.log(worker, 'started with pid %s' % worker.process.pid)
+
+    def reap(self, worker):
+        """Schedule the restart of a worker which exited"""
+        process = worker.process
+        process.join()
+        worker.process = None
+        if process.exitcode == 0:
+            worker.failures = 0
+            worker.restart = 0
+            self.log(worker, 'exited, recycled')
+            return
+        if time.monotonic() - worker.started > RESTART_MAX_DELAY:
+            worker.failures = 0
+        delay = min(RESTART_DELAY * 2 ** worker.failures, RESTART_MAX_DELAY)
+        worker.failures += 1
+        worker.restart = time.monotonic() + delay
+        self.log(worker, 'exited with code %s, restarted in %i seconds' % (
+            process.exitcode, delay))
+
+    def run(self):
+        for s in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(s, self.stop)
+        # the workers open their own connections
+        connections.close_all()
+
+        while not self.stopping:
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process is None and worker.restart <= now:
+                    self.start(worker)
+
+            running = [worker for worker in self.workers if worker.process]
+            restarts = [worker.restart for worker in self.workers
+                        if worker.process is None]
+            timeout = max(min(restarts) - now, 0) if restarts else None
+            ready = wait([worker.process.sentinel for worker in running] +
+                         [self.reader], timeout)
+            for worker in running:
+                if worker.process.sentinel in ready:
+                    self.reap(worker)
+
+        # drain: the workers finish their mail and flush their statuses,
+        # a worker started while stopping is asked again
+        for worker in self.workers:
+            if worker.process:
+                worker.process.terminate()
+                worker.process.join()
+                self.log(worker, 'stopped')
@@ -1,15 +1,53 @@
 """Unit tests for emencia.django.newsletter"""
 from datetime import datetime
 from datetime import timedelta
+import os
+import sys
+import time
+import signal
+import asyncio
+import threading
 import smtplib
+import email
+from unittest import mock
 from tempfile import NamedTemporaryFile
+from tempfile import mkdtemp
 
 from django.test import TestCase
+from django.test import SimpleTestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
 from django.http import Http404
 from django.db import IntegrityError
+from django.db.models import F
 from django.core.files import File
+from django.utils import timezone
 
 from emencia.django.newsletter.mailer import Mailer
+from emencia.django.newsletter.mailer import SMTPMailer
+from emencia.django.newsletter.mailer import html2text
+from emencia.django.newsletter import outbox
+from emencia.django.newsletter.asyncmailer import AsyncMailer
+from emencia.django.newsletter.journal import StatusJournal
+from emencia.django.newsletter.scheduler import NewsletterScheduler
+from emencia.django.newsletter.supervisor import Supervisor
+from emencia.django.newsletter.retry import RetryQueue
+from emencia.django.newsletter.retry import is_transient
+from emencia.django.newsletter.throttle import Throttle
+from emencia.django.newsletter.domains import DomainGate
+from emencia.django.newsletter.domains import interleave
+from emencia.django.newsletter.session import SMTPSession
+from emencia.django.newsletter.session import ResumingContext
+from emencia.django.newsletter.session import resuming_context
+from emencia.django.newsletter import pipelining
+from emencia.django.newsletter import spool
+from emencia.django.newsletter.timings import Histogram
+from emencia.django.newsletter.timings import timings_recorded
+from emencia.django.newsletter.wakeup import Listener
+from emencia.django.newsletter.wakeup import notify
+from emencia.django.newsletter.journal import replay_journals
+from emencia.django.newsletter.journal import insert_statuses
+from emencia.django.newsletter.journal import recount_newsletter
 from emencia.django.newsletter.models import Link
 from emencia.django.newsletter.models import Contact
 from emencia.django.newsletter.models import MailingList
@@ -17,8 +55,13 @@ from emencia.django.newsletter.models import SMTPServer
 from emencia.django.newsletter.models import Newsletter
 from emencia.django.newsletter.models import Attachment
 from emencia.django.newsletter.models import ContactMailingStatus
+from emencia.django.newsletter.models import Delivery
+from emencia.django.newsletter.models import ServerCredits
+from emencia.django.newsletter.models import PoolServer
 from emencia.django.newsletter.utils.tokens import tokenize
 from emencia.django.newsletter.utils.tokens import untokenize
+from emencia.django.newsletter.utils.newsletter import is_contact_independent
+from emencia.django.newsletter.utils.smtpsink import SMTPSink
 from emencia.django.newsletter.utils.statistics import get_newsletter_opening_statistics
 from emencia.django.newsletter.utils.statistics import get_newsletter_on_site_opening_statistics
 from emencia.django.newsletter.utils.statistics import get_newsletter_unsubscription_statistics
@@ -34,10 +77,37 @@ class FakeSMTP(object):
         self.mails_sent += 1
         return {}
 
+    def noop(self):
+        return (250, b'OK')
+
     def quit(*ka, **kw):
         pass
 
 
+class FakeSMTPBatch(FakeSMTP):
+    """Refuse the first recipient of each transaction"""
+    transactions = ()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        self.transactions += ((to_addrs, msg),)
+        self.mails_sent += len(to_addrs) - 1
+        return {to_addrs[0]: (550, b'No such user')}
+
+
+class FakeSMTPGreylist(FakeSMTP):
+    """Defer the first attempt to each recipient"""
+
+    def __init__(self):
+        self.deferred = set()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if to_addrs not in self.deferred:
+            self.deferred.add(to_addrs)
+            raise smtplib.SMTPRecipientsRefused(
+                {to_addrs: (450, b'Greylisted, try again later')})
+        return super(FakeSMTPGreylist, self).sendmail(from_addr, to_addrs, msg)
+
+
 class FakeSMTPRefuse(object):
     mails_sent = 0
 
@@ -48,6 +118,17 @@ class FakeSMTPRefuse(object):
         pass
 
 
+def crashing_worker(server_id, max_messages, verbose):
+    sys.exit(1)
+
+
+def stopping_worker(server_id, max_messages, verbose):
+    # finishes its mail on SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    time.sleep(10)
+    sys.exit(1)
+
+
 class SMTPServerTestCase(TestCase):
     """Tests for the SMTPServer model"""
 
@@ -82,30 +163,110 @@ class SMTPServerTestCase(TestCase):
         self.server.mails_hour = 42
         self.assertEqual(self.server.credits(), 42)
 
-        # Testing credits status, with multiple server case
-        ContactMailingStatus.objects.create(newsletter=self.newsletter,
-                                            contact=self.contact,
-                                            status=ContactMailingStatus.SENT)
+        # Testing credits consumption, with multiple server case
+        self.assertTrue(self.server.consume_credits())
         self.assertEqual(self.server.credits(), 41)
-        ContactMailingStatus.objects.create(newsletter=self.newsletter,
-                                            contact=self.contact,
-                                            status=ContactMailingStatus.SENT_TEST)
-        self.assertEqual(self.server.credits(), 40)
-        # Testing with a fake status
-        ContactMailingStatus.objects.create(newsletter=self.newsletter,
-                                            contact=self.contact,
-                                            status=ContactMailingStatus.ERROR)
-        self.assertEqual(self.server.credits(), 40)
-        # Testing with a second newsletter sharing the server
-        ContactMailingStatus.objects.create(newsletter=self.newsletter_2,
-                                            contact=self.contact,
-                                            status=ContactMailingStatus.SENT)
+        self.assertTrue(self.server.consume_credits(2))
         self.assertEqual(self.server.credits(), 39)
-        # Testing with a third newsletter with another server
-        ContactMailingStatus.objects.create(newsletter=self.newsletter_3,
-                                            contact=self.contact,
-                                            status=ContactMailingStatus.SENT)
+        # Testing with another server
+        self.server_2.mails_hour = 42
+        self.assertTrue(self.server_2.consume_credits())
         self.assertEqual(self.server.credits(), 39)
+        # Testing the limit
+        self.assertFalse(self.server.consume_credits(40))
+        self.assertTrue(self.server.consume_credits(39))
+        self.assertEqual(self.server.credits(), 0)
+        self.assertFalse(self.server.consume_credits())
+        # Testing the credits given back over time
+        ServerCredits.objects.filter(server=self.server).update(
+            last_update=F('last_update') - 1800)
+        self.assertEqual(self.server.credits(), 21)
+        self.server.mails_hour = 0
+        self.assertTrue(self.server.consume_credits(20000))
+
+    def test_adaptive_rate(self):
+        self.server.mails_hour = 7200
+        self.server.adaptive_rate = True
+        throttle = Throttle(self.server)
+        self.assertEqual(throttle.rate, 3600)
+        self.assertEqual(throttle.delay(), 1.0)
+
+        throttle.record(0.1)
+        self.assertEqual(throttle.rate, 3610)
+        throttle.record(0.1, smtplib.SMTPDataError(451, b'Slow down'))
+        self.assertEqual(throttle.rate, 1805)
+        # the replies to the mails sent before the decrease
+        throttle.record(0.1, smtplib.SMTPDataError(421, b'Slow down'))
+        self.assertEqual(throttle.rate, 1805)
+        throttle.last_decrease = 0
+        throttle.record(1.0)
+        self.assertEqual(throttle.rate, 902.5)
+        throttle.rate = 7195
+        throttle.record(0.1)
+        self.assertEqual(throttle.rate, 7200)
+
+        throttle.report()
+        self.assertEqual(SMTPServer.objects.get(pk=self.server.pk).effective_rate, 7200)
+
+    def test_rate_schedule(self):
+        self.server.mails_hour = 10000
+        self.server.rate_schedule = 'day 0: 500\nday 20: 10500\n22:00-06:00: 100'
+        self.server.warmup_start = datetime(2024, 1, 1).date()
+        self.assertEqual(self.server.rate(datetime(2024, 1, 1, 12)), 500)
+        self.assertEqual(self.server.rate(datetime(2024, 1, 11, 12)), 5500)
+        self.assertEqual(self.server.rate(datetime(2024, 2, 1, 12)), 10000)
+        self.assertEqual(self.server.rate(datetime(2024, 2, 1, 23)), 100)
+
+        self.assertEqual(self.server.completion(1000, datetime(2024, 1, 1, 12)),
+                         datetime(2024, 1, 1, 14))
+        # 5000 mails until 22:00, 800 during the night
+        self.assertEqual(self.server.completion(6000, datetime(2024, 1, 1, 12)),
+                         datetime(2024, 1, 2, 6, 12))
+        self.server.rate_schedule = ''
+        self.server.mails_hour = 2
+        Newsletter.objects.filter(server=self.server).update(status=Newsletter.WAITING)
+        self.newsletter_2.refresh_from_db(fields=['status'])
+        # after the mail of the first newsletter
+        completion = self.newsletter_2.projected_completion() - timezone.now()
+        self.assertTrue(timedelta(minutes=59) < completion <= timedelta(hours=1))
+        with override_settings(USE_TZ=True):
+            sending_date = timezone.now() - timedelta(days=1)
+            Newsletter.objects.filter(server=self.server).update(sending_date=sending_date)
+            # read aware from the database, naive like by default on newsletter_2
+            self.newsletter_2.sending_date = timezone.make_naive(sending_date)
+            completion = self.newsletter_2.projected_completion() - timezone.now()
+            self.assertTrue(timedelta(minutes=59) < completion <= timedelta(hours=1))
+        self.server.mails_hour = 0
+        self.assertEqual(self.server.completion(1000), None)
+
+    def test_session(self):
+        self.server.session_messages = 2
+        self.server.connect = lambda tls_context=None: FakeSMTP()
+        smtp = FakeSMTP()
+        session = SMTPSession(self.server, smtp)
+        self.assertIs(session.get(), smtp)
+        session.sent()
+        self.assertIs(session.get(), smtp)
+        session.sent()
+        # recycled after 2 mails
+        self.assertIsNot(session.get(), smtp)
+        self.assertEqual(session.messages, 0)
+
+        self.assertEqual(session.idle_timeout(), None)
+        self.server.keepalive = 60
+        smtp = session.get()
+        session.used -= 60
+        self.assertEqual(session.idle_timeout(), 0)
+        session.keepalive()
+        self.assertTrue(session.idle_timeout() > 59)
+        self.assertIs(session.get(), smtp)
+
+        # with the client certificate of the settings
+        with override_settings(EMAIL_SSL_CERTFILE='client.pem',
+                               EMAIL_SSL_KEYFILE='client.key'), \
+             mock.patch.object(ResumingContext, 'load_cert_chain') as load_cert_chain:
+            resuming_context()
+        load_cert_chain.assert_called_once_with('client.pem', 'client.key')
 
     def test_custom_headers(self):
         self.assertEqual(self.server.custom_headers, {})
@@ -278,15 +439,41 @@ class MailerTestCase(TestCase):
         self.assertEqual(len(mailer.expedition_list), 2)
         self.assertFalse(self.contacts[0] in mailer.expedition_list)
 
+    def test_iter_expedition_list(self):
+        mailer = Mailer(self.newsletter)
+        self.assertEqual(mailer.expedition_list.count(), 4)
+        self.assertEqual(list(mailer.iter_expedition_list()), self.contacts)
+        # the cursor follows the contacts processed in a row
+        mailer.expedition_cursor.processed(self.contacts[1])
+        mailer.save_cursor()
+        self.assertEqual(Newsletter.objects.get(pk=self.newsletter.pk).cursor, 0)
+        mailer.expedition_cursor.processed(self.contacts[0])
+        mailer.save_cursor()
+        self.assertEqual(Newsletter.objects.get(pk=self.newsletter.pk).cursor,
+                         self.contacts[1].pk)
+
+        ContactMailingStatus.objects.create(newsletter=self.newsletter,
+                                            contact=self.contacts[0],
+                                            status=ContactMailingStatus.SENT)
+        self.assertEqual(list(mailer.iter_expedition_list()), self.contacts[2:])
+        for contact in self.contacts[2:]:
+            mailer.expedition_cursor.processed(contact)
+        mailer.save_cursor()
+        # the next iteration starts again for the contacts not sent
+        self.assertEqual(list(mailer.iter_expedition_list()), self.contacts[1:])
+
+        # one mail sent within the hour
+        self.server.mails_hour = 3
+        self.server.consume_credits()
+        self.assertEqual(list(mailer.iter_expedition_list()), self.contacts[1:3])
+
     def test_can_send(self):
         mailer = Mailer(self.newsletter)
         self.assertTrue(mailer.can_send)
 
         # Checks credits
         self.server.mails_hour = 1
-        ContactMailingStatus.objects.create(newsletter=self.newsletter,
-                                            contact=self.contacts[0],
-                                            status=ContactMailingStatus.SENT)
+        self.server.consume_credits()
         mailer = Mailer(self.newsletter)
         self.assertFalse(mailer.can_send)
         self.server.mails_hour = 10
@@ -339,9 +526,7 @@ class MailerTestCase(TestCase):
         self.assertEqual(self.newsletter.status, Newsletter.SENDING)
 
         for contact in self.contacts:
-            ContactMailingStatus.objects.create(newsletter=self.newsletter,
-                                                contact=contact,
-                                                status=ContactMailingStatus.SENT)
+            mailer.update_contact_status(contact, None)
         mailer.update_newsletter_status()
         self.assertEqual(self.newsletter.status, Newsletter.SENT)
 
@@ -370,6 +555,131 @@ class MailerTestCase(TestCase):
             status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 4)
         self.assertEqual(self.newsletter.status, Newsletter.SENT)
 
+    def test_unsubscribed_while_sending(self):
+        self.server.mails_hour = 3
+        self.server.save()
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = FakeSMTP()
+        mailer.run()
+        self.assertEqual(self.newsletter.status, Newsletter.SENDING)
+
+        # the last recipient unsubscribes before the next hour
+        self.mailinglist.unsubscribers.add(self.contacts[3])
+        self.server.mails_hour = 0
+        self.server.save()
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = FakeSMTP()
+        mailer.run()
+        self.assertEqual(mailer.smtp.mails_sent, 0)
+        self.assertEqual(self.newsletter.status, Newsletter.SENT)
+
+    def test_send_batches(self):
+        self.newsletter.identical_content = True
+        self.newsletter.save()
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = FakeSMTPBatch()
+        mailer.run()
+
+        self.assertEqual(len(mailer.smtp.transactions), 1)
+        recipients, message = mailer.smtp.transactions[0]
+        self.assertEqual(recipients, [contact.email for contact in self.contacts])
+        message = email.message_from_bytes(message)
+        self.assertEqual(message['To'], 'undisclosed-recipients:;')
+        self.assertEqual(message['List-Unsubscribe'], None)
+        self.assertEqual(len(message.get_payload()), 2)
+        self.assertEqual(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.INVALID).get().contact, self.contacts[0])
+        self.assertEqual(self.newsletter.mails_sent(), 3)
+
+        # the slots of the domains are freed when no server has the credits
+        mailer = Mailer(self.newsletter)
+        mailer.domains = DomainGate(rates={}, concurrency={'domain.com': 4})
+        mailer.open_session = lambda sessions, count: (None, None)
+        mailer.send_batches({}, mailer.domains.dispatch(self.contacts), 4)
+        self.assertEqual(mailer.domains.inflight['domain.com'], set())
+
+    def test_send_batches_domains(self):
+        self.newsletter.identical_content = True
+        self.newsletter.save()
+        mailer = Mailer(self.newsletter)
+        mailer.domains = DomainGate(rates={}, concurrency={'domain.com': 2})
+        mailer.smtp = FakeSMTPBatch()
+        mailer.run()
+
+        # the batches cut short at the concurrency of the domain
+        self.assertEqual([recipients for recipients, message in mailer.smtp.transactions],
+                         [[contact.email for contact in self.contacts[:2]],
+                          [contact.email for contact in self.contacts[2:]]])
+        self.assertEqual(mailer.domains.inflight['domain.com'], set())
+
+    def test_retries(self):
+        mailer = Mailer(self.newsletter)
+        mailer.retries = RetryQueue(attempts=1, delay=0.01)
+        mailer.smtp = FakeSMTPGreylist()
+        mailer.run()
+
+        self.assertEqual(mailer.smtp.mails_sent, 4)
+        self.assertEqual(ContactMailingStatus.objects.filter(
+            newsletter=self.newsletter).exclude(
+            status=ContactMailingStatus.SENT).count(), 0)
+        self.assertEqual(self.newsletter.status, Newsletter.SENT)
+
+        self.assertTrue(is_transient(smtplib.SMTPServerDisconnected()))
+        self.assertTrue(is_transient(smtplib.SMTPDataError(421, b'Closing')))
+        self.assertFalse(is_transient(smtplib.SMTPDataError(554, b'Rejected')))
+        self.assertFalse(is_transient(smtplib.SMTPRecipientsRefused(
+            {'test1@domain.com': (550, b'No such user')})))
+
+    def test_pool(self):
+        server = SMTPServer.objects.create(name='Pool SMTP',
+                                           host='smtp.pool.com',
+                                           mails_hour=100,
+                                           tls=False)
+        PoolServer.objects.create(newsletter=self.newsletter, server=server, weight=1000)
+        self.assertEqual(self.newsletter.pool_servers(),
+                         [(self.server, 1), (server, 1000)])
+
+        def connect(tls_context=None):
+            raise OSError('Connection refused')
+        mailer = Mailer(self.newsletter)
+        mailer.smtp = FakeSMTP()
+        mailer.pool.members[1].server.connect = connect
+        self.assertEqual(mailer.pool.credits(), 200)
+        mailer.run()
+
+        # the share of the server down is sent by the other one
+        self.assertEqual(mailer.smtp.mails_sent, 4)
+        self.assertFalse(mailer.pool.members[1].healthy())
+        self.assertEqual(mailer.pool.credits(), 96)
+        self.assertEqual(self.newsletter.status, Newsletter.SENT)
+
+    def test_timings(self):
+        recorded = []
+
+        def receiver(sender, newsletter, timings, **kwargs):
+            recorded.append((newsletter, timings))
+        timings_recorded.connect(receiver)
+        try:
+            mailer = Mailer(self.newsletter)
+            mailer.smtp = FakeSMTP()
+            mailer.run()
+        finally:
+            timings_recorded.disconnect(receiver)
+
+        [(newsletter, timings)] = recorded
+        self.assertEqual(newsletter, self.newsletter)
+        self.assertEqual(set(timings.stages), set(['title', 'render', 'tracking', 'html2text',
+                                                   'serialize', 'smtp', 'status']))
+        self.assertEqual(timings.stages['title'].count, 4)
+        self.assertEqual(timings.stages['smtp'].count, 4)
+        self.assertEqual(timings.servers[self.server]['status'].count, 4)
+
+        histogram = Histogram()
+        for seconds in (0.002, 0.002, 0.002, 0.3):
+            histogram.add(seconds)
+        self.assertEqual(histogram.percentile(50), 0.0025)
+        self.assertEqual(histogram.percentile(100), 0.3)
+
     def test_recipients_refused(self):
         server = SMTPServer.objects.create(name='Local SMTP',
                                            host='localhost',
@@ -393,6 +703,545 @@ class MailerTestCase(TestCase):
             status=ContactMailingStatus.INVALID, newsletter=self.newsletter).count(), 1)
 
 
+    def test_build_email_content_static(self):
+        self.newsletter.content = '<a href="http://link.1">Link</a>{{ unsubscribe }}'
+        mailer = Mailer(self.newsletter)
+        self.assertTrue(mailer.content_is_static)
+        contents = [mailer.build_email_content(contact)
+                    for contact in self.contacts]
+        self.assertEqual(Link.objects.filter(url='http://link.1').count(), 1)
+
+        for contact, content in zip(self.contacts, contents):
+            uidb36, token = tokenize(contact)
+            self.assertEqual(content, mailer.render_email_content(
+                contact, uidb36, token))
+            self.assertTrue('%s-%s' % (uidb36, token) in content)
+            self.assertFalse(mailer.placeholder_token in content)
+
+    def test_build_text_content(self):
+        self.newsletter.content = '<p>%s</p><a href="http://link.1">Link</a>' \
+                                  '{{ unsubscribe }}' % ('Text ' * 40)
+        contacts = self.contacts + [Contact.objects.create(pk=1000, email='test5@domain.com')]
+        mailer = Mailer(self.newsletter)
+        for contact in contacts:
+            content = mailer.build_email_content(contact)
+            self.assertEqual(mailer.build_text_content(contact, content),
+                             html2text(content))
+        self.assertEqual(len(mailer.compiled_texts), 2)
+        self.assertFalse((None, None) in mailer.compiled_texts.values())
+
+        self.newsletter.content = 'Hello {{ contact.email }}'
+        mailer = Mailer(self.newsletter)
+        for contact in contacts:
+            self.assertEqual(mailer.build_text_content(
+                contact, mailer.build_email_content(contact)),
+                             'Hello %s\n\n' % contact.email)
+        self.assertEqual(list(mailer.compiled_texts.values()), [(None, None)])
+
+    def test_serialize_message(self):
+        mailer = Mailer(self.newsletter)
+        attachments = mailer.build_attachments()
+        mailer.attachments = mailer.encode_attachments(attachments)
+
+        message = mailer.build_message(self.contacts[0])
+        spliced = mailer.serialize_message(self.contacts[0])
+        for attachment in attachments:
+            message.attach(attachment)
+        parsed = email.message_from_bytes(spliced)
+        self.assertEqual(len(parsed.get_payload()), 2)
+        self.assertEqual(parsed.get_payload()[1].get_filename(), 'Test attachment')
+        self.assertEqual([part.get_content_type() for part in parsed.walk()],
+                         [part.get_content_type() for part in message.walk()])
+
+    def test_serialize_message_conformance(self):
+        self.server.headers = 'X-Campaign: été'
+        self.server.save()
+        self.newsletter.title = 'Newsletter pour {{ contact.email }} à lire'
+        mailer = Mailer(self.newsletter)
+        attachments = mailer.build_attachments()
+        mailer.attachments = mailer.encode_attachments(attachments)
+
+        for contact in self.contacts:
+            message = mailer.build_message(contact)
+            for attachment in attachments:
+                message.attach(attachment)
+            expected = email.message_from_string(message.as_string())
+            parsed = email.message_from_bytes(mailer.serialize_message(contact))
+            for part, expected_part in zip(parsed.walk(), expected.walk()):
+                self.assertEqual(part.items(), expected_part.items())
+                if not part.is_multipart():
+                    self.assertEqual(part.get_payload(decode=True),
+                                     expected_part.get_payload(decode=True))
+            self.assertEqual(len(list(parsed.walk())), len(list(expected.walk())))
+
+    def test_spool(self):
+        directory = mkdtemp()
+        self.assertEqual(spool.prerender(self.newsletter, directory=directory), 4)
+        self.assertEqual(spool.prerender(self.newsletter, directory=directory), 0)
+        mailer = Mailer(self.newsletter)
+        mailer.spool = spool.Spool.open(self.newsletter, directory)
+        mailer.spool_opened = True
+        self.assertEqual(len(mailer.spool), 4)
+        message = email.message_from_bytes(mailer.serialize_message(self.contacts[1]))
+        self.assertEqual(message['To'], 'test2@domain.com')
+        self.assertEqual(message.get_payload()[1].get_filename(), 'Test attachment')
+        self.assertEqual(mailer.spool.get(Contact(pk=42, email='test@domain.com')), None)
+
+        # stale once the content changes
+        self.newsletter.content = 'New content'
+        self.assertEqual(spool.Spool.open(self.newsletter, directory), None)
+        self.assertEqual(spool.prerender(self.newsletter, directory=directory), 4)
+        self.assertEqual(spool.spooled(directory), [self.newsletter.pk])
+
+
+class NewsletterUtilsTestCase(TestCase):
+    """Tests for the newsletter utils"""
+
+    def test_is_contact_independent(self):
+        self.assertTrue(is_contact_independent('<p>Hello</p>'))
+        self.assertTrue(is_contact_independent('{{ unsubscribe }} {% if newsletter %}{% endif %}'))
+        self.assertFalse(is_contact_independent('Hello {{ contact.email }}'))
+        self.assertFalse(is_contact_independent('{% if contact %}Hello{% endif %}'))
+        self.assertFalse(is_contact_independent('{{ uidb36 }}'))
+        self.assertFalse(is_contact_independent('{% include "footer.html" %}'))
+
+
+class DomainsTestCase(TestCase):
+    """Tests for the dispatch by domain"""
+
+    def setUp(self):
+        self.contacts = [Contact(id=i, email=email) for i, email in enumerate([
+            'a@gmail.com', 'b@gmail.com', 'c@gmail.com', 'd@gmail.com',
+            'a@free.fr', 'b@free.fr'])]
+
+    def test_interleave(self):
+        self.assertEqual([contact.email for contact in interleave(self.contacts)],
+                         ['a@gmail.com', 'a@free.fr', 'b@gmail.com',
+                          'c@gmail.com', 'b@free.fr', 'd@gmail.com'])
+
+    def test_dispatch(self):
+        gate = DomainGate(rates={'gmail.com': 3600}, concurrency={'free.fr': 1})
+        contacts = gate.dispatch(self.contacts, wait=False)
+        self.assertEqual(next(contacts).email, 'a@gmail.com')
+        self.assertEqual(next(contacts).email, 'a@free.fr')
+        # the other contacts wait for their domain
+        self.assertEqual(next(contacts), 0.1)
+        gate.release(self.contacts[4])
+        self.assertEqual(next(contacts).email, 'b@free.fr')
+        self.assertTrue(0.5 < next(contacts) <= 1)
+        gate.next_slot['gmail.com'] = 0
+        self.assertEqual(next(contacts).email, 'b@gmail.com')
+
+
+class AsyncMailerTestCase(TransactionTestCase):
+    """Tests for the AsyncMailer object against a SMTPSink"""
+
+    def setUp(self):
+        self.sink = SMTPSink(refused=['test4@domain.com'])
+        self.sink.start_thread()
+        self.server = SMTPServer.objects.create(name='Test SMTP',
+                                                host=self.sink.host,
+                                                port=self.sink.port,
+                                                max_connections=3,
+                                                tls=False, ssl=False)
+        self.contacts = [Contact.objects.create(email='test%i@domain.com' % i)
+                         for i in range(1, 11)]
+        self.mailinglist = MailingList.objects.create(name='Test MailingList')
+        self.mailinglist.subscribers.add(*self.contacts)
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    content='Test Newsletter Content',
+                                                    slug='test-newsletter',
+                                                    mailing_list=self.mailinglist,
+                                                    server=self.server,
+                                                    status=Newsletter.WAITING)
+
+    def tearDown(self):
+        self.sink.stop_thread()
+
+    def test_run(self):
+        mailer = AsyncMailer([self.server], stop_when_idle=True)
+        asyncio.run(mailer.run())
+
+        self.assertEqual(len(self.sink.messages), 9)
+        self.assertEqual(self.newsletter.mails_sent(), 9)
+        self.assertEqual(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.INVALID, newsletter=self.newsletter).count(), 1)
+        self.assertEqual(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                         Newsletter.SENDING)
+
+    def test_run_identical(self):
+        self.newsletter.identical_content = True
+        self.newsletter.save()
+        mailer = AsyncMailer([self.server], stop_when_idle=True)
+        asyncio.run(mailer.run())
+
+        # one transaction by chunk of the expedition list, the refused
+        # recipient left out
+        self.assertLess(len(self.sink.messages), 9)
+        self.assertEqual(sorted(email for sender, recipients, data in self.sink.messages
+                                for email in recipients),
+                         sorted(contact.email for contact in self.contacts
+                                if contact.email != 'test4@domain.com'))
+        self.assertEqual(self.newsletter.mails_sent(), 9)
+        self.assertEqual(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.INVALID, newsletter=self.newsletter).count(), 1)
+
+
+class PipeliningTestCase(TestCase):
+    """Tests for the sending with PIPELINING against a SMTPSink"""
+
+    def setUp(self):
+        self.sink = SMTPSink(refused=['test2@domain.com', 'test3@domain.com'])
+        self.sink.start_thread()
+        self.smtp = smtplib.SMTP(self.sink.host, self.sink.port)
+
+    def tearDown(self):
+        self.smtp.quit()
+        self.sink.stop_thread()
+
+    def test_sendmail(self):
+        refused = pipelining.sendmail(self.smtp, 'sender@domain.com',
+                                      ['test1@domain.com', 'test2@domain.com'],
+                                      b'Subject: Test\n\n.Test\n')
+        self.assertEqual(refused, {'test2@domain.com': (550, b'No such user')})
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            pipelining.sendmail(self.smtp, 'sender@domain.com',
+                                'test3@domain.com', b'Subject: Test\n\nTest\n')
+        # the connection is usable after a refused message
+        self.assertEqual(pipelining.sendmail(self.smtp, 'sender@domain.com',
+                                             'test4@domain.com', 'Subject: Test\n\nTest'), {})
+
+        self.assertEqual([recipients for sender, recipients, data in self.sink.messages],
+                         [['test1@domain.com'], ['test4@domain.com']])
+        self.assertEqual(self.sink.messages[0][2], b'Subject: Test\r\n\r\n..Test\r\n')
+
+
+class SMTPSinkMailerTestCase(TransactionTestCase):
+    """Tests for the Mailer sending to a SMTPSink"""
+
+    def setUp(self):
+        self.sink = SMTPSink()
+        self.sink.start_thread()
+        self.server = SMTPServer.objects.create(name='Sink SMTP',
+                                                host=self.sink.host,
+                                                port=self.sink.port,
+                                                tls=False, ssl=False)
+        self.contacts = [Contact.objects.create(email='test%i@domain.com' % i)
+                         for i in range(20)]
+        self.mailinglist = MailingList.objects.create(name='Test MailingList')
+        self.mailinglist.subscribers.add(*self.contacts)
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    content='Hello {{ contact.email }}',
+                                                    slug='test-newsletter',
+                                                    mailing_list=self.mailinglist,
+                                                    server=self.server,
+                                                    status=Newsletter.WAITING)
+
+    def tearDown(self):
+        self.sink.stop_thread()
+
+    def assertSentOnce(self, *sinks):
+        self.assertEqual(sorted(recipients[0] for sink in sinks or [self.sink]
+                                for sender, recipients, data in sink.messages),
+                         sorted(contact.email for contact in self.contacts))
+        statuses = ContactMailingStatus.objects.filter(newsletter=self.newsletter)
+        self.assertEqual(sorted(statuses.values_list('contact', flat=True)),
+                         sorted(contact.pk for contact in self.contacts))
+        self.assertFalse(statuses.exclude(status=ContactMailingStatus.SENT).exists())
+        self.newsletter.refresh_from_db()
+        self.assertEqual(self.newsletter.status, Newsletter.SENT)
+        self.assertEqual(self.newsletter.cursor, self.contacts[-1].pk)
+
+    def test_run_parallel(self):
+        self.sink.latency = 0.01
+        self.server.max_connections = 3
+        self.server.save()
+        sink = SMTPSink(latency=0.01)
+        sink.start_thread()
+        self.addCleanup(sink.stop_thread)
+        server = SMTPServer.objects.create(name='Pool SMTP', host=sink.host,
+                                           port=sink.port, tls=False, ssl=False)
+        PoolServer.objects.create(newsletter=self.newsletter, server=server, weight=1)
+        Mailer(Newsletter.objects.get(pk=self.newsletter.pk)).run()
+        self.assertSentOnce(self.sink, sink)
+        # the connections of each server within its max_connections
+        self.assertEqual(self.sink.peak_connections, 3)
+        self.assertEqual(sink.peak_connections, 1)
+
+    def test_run_render_processes(self):
+        with mock.patch('emencia.django.newsletter.mailer.RENDER_PROCESSES', 2):
+            Mailer(self.newsletter).run()
+        self.assertSentOnce()
+
+    def test_run_render_processes_domains(self):
+        mailer = Mailer(self.newsletter)
+        mailer.domains = DomainGate(rates={}, concurrency={'domain.com': 1})
+        with mock.patch('emencia.django.newsletter.mailer.RENDER_PROCESSES', 2):
+            mailer.run()
+        self.assertSentOnce()
+        self.assertEqual(mailer.domains.inflight['domain.com'], set())
+
+    def test_run_render_processes_retries(self):
+        self.sink.greylist = True
+        mailer = Mailer(self.newsletter)
+        mailer.retries = RetryQueue(delay=0.01)
+        with mock.patch('emencia.django.newsletter.mailer.RENDER_PROCESSES', 2):
+            mailer.run()
+        self.assertSentOnce()
+        self.assertEqual(len(self.sink.greylisted), 20)
+
+
+class StatusJournalTestCase(TestCase):
+    """Tests for the StatusJournal object"""
+
+    def setUp(self):
+        self.server = SMTPServer.objects.create(name='Test SMTP',
+                                                host='smtp.domain.com',
+                                                tls=False)
+        self.contacts = [Contact.objects.create(email='test1@domain.com'),
+                         Contact.objects.create(email='test2@domain.com')]
+        self.mailinglist = MailingList.objects.create(name='Test MailingList')
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    content='Test Newsletter Content',
+                                                    slug='test-newsletter',
+                                                    mailing_list=self.mailinglist,
+                                                    server=self.server)
+        self.directory = mkdtemp()
+
+    def test_batch(self):
+        journal = StatusJournal(self.directory, batch_size=2, delay=60)
+        journal.add(self.newsletter, self.contacts[0], ContactMailingStatus.SENT)
+        self.assertEqual(self.newsletter.mails_sent(), 0)
+        journal.add(self.newsletter, self.contacts[1], ContactMailingStatus.SENT)
+        self.assertEqual(self.newsletter.mails_sent(), 2)
+        journal.add(self.newsletter, self.contacts[1], ContactMailingStatus.ERROR)
+        journal.close()
+        self.assertEqual(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.ERROR).count(), 1)
+
+    def test_replay(self):
+        journal = StatusJournal(self.directory, batch_size=10, delay=60)
+        journal.add(self.newsletter, self.contacts[0], ContactMailingStatus.SENT)
+        journal.add(self.newsletter, self.contacts[1], ContactMailingStatus.ERROR)
+        journal.add(self.newsletter, self.contacts[1], ContactMailingStatus.ERROR)
+        # the first status inserted before the journal is truncated
+        insert_statuses(journal.buffer[:1])
+        self.assertEqual(replay_journals(self.directory), 0)
+        # the process crashes, releasing the lock on its journal
+        journal.fd.close()
+        self.assertEqual(replay_journals(self.directory), 2)
+        self.assertEqual(self.newsletter.mails_sent(), 1)
+        self.assertEqual(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.ERROR).count(), 2)
+
+    def test_replay_deleted(self):
+        journal = StatusJournal(self.directory, batch_size=10, delay=60)
+        journal.add(self.newsletter, self.contacts[0], ContactMailingStatus.SENT)
+        journal.add(self.newsletter, self.contacts[1], ContactMailingStatus.SENT)
+        journal.fd.close()
+        # the contact is deleted before the journal is replayed
+        self.contacts[1].delete()
+        self.assertEqual(replay_journals(self.directory), 1)
+        self.assertEqual(self.newsletter.mails_sent(), 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_replay_other_database(self):
+        journal = StatusJournal(self.directory, batch_size=10, delay=60)
+        journal.add(self.newsletter, self.contacts[0], ContactMailingStatus.SENT)
+        journal.fd.close()
+        with mock.patch('emencia.django.newsletter.journal.database_key',
+                        return_value='other'):
+            self.assertEqual(replay_journals(self.directory), 0)
+        self.assertTrue(os.path.exists(journal.path))
+        self.assertEqual(replay_journals(self.directory), 1)
+
+    def test_counters(self):
+        journal = StatusJournal(self.directory, batch_size=10, delay=60)
+        journal.add(self.newsletter, self.contacts[0], ContactMailingStatus.SENT)
+        journal.add(self.newsletter, self.contacts[1], ContactMailingStatus.INVALID)
+        journal.add(self.newsletter, self.contacts[1], ContactMailingStatus.SENT_TEST)
+        journal.close()
+        self.newsletter.refresh_from_db()
+        self.assertEqual((self.newsletter.sent_count, self.newsletter.error_count,
+                          self.newsletter.invalid_count), (1, 0, 1))
+
+        Newsletter.objects.filter(pk=self.newsletter.pk).update(sent_count=5)
+        ContactMailingStatus.objects.create(newsletter=self.newsletter,
+                                            contact=self.contacts[1],
+                                            status=ContactMailingStatus.ERROR)
+        self.assertEqual(recount_newsletter(self.newsletter), {
+            'sent_count': 1, 'error_count': 1, 'invalid_count': 1})
+        self.assertEqual(Newsletter.objects.get(pk=self.newsletter.pk).sent_count, 1)
+
+
+class OutboxTestCase(TestCase):
+    """Tests for the outbox of the newsletters"""
+
+    def setUp(self):
+        self.server = SMTPServer.objects.create(name='Test SMTP',
+                                                host='smtp.domain.com',
+                                                tls=False)
+        self.contacts = [Contact.objects.create(email='test%i@domain.com' % i)
+                         for i in range(5)]
+        self.mailinglist = MailingList.objects.create(name='Test MailingList')
+        self.mailinglist.subscribers.add(*self.contacts)
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    content='Test Newsletter Content',
+                                                    slug='test-newsletter',
+                                                    mailing_list=self.mailinglist,
+                                                    server=self.server,
+                                                    status=Newsletter.WAITING)
+
+    def test_claim(self):
+        contacts = self.mailinglist.expedition_set()
+        self.assertEqual(outbox.fill(self.newsletter, contacts), 5)
+        self.assertEqual(outbox.fill(self.newsletter, contacts), 0)
+
+        lease, claimed = outbox.claim(self.newsletter, 3)
+        self.assertEqual(claimed, self.contacts[:3])
+        other_lease, other_claimed = outbox.claim(self.newsletter, 3)
+        self.assertEqual(other_claimed, self.contacts[3:])
+        self.assertEqual(outbox.claim(self.newsletter, 3)[1], [])
+
+        # the sender of the first lease crashed
+        Delivery.objects.filter(lease=lease).update(
+            lease_expiration=datetime.now() - timedelta(seconds=1))
+        self.assertEqual(outbox.claim(self.newsletter, 3)[1], self.contacts[:3])
+
+        outbox.release(self.newsletter, [self.contacts[3].pk], [other_lease])
+        self.assertEqual(outbox.claim(self.newsletter, 3)[1], self.contacts[4:])
+        self.assertEqual(Delivery.objects.count(), 4)
+
+    def test_iter_outbox(self):
+        mailer = Mailer(self.newsletter)
+        for contact in mailer.iter_outbox():
+            mailer.update_contact_status(contact, None)
+        self.assertEqual(Delivery.objects.count(), 0)
+        mailer.update_newsletter_status()
+        self.assertEqual(self.newsletter.mails_sent(), 5)
+
+
+class SchedulerTestCase(TestCase):
+    """Tests for the scheduler of the SMTPMailer"""
+
+    def setUp(self):
+        self.server = SMTPServer.objects.create(name='Test SMTP',
+                                                host='smtp.domain.com',
+                                                tls=False)
+        self.mailinglist = MailingList.objects.create(name='Test MailingList')
+        self.scheduler = NewsletterScheduler(self.server, poll_delay=7200)
+
+    def create_newsletter(self, slug, **kwargs):
+        return Newsletter.objects.create(title=slug, content='Test Newsletter Content',
+                                         slug=slug, mailing_list=self.mailinglist,
+                                         server=self.server, **kwargs)
+
+    def test_fair_share(self):
+        first = self.create_newsletter('first', status=Newsletter.WAITING, priority=2)
+        second = self.create_newsletter('second', status=Newsletter.SENDING)
+        self.create_newsletter('draft')
+        self.scheduler.refresh()
+        served = [self.scheduler.next() for i in range(6)]
+        self.assertEqual(served.count(first), 4)
+        self.assertEqual(served.count(second), 2)
+
+        self.scheduler.done(first.id)
+        self.assertEqual([self.scheduler.next() for i in range(2)], [second, second])
+
+    def test_refresh(self):
+        self.scheduler.refresh()
+        self.assertEqual(self.scheduler.next(), None)
+
+        later = self.create_newsletter('later', status=Newsletter.WAITING,
+                                       sending_date=datetime.now() + timedelta(hours=1))
+        newsletter = self.create_newsletter('newsletter', status=Newsletter.WAITING)
+        self.assertEqual(self.scheduler.refresh(), [])
+        self.assertEqual(self.scheduler.next(), newsletter)
+        self.assertTrue(3500 < self.scheduler.timeout() <= 3600)
+
+        newsletter.status = Newsletter.CANCELED
+        newsletter.save()
+        later.sending_date = datetime.now()
+        later.save()
+        self.assertEqual(self.scheduler.refresh(), [newsletter.id])
+        self.assertEqual(self.scheduler.next(), later)
+        self.assertEqual(self.scheduler.next(), later)
+
+    def test_max_messages(self):
+        self.mailinglist.subscribers.add(*[Contact.objects.create(email='test%i@domain.com' % i)
+                                           for i in range(5)])
+        self.create_newsletter('newsletter', status=Newsletter.WAITING)
+        mailer = SMTPMailer(self.server, max_messages=3)
+        mailer.smtp = FakeSMTP()
+        mailer.run()
+        self.assertEqual(mailer.smtp.mails_sent, 3)
+        self.assertEqual(ContactMailingStatus.objects.count(), 3)
+
+
+class WakeupTestCase(TransactionTestCase):
+    """Tests for the wakeup of the senders"""
+
+    def test_notify(self):
+        listener = Listener(1)
+        listener.open()
+        notify(2)
+        self.assertFalse(listener.wait(0.5))
+        notify(1)
+        self.assertTrue(listener.wait(0.5))
+        listener.interrupt()
+        self.assertFalse(listener.wait(5))
+        listener.close()
+
+
+class SupervisorTestCase(SimpleTestCase):
+    """Tests for the supervisor of the worker processes"""
+
+    def setUp(self):
+        self.server = SMTPServer(pk=1, name='Test SMTP')
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            self.addCleanup(signal.signal, signum, signal.getsignal(signum))
+
+    def run_supervisor(self, supervisor, seconds):
+        """Run the supervisor until stopped after seconds,
+        return the (time, message) logged"""
+        logs = []
+        supervisor.log = lambda worker, message: logs.append((time.monotonic(), message))
+        timer = threading.Timer(seconds, supervisor.stop)
+        timer.start()
+        supervisor.run()
+        timer.join()
+        return logs
+
+    def test_restart(self):
+        supervisor = Supervisor([self.server])
+        supervisor.target = crashing_worker
+        with mock.patch('emencia.django.newsletter.supervisor.RESTART_DELAY', 0.1):
+            logs = self.run_supervisor(supervisor, 1)
+
+        starts = [when for when, message in logs if message.startswith('started')]
+        # restarted after 0.1, 0.2 and 0.4 seconds
+        self.assertTrue(len(starts) >= 4)
+        for i, (start, restart) in enumerate(zip(starts, starts[1:])):
+            self.assertTrue(restart - start >= 0.1 * 2 ** i)
+        self.assertEqual(supervisor.workers[0].failures, len(starts) - 1 +
+                         (supervisor.workers[0].process is None))
+
+    def test_stop(self):
+        supervisor = Supervisor([self.server], processes=2)
+        supervisor.target = stopping_worker
+        logs = self.run_supervisor(supervisor, 0.5)
+
+        # the workers exited cleanly and were not restarted
+        messages = [message for when, message in logs]
+        self.assertEqual(len([message for message in messages
+                              if message.startswith('started')]), 2)
+        self.assertEqual(len([message for message in messages
+                              if message in ('exited, recycled', 'stopped')]), 2)
+        for worker in supervisor.workers:
+            self.assertEqual(worker.failures, 0)
+            self.assertTrue(worker.process is None or worker.process.exitcode == 0)
+
+
 class StatisticsTestCase(TestCase):
     """Tests for the statistics functions"""
 
@@ -422,6 +1271,8 @@ class StatisticsTestCase(TestCase):
                                             contact=self.contacts[0],
                                             status=ContactMailingStatus.SENT_TEST)
 
+        recount_newsletter(self.newsletter)
+
         self.recipients = len(self.contacts)
         self.status = ContactMailingStatus.objects.filter(newsletter=self.newsletter)
 
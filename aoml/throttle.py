@@ -0,0 +1,120 @@
+"""Pacing of the mails sent by a SMTP server"""
+import time
+import threading
+from smtplib import SMTPResponseException
+from smtplib import SMTPRecipientsRefused
+
+from .models import SMTPServer
+from .settings import ADAPTIVE_INITIAL_RATE
+from .settings import ADAPTIVE_MIN_RATE
+from .settings import ADAPTIVE_INCREASE
+from .settings import ADAPTIVE_DECREASE
+from .settings import ADAPTIVE_LATENCY_FACTOR
+
+# replies of a server asking to slow down
+THROTTLING_CODES = (421, 451)
+# the replies to the mails sent before a decrease are still to come,
+# the rate is decreased at most once in this many seconds
+DECREASE_INTERVAL = 5
+# seconds between the reports of the effective rate
+REPORT_INTERVAL = 10
+# weight of the last reply in the average latency
+LATENCY_WEIGHT = 0.1
+# seconds between the reads of the rate schedule of the server
+SCHEDULE_INTERVAL = 60
+
+
+def is_throttling(exception):
+    """Tell if a failure asks to slow down"""
+    if isinstance(exception, SMTPRecipientsRefused):
+        return bool(exception.recipients) and any(
+            code in THROTTLING_CODES for code, message in exception.recipients.values())
+    if isinstance(exception, SMTPResponseException):
+        return exception.smtp_code in THROTTLING_CODES
+    return False
+
+
+class Throttle(object):
+    """Give the sending slots of a SMTP server, one every 3600 / rate
+    seconds, shared by the connections of a sender.
+
+    The rate is mails_hour following the rate schedule, or with the
+    adaptive rate of the server it is increased by
+    NEWSLETTER_ADAPTIVE_INCREASE mails per hour at each mail sent and
+    multiplied by NEWSLETTER_ADAPTIVE_DECREASE on a throttling reply or
+    a reply NEWSLETTER_ADAPTIVE_LATENCY_FACTOR times slower than the
+    average, between NEWSLETTER_ADAPTIVE_MIN_RATE and the scheduled
+    mails_hour (additive increase, multiplicative decrease)."""
+
+    def __init__(self, server):
+        self.server = server
+        self.adaptive = server.adaptive_rate
+        self.ceiling = server.rate() or float('inf')
+        if self.adaptive:
+            self.rate = min(ADAPTIVE_INITIAL_RATE, self.ceiling)
+        else:
+            self.rate = server.rate()
+        self.latency = None
+        self.next_slot = 0.0
+        self.last_decrease = 0.0
+        self.reported = 0.0
+        self.scheduled = time.monotonic()
+        self.lock = threading.Lock()
+
+    def follow_schedule(self):
+        """Read the rate of the schedule of the server, at most every
+        SCHEDULE_INTERVAL seconds"""
+        if not self.server.rate_schedule or \
+               time.monotonic() - self.scheduled < SCHEDULE_INTERVAL:
+            return
+        self.scheduled = time.monotonic()
+        rate = self.server.rate()
+        self.ceiling = rate or float('inf')
+        if self.adaptive:
+            self.rate = min(self.rate, self.ceiling)
+        else:
+            self.rate = rate
+
+    def delay(self):
+        """Seconds between two mails at the current rate"""
+        if not self.rate:
+            return 0.0
+        return 3600.0 / self.rate
+
+    def reserve(self):
+        """Take the next sending slot, return the seconds to wait for it"""
+        with self.lock:
+            self.follow_schedule()
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.delay()
+            return slot - now
+
+    def record(self, latency, exception=None):
+        """Adapt the rate to the reply to a mail, received in latency
+        seconds"""
+        if not self.adaptive:
+            return
+        with self.lock:
+            spike = (self.latency is not None and
+                     latency > self.latency * ADAPTIVE_LATENCY_FACTOR)
+            if is_throttling(exception) or (exception is None and spike):
+                now = time.monotonic()
+                if now - self.last_decrease >= DECREASE_INTERVAL:
+                    self.rate = max(self.rate * ADAPTIVE_DECREASE, ADAPTIVE_MIN_RATE)
+                    self.last_decrease = now
+            elif exception is None:
+                self.rate = min(self.rate + ADAPTIVE_INCREASE, self.ceiling)
+            if exception is None:
+                self.latency = latency if self.latency is None else (
+                    self.latency + LATENCY_WEIGHT * (latency - self.latency))
+
+    def report_due(self):
+        return self.adaptive and time.monotonic() - self.reported >= REPORT_INTERVAL
+
+    def report(self):
+        """Save the effective rate on the server, for the monitoring"""
+        self.reported = time.monotonic()
+        self.server.effective_rate = int(self.rate)
+        SMTPServer.objects.filter(pk=self.server.pk).update(
+            effective_rate=self.server.effective_rate)
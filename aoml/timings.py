@@ -0,0 +1,107 @@
+"""Timings of the stages of the sending of the mails"""
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.dispatch import Signal
+
+# stages of a mail, in their order
+STAGES = ('title', 'render', 'tracking', 'html2text', 'serialize', 'smtp', 'status')
+# upper bounds in seconds of the buckets of the histograms
+BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+          0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# sent by a sender once a newsletter is processed, with the newsletter
+# and its Timings
+timings_recorded = Signal()
+
+
+class Histogram(object):
+    """Durations counted in buckets of BOUNDS"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect_left(BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for i, count in enumerate(other.buckets):
+            self.buckets[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self):
+        return self.count and self.total / self.count
+
+    def percentile(self, percent):
+        """Upper bound of the bucket of the percentile"""
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(BOUNDS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Timings(object):
+    """Histograms of the durations of the stages of the mails of a
+    newsletter, and of the ones of each SMTP server sending it, the
+    stages not sent by a server being counted for server.
+
+    Thread safe, shared by the connections of a sender."""
+
+    def __init__(self, server=None):
+        self.server = server
+        self.stages = {}
+        self.servers = {}
+        self.lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.stages)
+
+    def add(self, stage, seconds, server=None):
+        server = server or self.server
+        with self.lock:
+            self.stages.setdefault(stage, Histogram()).add(seconds)
+            if server is not None:
+                self.servers.setdefault(server, {}).setdefault(
+                    stage, Histogram()).add(seconds)
+
+    @contextmanager
+    def measure(self, stage, server=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, server)
+
+
+def merge(histograms, stages):
+    """Add the histograms of stages to the histograms by stage"""
+    for stage, histogram in stages.items():
+        histograms.setdefault(stage, Histogram()).merge(histogram)
+    return histograms
+
+
+def summary(stages):
+    """Lines of a table of the histograms by stage, in milliseconds"""
+    lines = ['%-10s %8s %10s %8s %8s %8s %8s' % (
+        'stage', 'count', 'total (s)', 'mean', 'p50', 'p95', 'max')]
+    for stage in sorted(stages, key=lambda stage: (
+            stage not in STAGES, STAGES.index(stage) if stage in STAGES else stage)):
+        histogram = stages[stage]
+        lines.append('%-10s %8i %10.2f %8.2f %8.2f %8.2f %8.2f' % (
+            stage, histogram.count, histogram.total, histogram.mean() * 1000,
+            histogram.percentile(50) * 1000, histogram.percentile(95) * 1000,
+            histogram.max * 1000))
+    return lines
@@ -1,4 +1,6 @@
 """Utils for newsletter"""
+import re
+
 from bs4 import BeautifulSoup
 from django.urls import reverse
 
@@ -6,24 +8,53 @@ from ..models import Link
 from ..settings import USE_PRETTIFY
 from ..settings import BS_PARSER
 
-def track_links(content, context):
+TEMPLATE_TAG_RE = re.compile(r'{[{%].*?[%}]}', re.DOTALL)
+CONTACT_DEPENDENT_RE = re.compile(r'\b(contact|uidb36|token)\b|'
+                                  r'^{%\s*(include|extends|load|ssi)\b')
+
+
+def is_contact_independent(template_string):
+    """Check if a newsletter content only depends on the contact
+    through the links rendered with his tokens (unsubscribe, view on site,
+    tracking), in which case it can be rendered once for all the contacts.
+    Tags able to pull an arbitrary context are considered as dependent."""
+    for tag in TEMPLATE_TAG_RE.findall(template_string):
+        if CONTACT_DEPENDENT_RE.search(tag):
+            return False
+    return True
+
+
+def track_links(content, context, links=None):
     """Convert all links in the template for the user
-    to track his navigation"""
+    to track his navigation.
+
+    links is an optional dict of Link ids by url, shared between
+    the calls for a newsletter to hit the database once per url."""
     if not context.get('uidb36'):
         return content
 
+    if links is None:
+        links = {}
+    # The link id is the last argument of the url, so the url
+    # is reversed once and completed for each link
+    tracking_url = 'https://%s%s' % (context['domain'], reverse('newsletter_newsletter_tracking_link',
+                                                                args=[context['newsletter'].slug,
+                                                                      context['uidb36'], context['token'],
+                                                                      0]))
+    tracking_url = tracking_url[:-len('0/')]
+
     soup = BeautifulSoup(content, BS_PARSER)
     for link_markup in soup('a'):
         if link_markup.get('href') and \
                'no-track' not in link_markup.get('rel', ''):
             link_href = link_markup['href']
-            link_title = link_markup.get('title', link_href)
-            link, created = Link.objects.get_or_create(url=link_href,
-                                                       defaults={'title': link_title})
-            link_markup['href'] = 'https://%s%s' % (context['domain'], reverse('newsletter_newsletter_tracking_link',
-                                                                              args=[context['newsletter'].slug,
-                                                                                    context['uidb36'], context['token'],
-                                                                                    link.pk]))
+            if link_href not in links:
+                link_title = link_markup.get('title', link_href)
+                # the senders of other processes may create the same link
+                link = Link.objects.filter(url=link_href).order_by('pk').first() or \
+                       Link.objects.create(url=link_href, title=link_title)
+                links[link_href] = link.pk
+            link_markup['href'] = '%s%s/' % (tracking_url, links[link_href])
     if USE_PRETTIFY:
         return soup.prettify()
     else:
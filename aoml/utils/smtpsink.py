@@ -0,0 +1,132 @@
+"""Minimal SMTP server discarding the mails, for tests and benchmarks"""
+import time
+import asyncio
+import threading
+
+
+class SMTPSink(object):
+    """SMTP server accepting all the mails without delivering them.
+
+    latency simulates the network round-trip by delaying each reply
+    without blocking the reading of the next commands, refused is a
+    set of recipients rejected with a 550 reply. With greylist each
+    recipient is deferred with a 450 reply the first time.
+
+    Can be served in the running event loop with start() or
+    in a background thread with start_thread()."""
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, refused=(),
+                 greylist=False):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.refused = set(refused)
+        self.greylist = greylist
+        self.greylisted = set()
+        self.messages = []
+        # connections open and the most open at once
+        self.connections = 0
+        self.peak_connections = 0
+        self.server = None
+        self.loop = None
+        self.thread = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def start_thread(self):
+        """Serve in a daemon thread, return once listening"""
+        started = threading.Event()
+
+        def serve():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.start())
+            started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=serve, name='smtp-sink', daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop_thread(self):
+        asyncio.run_coroutine_threadsafe(self.stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    async def handle(self, reader, writer):
+        replies = asyncio.Queue()
+        replier = asyncio.ensure_future(self.reply(replies, writer))
+        replies.put_nowait((time.monotonic(), b'220 sink ESMTP\r\n'))
+        sender, recipients = None, []
+        self.connections += 1
+        self.peak_connections = max(self.peak_connections, self.connections)
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                command = line[:4].upper()
+                if command == b'EHLO':
+                    reply = b'250-sink\r\n250-PIPELINING\r\n250 8BITMIME\r\n'
+                elif command == b'MAIL':
+                    sender, recipients = line[10:].strip(), []
+                    reply = b'250 OK\r\n'
+                elif command == b'RCPT':
+                    recipient = line[8:].strip().strip(b'<>').decode()
+                    if recipient in self.refused:
+                        reply = b'550 No such user\r\n'
+                    elif self.greylist and recipient not in self.greylisted:
+                        self.greylisted.add(recipient)
+                        reply = b'450 Greylisted, try again later\r\n'
+                    else:
+                        recipients.append(recipient)
+                        reply = b'250 OK\r\n'
+                elif command == b'DATA':
+                    replies.put_nowait((time.monotonic() + self.latency,
+                                        b'354 End data with <CR><LF>.<CR><LF>\r\n'))
+                    data = []
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'.\r\n', b''):
+                            break
+                        data.append(line)
+                    if recipients:
+                        self.messages.append((sender, recipients, b''.join(data)))
+                        reply = b'250 OK queued\r\n'
+                    else:
+                        reply = b'554 No valid recipients\r\n'
+                elif command == b'QUIT':
+                    replies.put_nowait((time.monotonic() + self.latency, b'221 Bye\r\n'))
+                    break
+                elif command in (b'HELO', b'RSET', b'NOOP'):
+                    reply = b'250 OK\r\n'
+                else:
+                    reply = b'502 Command not implemented\r\n'
+                replies.put_nowait((time.monotonic() + self.latency, reply))
+        finally:
+            self.connections -= 1
+            replies.put_nowait(None)
+            await replier
+            writer.close()
+
+    async def reply(self, replies, writer):
+        """Write the replies in order once their delay is elapsed"""
+        while True:
+            item = await replies.get()
+            if item is None:
+                return
+            due, reply = item
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                writer.write(reply)
+                await writer.drain()
+            except ConnectionError:
+                return
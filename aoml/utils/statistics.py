@@ -111,10 +111,10 @@ def get_newsletter_top_links(status):
 
 def get_newsletter_statistics(newsletter):
     """Return the statistics of a newsletter"""
-    recipients = newsletter.mailing_list.expedition_set().count()
+    recipients = newsletter.recipients()
     all_status = Status.objects.filter(newsletter=newsletter)
     post_sending_status = all_status.filter(creation_date__gte=newsletter.sending_date)
-    mails_sent = post_sending_status.filter(status=Status.SENT).count()
+    mails_sent = newsletter.sent_count
 
     statistics = {'tests_sent': all_status.filter(status=Status.SENT_TEST).count(),
                   'mails_sent': mails_sent,
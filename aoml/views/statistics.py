@@ -39,7 +39,7 @@ def get_daily_stats(newsletter):
     start = 0
     end = 10
 
-    recipients = newsletter.mailing_list.expedition_set().count()
+    recipients = newsletter.recipients()
 
     sending_date = newsletter.sending_date.date()
     days = []
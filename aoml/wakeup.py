@@ -0,0 +1,176 @@
+"""Wake up the continuous senders when a newsletter changes.
+
+With PostgreSQL the notifications go through LISTEN/NOTIFY, so the
+senders of all the hosts are woken up, otherwise they are datagrams
+sent to the unix sockets opened by the senders of the host."""
+import os
+import select
+import socket
+from glob import glob
+from uuid import uuid4
+
+from django.db import DEFAULT_DB_ALIAS
+from django.db import DatabaseError
+from django.db import connection
+from django.db import connections
+
+from .settings import WAKEUP
+from .settings import WAKEUP_DIR
+
+CHANNEL = 'aoml_newsletter'
+
+
+def use_postgresql():
+    return connection.vendor == 'postgresql'
+
+
+def use_sockets():
+    return hasattr(socket, 'AF_UNIX')
+
+
+def notify(server_id):
+    """Wake up the senders of a SMTP server"""
+    if not WAKEUP:
+        return
+    payload = str(server_id)
+    if use_postgresql():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, payload])
+    elif use_sockets():
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            for path in glob(os.path.join(WAKEUP_DIR, '*.sock')):
+                try:
+                    sock.sendto(payload.encode(), path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # left by a crashed sender
+                    remove(path)
+                except OSError:
+                    # buffer full, the sender will wake up anyway
+                    pass
+        finally:
+            sock.close()
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class Listener(object):
+    """Wait for the notifications of a SMTP server, or of all the servers
+    if server_id is None, without polling. The channel is opened on the
+    first wait, and a wait can be interrupted from another thread."""
+
+    def __init__(self, server_id=None):
+        self.server_id = server_id
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.database = None
+        self.socket = None
+        self.path = None
+        self.received = []
+
+    def open(self):
+        """Open the channel of the notifications, before reading the
+        newsletters not to miss their changes"""
+        if not WAKEUP or self.database or self.socket:
+            return
+        try:
+            self.open_channel()
+        except (DatabaseError, OSError):
+            # wait without notifications until the next try
+            self.close_channel()
+
+    def open_channel(self):
+        if use_postgresql():
+            self.database = connections.create_connection(DEFAULT_DB_ALIAS)
+            # waits are run by any thread of an executor
+            self.database.inc_thread_sharing()
+            with self.database.cursor() as cursor:
+                cursor.execute('LISTEN %s' % CHANNEL)
+            if hasattr(self.database.connection, 'add_notify_handler'):
+                # psycopg 3
+                self.database.connection.add_notify_handler(self.received.append)
+        elif use_sockets():
+            os.makedirs(WAKEUP_DIR, exist_ok=True)
+            self.path = os.path.join(WAKEUP_DIR, '%s.sock' % uuid4().hex[:16])
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.bind(self.path)
+            self.socket.setblocking(False)
+
+    def close_channel(self):
+        if self.database:
+            try:
+                self.database.close()
+            except DatabaseError:
+                pass
+            self.database.dec_thread_sharing()
+            self.database = None
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+            remove(self.path)
+
+    def close(self):
+        self.close_channel()
+        self.reader.close()
+        self.writer.close()
+
+    def interrupt(self):
+        """Stop the current or next wait"""
+        try:
+            self.writer.send(b'\0')
+        except OSError:
+            pass
+
+    def wait(self, timeout=None):
+        """Wait for a notification until timeout or interrupt,
+        return True if notified"""
+        self.open()
+        channels = [channel for channel in (self.socket, self.database and
+                                            self.database.connection) if channel]
+        readable = select.select([self.reader] + channels, [], [], timeout)[0]
+        if self.reader in readable:
+            drain(self.reader)
+        if not any(channel in readable for channel in channels):
+            return False
+        return self.receive()
+
+    def receive(self):
+        """Read the notifications received"""
+        payloads = []
+        if self.socket:
+            payloads.extend(payload.decode() for payload in drain(self.socket))
+        if self.database:
+            raw = self.database.connection
+            try:
+                with self.database.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+            except DatabaseError:
+                # the notifications may be lost, act as notified
+                self.close_channel()
+                return True
+            if not hasattr(raw, 'add_notify_handler'):
+                # psycopg 2
+                self.received.extend(raw.notifies)
+                del raw.notifies[:]
+            payloads.extend(notification.payload for notification in self.received)
+            del self.received[:]
+        return self.server_id is None or str(self.server_id) in payloads
+
+
+def drain(sock):
+    """Read the pending datagrams of a non blocking socket"""
+    datagrams = []
+    while True:
+        try:
+            datagram = sock.recv(64)
+        except (BlockingIOError, InterruptedError):
+            return datagrams
+        if not datagram:
+            return datagrams
+        datagrams.append(datagram)
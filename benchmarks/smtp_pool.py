@@ -0,0 +1,92 @@
+"""Benchmark of the Mailer sending rate by size of the connection pool.
+
+The mails are sent to a local SMTPSink simulating the network latency,
+on a temporary SQLite database.
+
+  $ python benchmarks/smtp_pool.py --mails 500 --latency 0.02 --pools 1 2 5 10 20
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django
+from django.conf import settings
+
+
+def setup(database):
+    settings.configure(
+        SECRET_KEY='benchmark',
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': database,
+                               'OPTIONS': {'timeout': 30}}},
+        INSTALLED_APPS=['django.contrib.contenttypes',
+                        'django.contrib.auth',
+                        'aoml'],
+        ROOT_URLCONF='benchmarks.urls',
+        TEMPLATES=[{'BACKEND': 'django.template.backends.django.DjangoTemplates',
+                    'APP_DIRS': True}],
+        DEFAULT_AUTO_FIELD='django.db.models.BigAutoField',
+        NEWSLETTER_STATUS_JOURNAL_DIR=tempfile.mkdtemp())
+    django.setup()
+
+    from django.core.management import call_command
+    call_command('migrate', verbosity=0)
+
+
+def run(mails, latency, pools):
+    from django.utils import timezone
+    from aoml.mailer import Mailer
+    from aoml.models import Contact
+    from aoml.models import MailingList
+    from aoml.models import Newsletter
+    from aoml.models import SMTPServer
+    from aoml.models import ContactMailingStatus
+    from aoml.utils.smtpsink import SMTPSink
+
+    sink = SMTPSink(latency=latency)
+    sink.start_thread()
+
+    server = SMTPServer.objects.create(name='sink', host=sink.host, port=sink.port,
+                                       tls=False, ssl=False)
+    mailing_list = MailingList.objects.create(name='benchmark')
+    Contact.objects.bulk_create([Contact(email='contact-%i@example.com' % i)
+                                 for i in range(mails)])
+    mailing_list.subscribers.add(*Contact.objects.all())
+    newsletter = Newsletter.objects.create(
+        title='Benchmark', slug='benchmark', mailing_list=mailing_list,
+        server=server, sending_date=timezone.now(),
+        content='<p>Hello</p><a href="http://example.com/">link</a>')
+
+    print('%i mails, %.0f ms latency' % (mails, latency * 1000))
+    print('%12s %12s %12s' % ('connections', 'seconds', 'mails/s'))
+    for pool in pools:
+        ContactMailingStatus.objects.all().delete()
+        Newsletter.objects.filter(pk=newsletter.pk).update(status=Newsletter.WAITING)
+        server.max_connections = pool
+        server.save()
+
+        mailer = Mailer(Newsletter.objects.get(pk=newsletter.pk))
+        start = time.time()
+        mailer.run()
+        duration = time.time() - start
+        assert newsletter.mails_sent() == mails
+        print('%12i %12.2f %12.1f' % (pool, duration, mails / duration))
+
+    sink.stop_thread()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mails', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='simulated latency of each SMTP reply in seconds')
+    parser.add_argument('--pools', type=int, nargs='+', default=[1, 2, 5, 10, 20])
+    options = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile(suffix='.db') as database:
+        setup(database.name)
+        run(options.mails, options.latency, options.pools)
@@ -0,0 +1,9 @@
+"""Urls for the benchmarks"""
+from django.urls import include
+from django.urls import re_path
+
+urlpatterns = [
+    re_path(r'^newsletters/', include('aoml.urls.newsletter')),
+    re_path(r'^mailing/', include('aoml.urls.mailing_list')),
+    re_path(r'^tracking/', include('aoml.urls.tracking')),
+]